@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+"""Benchmark eval.py's result handling against fake-nix-eval-jobs.py.
+
+  python3 .github/eval-bench.py [--scale 0.1] [--only traces]
+
+Runs eval.py over synthetic result streams as it would run in CI, output
+discarded, and reports per scenario the lines it took in, how much CPU eval.py
+itself spent on them (not the stand-in, which runs beside it), the rate that
+gives, and eval.py's peak RSS. Both are sampled from /proc while it runs, so
+they can miss its last few milliseconds. Each run writes a --profile,
+checked to hold each attribute exactly once: the sharding, worked out by the
+stand-in as the Nix expression would, must neither drop nor repeat any. The
+cached scenario instead fills the result cache first, then times the replay
+and checks that it reports every attribute. The incremental one fills it
+too, with a package directory per synthetic package, then changes one
+package and checks that only that package's attributes and the devShells,
+keyed by the whole tree, are evaluated again.
+"""
+
+import argparse
+import collections
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVAL = os.path.join(HERE, "eval.py")
+FAKE = os.path.join(HERE, "fake-nix-eval-jobs.py")
+SAMPLE_INTERVAL = 0.01
+
+# name -> (stand-in options, eval.py options); --attrs is scaled by --scale.
+# The CACHED ones run once to fill the result cache and measure the next run.
+SCENARIOS = {
+    "results": (["--attrs", "20000"], []),
+    "warnings": (["--attrs", "20000", "--warn-every", "1"], []),
+    "traces": (
+        ["--attrs", "5000", "--error-rate", "0.2", "--trace-lines", "400"],
+        [],
+    ),
+    "shards": (["--attrs", "20000"], ["--local", "4"]),
+    "cached": (["--attrs", "20000"], ["--local", "4"]),
+    # Small enough that its --select, skipped and assigned maps and all,
+    # still fits in one argument.
+    "incremental": (["--attrs", "1000"], ["--local", "4"]),
+}
+CACHED = ("cached", "incremental")
+# The package the incremental scenario changes.
+CHANGED = "pkg-000000"
+
+
+class Sampler:
+    """CPU seconds and peak RSS of one process, read from /proc until it exits."""
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.cpu = 0.0
+        self.peak_mb = 0.0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        ticks = os.sysconf("SC_CLK_TCK")
+        while not self.done.is_set():
+            try:
+                with open(f"/proc/{self.pid}/stat", encoding="ascii") as f:
+                    # Fields after the parenthesised name; utime and stime are
+                    # the 14th and 15th overall.
+                    fields = f.read().rpartition(")")[2].split()
+                self.cpu = (int(fields[11]) + int(fields[12])) / ticks
+                with open(f"/proc/{self.pid}/status", encoding="ascii") as f:
+                    for line in f:
+                        if line.startswith("VmHWM:"):
+                            self.peak_mb = int(line.split()[1]) / 1024
+                            break
+            except (OSError, ValueError, IndexError):
+                return
+            self.done.wait(SAMPLE_INTERVAL)
+
+    def stop(self) -> None:
+        self.done.set()
+        self.thread.join()
+
+
+def git(cwd: str, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+        cwd=cwd,
+        check=True,
+    )
+
+
+def make_packages(cwd: str, attrs: int) -> None:
+    """A packages/pkgs-by-name directory per synthetic package name."""
+    # As many names as the system with the most synthetic packages has
+    names = (attrs - attrs // 10 + 1) // 2
+    for i in range(names):
+        directory = os.path.join(cwd, "packages", "pkgs-by-name", f"pkg-{i:06d}")
+        os.makedirs(directory)
+        with open(os.path.join(directory, "package.nix"), "w", encoding="utf-8") as f:
+            f.write(f"# pkg-{i:06d}\n")
+
+
+def run(name: str, scale: float, workdir: str) -> dict[str, float | int | str]:
+    fake_args, eval_args = SCENARIOS[name]
+    fake_args = list(fake_args)
+    attrs = max(1, int(int(fake_args[fake_args.index("--attrs") + 1]) * scale))
+    fake_args[fake_args.index("--attrs") + 1] = str(attrs)
+    if "--warn-every" in fake_args:
+        every = int(fake_args[fake_args.index("--warn-every") + 1])
+        lines = attrs + attrs // every
+    else:
+        lines = attrs
+    profile = os.path.join(workdir, f"{name}.jsonl")
+    timings = os.path.join(workdir, f"{name}-timings.json")
+    cwd = os.path.join(workdir, name)
+    os.mkdir(cwd)
+    cmd = [
+        sys.executable,
+        EVAL,
+        *(eval_args if "--local" in eval_args else ["0", "1", *eval_args]),
+        "--nix-eval-jobs",
+        shlex.join([sys.executable, FAKE, *fake_args]),
+        "--timings",
+        timings,
+    ]
+    expected = None
+    if name in CACHED:
+        # The cache is keyed by a git tree, so give it one.
+        cmd += ["--cache", os.path.join(workdir, "cache")]
+        git(cwd, "init", "-q")
+        if name == "incremental":
+            make_packages(cwd, attrs)
+            git(cwd, "add", ".")
+        git(cwd, "commit", "-q", "--allow-empty", "-m", name)
+        # Attributes are left out of the --select only if timed, so assigned.
+        fill = [*cmd, "--record", timings] if name == "incremental" else cmd
+        subprocess.run(fill, stdout=subprocess.DEVNULL, cwd=cwd, check=False)
+        if name == "incremental":
+            path = os.path.join(cwd, "packages", "pkgs-by-name", CHANGED, "package.nix")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("# changed\n")
+            git(cwd, "commit", "-q", "-a", "-m", f"{name}: change {CHANGED}")
+            layout = {"packages": attrs - attrs // 10, "devShells": attrs // 10}
+            # Package names are per system, so CHANGED is one on each
+            expected = min(2, layout["packages"]) + layout["devShells"]
+            cmd += ["--profile", profile]
+        # A replay evaluates nothing; count the report.
+        lines = attrs
+    else:
+        cmd += ["--profile", profile]
+    started = time.monotonic()
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd, text=True
+    )
+    sampler = Sampler(proc.pid)
+    output, _ = proc.communicate()
+    wall = time.monotonic() - started
+    sampler.stop()
+
+    seen = collections.Counter()
+    if os.path.exists(profile):
+        with open(profile, encoding="utf-8") as f:
+            for line in f:
+                seen[json.loads(line)["attr"]] += 1
+    repeated = sum(1 for count in seen.values() if count > 1)
+    reported = f"Evaluated {attrs} attributes" in output
+    if name not in CACHED:
+        coverage = "ok"
+        if len(seen) != attrs or repeated:
+            coverage = f"{len(seen)} of {attrs}, {repeated} repeated"
+    elif not reported:
+        coverage = "replay incomplete"
+    elif expected is not None and (len(seen) != expected or repeated):
+        coverage = f"evaluated {len(seen)} again, not {expected}"
+    else:
+        coverage = "ok"
+    return {
+        "scenario": name,
+        "lines": lines,
+        "wall": wall,
+        "cpu": sampler.cpu,
+        "rate": lines / sampler.cpu if sampler.cpu else 0.0,
+        "peak_mb": sampler.peak_mb,
+        "coverage": coverage,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="run only this scenario; may be repeated",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply every scenario's attribute count (default: 1)",
+    )
+    parser.add_argument(
+        "--json", metavar="FILE", help="also write the results to FILE as JSON"
+    )
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'scenario':<10} {'lines':>8} {'wall s':>8} {'cpu s':>8} "
+        f"{'lines/cpu s':>12} {'peak MB':>8}  sharding"
+    )
+    with tempfile.TemporaryDirectory(prefix="eval-bench-") as workdir:
+        for name in args.only or SCENARIOS:
+            r = run(name, args.scale, workdir)
+            results.append(r)
+            print(
+                f"{r['scenario']:<10} {r['lines']:>8} {r['wall']:>8.2f} "
+                f"{r['cpu']:>8.2f} {r['rate']:>12.0f} {r['peak_mb']:>8.1f}  "
+                f"{r['coverage']}",
+                flush=True,
+            )
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    return 0 if all(r["coverage"] == "ok" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
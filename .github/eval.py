@@ -2,26 +2,105 @@
 # SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
-"""Evaluate flake outputs using nix-eval-jobs with index-based sharding."""
+"""Evaluate flake outputs using nix-eval-jobs with index-based sharding.
 
+Attributes are spread over the shards by (globalIdx + localIdx) mod totalJobs,
+unless a timing file says how long each took last time: those are packed
+longest first onto the least loaded shard, so one shard drawing several heavy
+NixOS configurations no longer sets the critical path. Attributes the file
+does not know still go by the modulo. Each shard can record its own times
+with --record. The eval workflow merges those of the last run on main and
+hands the same file to every shard, since shards balanced by different times
+would drop or repeat attributes. Locally, .github/eval-timings.json is read
+when present; refresh it from a run's eval-timings-* artifacts with
+
+  jq -s add timings-*.json > .github/eval-timings.json
+
+On one large machine, --local N runs all N shards at once and merges them
+into a single report and exit status, sharing the host's memory between
+them; --fail-fast stops the rest at the first error.
+
+With --cache DIR, results are kept per attribute, content-addressed and
+keyed by the files the attribute can read, flake.lock among them. A package
+from packages/pkgs-by-name reads its own directory, those of the packages it
+names and the code the whole flake shares, but no NixOS module, target, test
+or other package beyond their flake-module.nix files; any other attribute
+may read the whole tree but .github and the like. Attributes the timing file
+assigns to a shard are replayed when their key is cached and left out of its
+--select, so a change to one package evaluates that package again, and one
+to a module everything but those packages. A shard whose whole tree
+is unchanged is replayed without running nix-eval-jobs at all. Failures
+are never cached, so they are always evaluated again. --base REV looks up
+REV's results for the same attributes and lists those whose drvPath differs,
+which --affected writes out for a build to pick up. The eval workflow
+restores the last main run's cache into every shard and, for a pull request,
+compares against the merge base.
+
+Successes are counted, not kept, so memory stays flat however many
+attributes there are. --profile streams one JSON line per attribute with its
+eval time and its worker's peak RSS; the slowest are tabled at the end, and
+--baseline, an earlier profile, flags attributes that got slower or bigger.
+
+--nix-eval-jobs swaps the command, which with fake-nix-eval-jobs.py replays
+synthetic or recorded result streams without Nix; eval-bench.py uses that to
+measure how fast and how lean the reporting path is.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import heapq
 import json
+import os
+import queue
+import shlex
 import subprocess
 import sys
+import threading
 import time
-from typing import Any
+from collections.abc import Iterable, Iterator
+from typing import Any, TextIO
+
+# Read by default when it exists; stale entries only cost balance, never
+# correctness, as a missing attribute falls back to the modulo.
+DEFAULT_TIMINGS = os.path.join(os.path.dirname(__file__), "eval-timings.json")
+# What a cached result keeps; the rest of nix-eval-jobs' output is not needed.
+CACHED_FIELDS = ("attr", "attrPath", "drvPath")
+# Top-level paths no Nix file reads, left out of the cache key so a change to
+# CI, licensing or the Markdown beside them keeps the cached results. docs/ is
+# not one of them: it is a package's source.
+NOT_EVALUATED = (".github", "LICENSES", "REUSE.toml")
+# Where the packages are that key on their own directory, and the trees none
+# of them reads but for the flake-module.nix files the flake itself imports.
+PACKAGES_DIR = "packages/pkgs-by-name"
+MODULE_TREES = ("docs/", "modules/", "targets/", "tests/")
+# How nix-eval-jobs is run unless --nix-eval-jobs says otherwise.
+NIX_EVAL_JOBS = ["nix", "run", "--inputs-from", ".#", "nixpkgs#nix-eval-jobs", "--"]
+# A regression must also clear these, so noise on quick attributes is not one.
+MIN_REGRESSION_SECONDS = 1.0
+MIN_REGRESSION_MB = 64
 
 SELECT_EXPR = """
 flake: let
   lib = flake.inputs.nixpkgs.lib;
   jobId = {job_id};
   totalJobs = {total_jobs};
+  # "output.system.name" -> shard, packed from recorded eval times
+  assigned = builtins.fromJSON {assigned};
+  # "output.system.name" -> true for those replayed from the cache
+  skipped = builtins.fromJSON {skipped};
 
-  # Shard an attrset: keep attrs where (globalIdx + localIdx) mod totalJobs == jobId
-  shardAttrs = globalIdx: attrs:
+  # Shard an attrset: keep attrs assigned to jobId, or failing an assignment
+  # those where (globalIdx + localIdx) mod totalJobs == jobId
+  shardAttrs = prefix: globalIdx: attrs:
     let
       names = builtins.attrNames attrs;
       selected = lib.imap0 (i: name:
-        if lib.mod (globalIdx + i) totalJobs == jobId then name else null
+        let
+          key = "${{prefix}}.${{name}}";
+          shard = assigned.${{key}} or (lib.mod (globalIdx + i) totalJobs);
+        in
+        if shard == jobId && !(skipped ? ${{key}}) then name else null
       ) names;
     in lib.getAttrs (builtins.filter (x: x != null) selected) attrs;
 
@@ -33,7 +112,7 @@ flake: let
       offsets = builtins.foldl' (acc: sys:
         acc // {{ ${{sys}} = acc._idx; _idx = acc._idx + builtins.length (builtins.attrNames output.${{sys}}); }}
       ) {{ _idx = 0; }} systems;
-    in builtins.mapAttrs (sys: attrs: shardAttrs offsets.${{sys}} attrs) output;
+    in builtins.mapAttrs (sys: attrs: shardAttrs "${{outputName}}.${{sys}}" offsets.${{sys}} attrs) output;
 
 in {{
   packages = shardOutput "packages";
@@ -42,78 +121,629 @@ in {{
 """
 
 
-def run_eval(
-    job_id: int, total_jobs: int
-) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
-    """Run nix-eval-jobs and return (successes, errors)."""
-    select_expr = SELECT_EXPR.format(job_id=job_id, total_jobs=total_jobs)
+def nix_string(text: str) -> str:
+    """Quote text as a Nix string literal."""
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("${", "\\${")
+    return f'"{escaped}"'
+
+
+def shard_key(result: dict[str, Any]) -> str:
+    """The unit sharding assigns: output.system.name, whatever lies below it."""
+    path = result.get("attrPath") or result.get("attr", "?").split(".")
+    return ".".join(path[:3])
+
+
+def load_timings(path: str) -> dict[str, float]:
+    """Seconds per shard key from a timing file; empty if there is none."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            timings = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"[!] Ignoring timing file {path}: {e}", file=sys.stderr)
+        return {}
+    return {k: float(v) for k, v in timings.items() if isinstance(v, int | float)}
+
+
+def save_timings(path: str, timings: dict[str, float]) -> None:
+    """Merge this run's timings into path, keeping entries for other shards."""
+    merged = load_timings(path)
+    merged.update((k, round(v, 2)) for k, v in timings.items())
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(merged, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def assign_shards(timings: dict[str, float], total_jobs: int) -> dict[str, int]:
+    """Longest-processing-time-first: each attribute to the least loaded shard.
+
+    Every shard computes this from the same file, so ties are broken by name
+    and shard number to make them all agree.
+    """
+    loads = [(0.0, shard) for shard in range(total_jobs)]
+    assigned = {}
+    for attr, seconds in sorted(timings.items(), key=lambda kv: (-kv[1], kv[0])):
+        load, shard = heapq.heappop(loads)
+        assigned[attr] = shard
+        heapq.heappush(loads, (load + seconds, shard))
+    return assigned
+
+
+def select_expr(
+    job_id: int,
+    total_jobs: int,
+    assigned: dict[str, int],
+    skipped: Iterable[str] = (),
+) -> str:
+    """The --select expression for one shard, less the shard keys skipped."""
+    return SELECT_EXPR.format(
+        job_id=job_id,
+        total_jobs=total_jobs,
+        assigned=nix_string(json.dumps(assigned, sort_keys=True)),
+        skipped=nix_string(json.dumps(dict.fromkeys(sorted(skipped), True))),
+    )
+
+
+def git(*args: str) -> str:
+    return subprocess.run(
+        ["git", *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def digest(files: dict[str, str]) -> str:
+    """A sha256 over paths and the blobs git holds for them."""
+    listing = "".join(f"{path}\0{blob}\n" for path, blob in sorted(files.items()))
+    return hashlib.sha256(listing.encode()).hexdigest()
+
+
+class InputTree:
+    """The files the flake evaluates, at a revision or in the working tree.
+
+    Nix copies the tracked files of a git flake, modified ones as they are on
+    disk, so that is the tree: git stash create records exactly those without
+    touching the index or the working tree. NOT_EVALUATED and top-level
+    Markdown files are left out; flake.lock is in.
+    """
+
+    def __init__(self, rev: str, files: dict[str, str]) -> None:
+        self.rev = rev
+        self.files = files
+        self.whole: str | None = None
+        self.reads: dict[str, set[str]] | None = None
+        self.keys: dict[str, str] = {}
+
+    @classmethod
+    def read(cls, rev: str | None = None) -> "InputTree | None":
+        """The tree at rev, or in the working tree; None outside a checkout."""
+        try:
+            if rev is None:
+                rev = git("stash", "create") or "HEAD"
+            rev = git("rev-parse", "--verify", f"{rev}^{{commit}}")
+            listing = git("ls-tree", "-r", "-z", rev)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        files = {}
+        for entry in listing.split("\0"):
+            meta, _, path = entry.partition("\t")
+            top = path.partition("/")[0]
+            if not path or top in NOT_EVALUATED or top == path and path.endswith(".md"):
+                continue
+            files[path] = meta.rpartition(" ")[2]
+        return cls(rev, files)
+
+    def key(self) -> str:
+        """A digest of the whole tree, for results that may read any of it."""
+        if self.whole is None:
+            self.whole = digest(self.files)
+        return self.whole
+
+    def package_reads(self) -> dict[str, set[str]]:
+        """Package name -> the PACKAGES_DIR directories evaluating it reads.
+
+        Its own, and that of every package it names, word for word anywhere in
+        its files, and so on for those: a dependency spelled some other way
+        goes unseen, a name that is not one only costs a needless evaluation.
+        """
+        if self.reads is not None:
+            return self.reads
+        prefix = f"{PACKAGES_DIR}/"
+        names = {
+            path.split("/")[2]
+            for path in self.files
+            if path.startswith(prefix) and path.count("/") > 2
+        }
+        named = {name: {name} for name in names}
+        patterns = [arg for name in sorted(names) for arg in ("-e", name)]
+        found = ""
+        with contextlib.suppress(OSError, subprocess.CalledProcessError):
+            # git grep exits 1 when nothing matches
+            if patterns:
+                found = git(
+                    "grep", "-I", "-o", "-w", "-F", *patterns, self.rev, "--", prefix
+                )
+        for line in found.splitlines():
+            path, _, name = line.removeprefix(f"{self.rev}:").rpartition(":")
+            if path.startswith(prefix) and name in names:
+                named[path.split("/")[2]].add(name)
+        self.reads = {}
+        for name in names:
+            reads, todo = set(), [name]
+            while todo:
+                if (other := todo.pop()) not in reads:
+                    reads.add(other)
+                    todo.extend(named[other])
+            self.reads[name] = reads
+        return self.reads
+
+    def attr_key(self, attr: str) -> str:
+        """A digest of the files the attribute attr, a shard key, can read."""
+        output, _, rest = attr.partition(".")
+        name = rest.partition(".")[2]
+        if output != "packages" or name not in self.package_reads():
+            return self.key()
+        if name not in self.keys:
+            reads = self.package_reads()[name]
+            prefix = f"{PACKAGES_DIR}/"
+            self.keys[name] = digest(
+                {
+                    path: blob
+                    for path, blob in self.files.items()
+                    if (
+                        path.split("/")[2] in reads
+                        if path.startswith(prefix)
+                        else not path.startswith(MODULE_TREES)
+                        or path.endswith("/flake-module.nix")
+                    )
+                }
+            )
+        return self.keys[name]
+
+
+class CacheWriter:
+    """One shard's results as they arrive, indexed only if the shard completes.
+
+    Each shard key's results are also indexed on their own, under the key of
+    the files that attribute reads, unless one of them failed; the shard as a
+    whole only if none did.
+    """
+
+    def __init__(self, cache: "ResultCache", tree: InputTree, index: str) -> None:
+        self.cache = cache
+        self.tree = tree
+        self.index = index
+        self.failed: set[str] = set()
+        os.makedirs(os.path.dirname(index), exist_ok=True)
+        self.file = open(f"{index}.tmp", "w", encoding="utf-8")  # noqa: SIM115
+
+    def write(self, result: dict[str, Any]) -> None:
+        key = shard_key(result)
+        if "error" in result:
+            self.failed.add(key)
+        else:
+            self.file.write(f"{self.cache.put(result)} {key}\n")
+
+    def commit(self) -> None:
+        # Renamed into place, so a shard killed part way leaves no entry; the
+        # objects it stored are harmless and may serve another shard later.
+        self.file.close()
+        by_key: dict[str, list[str]] = {}
+        with open(f"{self.index}.tmp", encoding="utf-8") as f:
+            for line in f:
+                result, _, key = line.rstrip("\n").partition(" ")
+                by_key.setdefault(key, []).append(result)
+        for key, digests in by_key.items():
+            if key not in self.failed:
+                self.cache.store(self.cache.attr_index(self.tree, key), digests)
+        if self.failed:
+            self.discard()
+        else:
+            os.replace(f"{self.index}.tmp", self.index)
+
+    def discard(self) -> None:
+        self.file.close()
+        os.unlink(f"{self.index}.tmp")
+
+
+class ResultCache:
+    """Content-addressed results under a directory any cache can carry.
+
+    DIR/objects/ab/<sha256>.json holds one attribute's result, named by the
+    hash of what it holds, so every shard, rerun and tree that yields the same
+    result shares one file. An index lists such hashes, one per line:
+    DIR/attrs/ab/<hash> the results of one shard key for one key of the files
+    it reads (InputTree.attr_key), DIR/shards/<tree key>/<command hash> those
+    of one nix-eval-jobs command for one whole tree, the command standing for
+    the shard's --select and with it its assignments. Nothing is ever
+    rewritten, so caches restored from several runs merge by copying over each
+    other; reading an entry touches it, so what a run did not use can be told
+    by its age and pruned.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def index(self, tree: InputTree, cmd: list[str]) -> str:
+        selection = hashlib.sha256(shlex.join(cmd).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, "shards", tree.key(), selection)
+
+    def attr_index(self, tree: InputTree, attr: str) -> str:
+        key = hashlib.sha256(f"{tree.attr_key(attr)}\0{attr}".encode()).hexdigest()
+        return os.path.join(self.directory, "attrs", key[:2], key)
+
+    def object(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], f"{digest}.json")
+
+    def put(self, result: dict[str, Any]) -> str:
+        """Store one result, unless it is there already; its hash."""
+        kept = {k: result[k] for k in CACHED_FIELDS if k in result}
+        data = json.dumps(kept, sort_keys=True).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        return digest
+
+    def store(self, index: str, digests: list[str]) -> None:
+        """Write an index listing digests, unless it is there already."""
+        if os.path.exists(index):
+            return
+        os.makedirs(os.path.dirname(index), exist_ok=True)
+        with open(f"{index}.{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+            f.writelines(f"{d}\n" for d in digests)
+        os.replace(f"{index}.{os.getpid()}.tmp", index)
+
+    def digests(self, index: str) -> list[str] | None:
+        """The hashes an index lists, or None unless every object is there.
+
+        A partly restored cache can hold an index without its objects; those
+        results are evaluated again rather than replayed short.
+        """
+        try:
+            with open(index, encoding="utf-8") as f:
+                digests = [line.split()[0] for line in f if line.strip()]
+        except OSError:
+            return None
+        paths = [index, *map(self.object, digests)]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        for path in paths:
+            os.utime(path)
+        return digests
+
+    def results(self, digests: list[str]) -> Iterator[dict[str, Any]]:
+        for digest in digests:
+            with open(self.object(digest), encoding="utf-8") as f:
+                yield json.load(f)
 
+    def writer(self, tree: InputTree, cmd: list[str]) -> CacheWriter:
+        return CacheWriter(self, tree, self.index(tree, cmd))
+
+    def drv_paths(
+        self, tree: InputTree, keys: Iterable[str]
+    ) -> dict[str, dict[str, str | None]]:
+        """shard key -> attr -> drvPath, for those of keys cached for tree."""
+        paths = {}
+        for key in keys:
+            digests = self.digests(self.attr_index(tree, key))
+            if digests is not None:
+                paths[key] = {
+                    r.get("attr", "?"): r.get("drvPath") for r in self.results(digests)
+                }
+        return paths
+
+
+def read_jsonl(path: str) -> Iterator[dict[str, Any]]:
+    """The JSON objects in a JSON-lines file, skipping lines that are not."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except OSError:
+        return
+
+
+def load_profile(path: str) -> dict[str, tuple[float, float | None]]:
+    """attr -> (seconds, peak RSS in MB) from a --profile file."""
+    return {
+        p["attr"]: (p["seconds"], p.get("peak_rss_mb"))
+        for p in read_jsonl(path)
+        if "attr" in p and "seconds" in p
+    }
+
+
+def worker_peak_rss(pid: int) -> float | None:
+    """Peak RSS in MB of nix-eval-jobs' worker, the child of pid.
+
+    `nix run` execs nix-eval-jobs, so pid is that; its one worker is its
+    child, and is replaced once it outgrows --max-memory-size.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", encoding="ascii") as f:
+            children = f.read().split()
+    except OSError:
+        return None
+    peak = None
+    for child in children:
+        try:
+            with open(f"/proc/{child}/status", encoding="ascii") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        rss = int(line.split()[1]) / 1024
+                        peak = rss if peak is None else max(peak, rss)
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+    return peak
+
+
+class Report:
+    """What a run keeps of its results, independent of how many there are.
+
+    Successes are counted and errors kept for the final listing. Optional
+    parts: per-shard-key timings for --record, drvPaths for --base, the
+    slowest attributes, a streamed --profile and regressions against a
+    --baseline profile.
+    """
+
+    def __init__(
+        self,
+        slowest: int = 0,
+        profile: TextIO | None = None,
+        baseline: dict[str, tuple[float, float | None]] | None = None,
+        threshold: float = 0.2,
+        timings: bool = False,
+        drv_paths: bool = False,
+    ) -> None:
+        self.succeeded = 0
+        self.errors: list[dict[str, Any]] = []
+        self.slowest = slowest
+        self.slow: list[tuple[float, str, float | None]] = []
+        self.profile = profile
+        self.baseline = baseline or {}
+        self.threshold = threshold
+        self.regressions: list[tuple[str, str, float, float]] = []
+        self.timings: dict[str, float] | None = {} if timings else None
+        self.drv_paths: dict[str, dict[str, str | None]] | None = (
+            {} if drv_paths else None
+        )
+
+    def add(
+        self,
+        result: dict[str, Any],
+        job_id: int | None = None,
+        seconds: float | None = None,
+        rss: float | None = None,
+    ) -> None:
+        """Count a result; seconds and rss only for one evaluated just now."""
+        attr = result.get("attr", "?")
+        if "error" in result:
+            self.errors.append(result)
+        else:
+            self.succeeded += 1
+        if self.drv_paths is not None and attr != "nix-eval-jobs":
+            paths = self.drv_paths.setdefault(shard_key(result), {})
+            paths[attr] = result.get("drvPath")
+        if seconds is None:
+            return
+        if self.timings is not None:
+            key = shard_key(result)
+            self.timings[key] = self.timings.get(key, 0.0) + seconds
+        if self.slowest:
+            entry = (seconds, attr, rss)
+            if len(self.slow) < self.slowest:
+                heapq.heappush(self.slow, entry)
+            else:
+                heapq.heappushpop(self.slow, entry)
+        if self.profile is not None:
+            line = {
+                "attr": attr,
+                "shard": job_id,
+                "seconds": round(seconds, 3),
+                "peak_rss_mb": rss and round(rss),
+                "failed": "error" in result,
+            }
+            self.profile.write(json.dumps(line) + "\n")
+        if attr in self.baseline:
+            self.compare(attr, seconds, rss)
+
+    def compare(self, attr: str, seconds: float, rss: float | None) -> None:
+        old_seconds, old_rss = self.baseline[attr]
+        limit = 1 + self.threshold
+        if seconds > old_seconds * limit and seconds - old_seconds >= (
+            MIN_REGRESSION_SECONDS
+        ):
+            self.regressions.append((attr, "time", old_seconds, seconds))
+        if (
+            rss is not None
+            and old_rss is not None
+            and rss > old_rss * limit
+            and rss - old_rss >= MIN_REGRESSION_MB
+        ):
+            self.regressions.append((attr, "memory", old_rss, rss))
+
+
+def eval_command(
+    select: str, max_memory: int | None, command: list[str] | None = None
+) -> list[str]:
+    """The nix-eval-jobs invocation for one shard; command runs nix-eval-jobs."""
     cmd = [
-        "nix",
-        "run",
-        "--inputs-from",
-        ".#",
-        "nixpkgs#nix-eval-jobs",
-        "--",
+        *(command or NIX_EVAL_JOBS),
         "--flake",
         ".#",
         "--no-instantiate",
         "--select",
-        select_expr,
+        select,
         "--force-recurse",
         "--accept-flake-config",
         "--option",
         "allow-import-from-derivation",
         "false",
     ]
+    if max_memory is not None:
+        cmd += ["--max-memory-size", str(max_memory)]
+    return cmd
+
 
-    successes = []
-    errors = []
+def read_lines(job_id: int, proc: subprocess.Popen, lines: queue.Queue) -> None:
+    """Forward one shard's output lines, then None once it has ended."""
+    assert proc.stdout is not None
+    for line in proc.stdout:
+        lines.put((job_id, line))
+    lines.put((job_id, None))
+
+
+def run_eval(
+    selects: dict[int, str],
+    report: Report,
+    max_memory: int | None = None,
+    fail_fast: bool = False,
+    writers: dict[int, CacheWriter] | None = None,
+    command: list[str] | None = None,
+) -> None:
+    """Run nix-eval-jobs for each shard at once, adding the results to report.
+
+    An attribute's eval time is the gap since the same shard's previous
+    result: each nix-eval-jobs runs one worker, so that is the time spent
+    evaluating it (a shard's first result also carries the flake load). With
+    fail_fast, the first error stops the shards still running. writers, by
+    shard, get every result and are committed if their shard completes.
+    """
+    job_ids = list(selects)
+    writers = writers or {}
     start_time = time.time()
+    tagged = len(job_ids) > 1
 
     print("[+] Starting nix-eval-jobs...", flush=True)
 
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as proc:
-        assert proc.stdout is not None
-        for line in proc.stdout:
+    lines: queue.Queue = queue.Queue()
+    procs = {}
+    last = {}
+    for job_id in job_ids:
+        cmd = eval_command(selects[job_id], max_memory, command)
+        procs[job_id] = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        last[job_id] = time.monotonic()
+        threading.Thread(
+            target=read_lines, args=(job_id, procs[job_id], lines), daemon=True
+        ).start()
+
+    running = set(job_ids)
+    cancelled: set[int] = set()
+    failed: set[int] = set()
+    try:
+        while running:
+            job_id, line = lines.get()
+            if line is None:
+                running.discard(job_id)
+                exit_code = procs[job_id].wait()
+                # An exit status alone is worth reporting only if nothing else
+                # from this shard already explains it.
+                if exit_code != 0 and job_id not in cancelled | failed:
+                    report.add(
+                        {
+                            "attr": "nix-eval-jobs",
+                            "error": f"Process exited with code {exit_code}",
+                        }
+                    )
+                writer = writers.pop(job_id, None)
+                if writer is not None:
+                    if exit_code == 0:
+                        writer.commit()
+                    else:
+                        writer.discard()
+                continue
             line = line.strip()
             if not line:
                 continue
             try:
                 result = json.loads(line)
-                elapsed = time.time() - start_time
-                attr = result.get("attr", "?")
-                if "error" in result:
-                    errors.append(result)
-                    print(f"[{elapsed:6.1f}s] ✗ {attr}")
-                else:
-                    successes.append(result)
-                    print(f"[{elapsed:6.1f}s] ✓ {attr}")
             except json.JSONDecodeError:
                 # Not JSON, probably a warning
                 print(line, file=sys.stderr)
+                continue
+            now = time.monotonic()
+            seconds = now - last[job_id]
+            last[job_id] = now
+            rss = worker_peak_rss(procs[job_id].pid)
+            report.add(result, job_id, seconds, rss)
+            if job_id in writers:
+                writers[job_id].write(result)
+            elapsed = time.time() - start_time
+            attr = result.get("attr", "?")
+            shard = f" [shard {job_id}]" if tagged else ""
+            memory = f", {rss:.0f} MB" if rss is not None else ""
+            if "error" in result:
+                failed.add(job_id)
+                print(f"[{elapsed:6.1f}s] ✗ {attr}{shard} ({seconds:.1f}s{memory})")
+                if fail_fast and running - cancelled - {job_id}:
+                    cancelled |= running - {job_id}
+                    print("[!] Stopping the other shards (--fail-fast)")
+                    for other in cancelled:
+                        procs[other].terminate()
+            else:
+                print(f"[{elapsed:6.1f}s] ✓ {attr}{shard} ({seconds:.1f}s{memory})")
+            sys.stdout.flush()
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        for writer in writers.values():
+            writer.discard()
 
-        exit_code = proc.wait()
-        if exit_code != 0 and not errors:
-            errors.append(
-                {
-                    "attr": "nix-eval-jobs",
-                    "error": f"Process exited with code {exit_code}",
-                }
-            )
+    if cancelled:
+        print(f"[!] Cancelled shards: {' '.join(map(str, sorted(cancelled)))}")
 
-    return successes, errors
 
+def default_max_memory(shards: int) -> int | None:
+    """Per-worker memory cap in MiB sharing MemAvailable, or None if ample.
 
-def print_results(
-    successes: list[dict[str, Any]], errors: list[dict[str, Any]], elapsed: float
-) -> None:
+    nix-eval-jobs restarts a worker that grows past its --max-memory-size,
+    4096 MiB by default; several shards at once must not add up to more than
+    the host has.
+    """
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) // 1024
+                    break
+            else:
+                return None
+    except (OSError, ValueError, IndexError):
+        return None
+    share = available // shards
+    return None if share >= 4096 else max(share, 1024)
+
+
+def print_results(report: Report, elapsed: float) -> None:
     """Pretty print evaluation results."""
+    errors = sorted(report.errors, key=lambda r: r.get("attr", ""))
     print(f"\n{'=' * 60}")
-    print(f"Evaluated {len(successes) + len(errors)} attributes in {elapsed:.1f}s")
-    print(f"  ✓ {len(successes)} succeeded")
+    print(f"Evaluated {report.succeeded + len(errors)} attributes in {elapsed:.1f}s")
+    print(f"  ✓ {report.succeeded} succeeded")
     print(f"  ✗ {len(errors)} failed")
 
+    if report.slow:
+        print(f"\n{'=' * 60}")
+        print(f"Slowest {len(report.slow)}:\n")
+        for seconds, attr, rss in sorted(report.slow, reverse=True):
+            memory = f"{rss:8.0f} MB" if rss is not None else f"{'?':>8} MB"
+            print(f"  {seconds:8.1f}s {memory}  {attr}")
+
+    if report.regressions:
+        print(f"\n{'=' * 60}")
+        print(f"Regressed against the baseline by over {report.threshold:.0%}:\n")
+        for attr, kind, old, new in sorted(report.regressions):
+            unit = "s" if kind == "time" else " MB"
+            print(f"  {attr}: {kind} {old:.1f}{unit} -> {new:.1f}{unit}")
+
     if errors:
         print(f"\n{'=' * 60}")
         print("Errors:\n")
@@ -127,31 +757,238 @@ def print_results(
             print()
 
 
+def replay(
+    report: Report,
+    cache: ResultCache,
+    digests: list[str],
+    known: dict[str, float],
+    writer: CacheWriter | None = None,
+) -> None:
+    """Add cached results to report, and to writer if there is one.
+
+    Their shard keys keep the times known for them, so --record still has
+    them for the next run to balance by.
+    """
+    for result in cache.results(digests):
+        report.add(result)
+        key = shard_key(result)
+        if report.timings is not None and key in known:
+            report.timings[key] = known[key]
+        if writer is not None:
+            writer.write(result)
+
+
+def affected_outputs(
+    base: dict[str, str | None], current: dict[str, str | None]
+) -> list[tuple[str, str]]:
+    """(mark, attr) for each output whose drvPath differs from base's.
+
+    "+" is new, "-" gone and "~" changed; a failure counts as a drvPath of
+    None, so an attribute that starts or stops failing is changed too.
+    """
+    marks = []
+    for attr in sorted(base.keys() | current.keys()):
+        if attr not in base:
+            marks.append(("+", attr))
+        elif attr not in current:
+            marks.append(("-", attr))
+        elif base[attr] != current[attr]:
+            marks.append(("~", attr))
+    return marks
+
+
 def main() -> int:
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <job-id> <total-jobs>", file=sys.stderr)
-        return 1
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("job_id", type=int, nargs="?", help="this shard, from 0")
+    parser.add_argument("total_jobs", type=int, nargs="?", help="number of shards")
+    parser.add_argument(
+        "--local",
+        type=int,
+        metavar="N",
+        help="instead of one shard, run all N shards at once on this host",
+    )
+    parser.add_argument(
+        "--max-memory-size",
+        type=int,
+        metavar="MIB",
+        help="nix-eval-jobs worker memory cap (default with --local: "
+        "MemAvailable shared between the shards, at most 4096)",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="with --local, stop the other shards at the first error",
+    )
+    parser.add_argument(
+        "--timings",
+        default=DEFAULT_TIMINGS,
+        metavar="FILE",
+        help="per-attribute eval times to balance shards by "
+        "(default: eval-timings.json next to this script, if present)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="keep results in DIR and replay those whose inputs are unchanged",
+    )
+    parser.add_argument(
+        "--base",
+        metavar="REV",
+        help="with --cache, list the outputs whose drvPath differs from REV's "
+        "cached results",
+    )
+    parser.add_argument(
+        "--affected",
+        metavar="FILE",
+        help="with --base, write the affected attributes to FILE, one per line",
+    )
+    parser.add_argument(
+        "--nix-eval-jobs",
+        metavar="CMD",
+        help="run nix-eval-jobs as CMD, split like a shell would, e.g. "
+        "fake-nix-eval-jobs.py to run without Nix",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="merge this run's per-attribute eval times into FILE",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="write each attribute's eval time and worker peak RSS to FILE "
+        "as JSON lines",
+    )
+    parser.add_argument(
+        "--slowest",
+        type=int,
+        default=10,
+        metavar="N",
+        help="list the N slowest attributes at the end (default: 10; 0: none)",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="an earlier --profile; flag attributes that regressed against it",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        metavar="PCT",
+        help="with --baseline, how much slower or bigger is a regression (default: 20)",
+    )
+    args = parser.parse_args()
+    if args.base and not args.cache:
+        parser.error("--base compares against cached results; give --cache")
 
-    try:
-        job_id = int(sys.argv[1])
-        total_jobs = int(sys.argv[2])
-    except ValueError:
-        print("Error: job-id and total-jobs must be integers", file=sys.stderr)
-        return 1
+    if args.local is not None:
+        if args.job_id is not None or args.local <= 0:
+            parser.error("--local N takes no job-id, and N must be positive")
+        job_ids, total_jobs = list(range(args.local)), args.local
+        max_memory = args.max_memory_size or default_max_memory(args.local)
+        print(f"[+] Evaluating flake outputs ({total_jobs} shards at once)")
+    else:
+        if args.job_id is None or args.total_jobs is None:
+            parser.error("give <job-id> <total-jobs>, or --local N")
+        job_id, total_jobs = args.job_id, args.total_jobs
+        if job_id < 0 or total_jobs <= 0 or job_id >= total_jobs:
+            print("Error: invalid job-id or total-jobs", file=sys.stderr)
+            return 1
+        job_ids, max_memory = [job_id], args.max_memory_size
+        print(f"[+] Evaluating flake outputs (job {job_id}/{total_jobs})")
 
-    if job_id < 0 or total_jobs <= 0 or job_id >= total_jobs:
-        print("Error: invalid job-id or total-jobs", file=sys.stderr)
-        return 1
+    known = load_timings(args.timings)
+    assigned = assign_shards(known, total_jobs)
+    if known:
+        total = sum(known.values())
+        mine = sum(known[attr] for attr, shard in assigned.items() if shard in job_ids)
+        print(
+            f"[+] Balancing {len(known)} timed attributes: ~{mine:.0f}s here, "
+            f"{total / total_jobs:.0f}s per shard ideally; others by modulo"
+        )
 
-    print(f"[+] Evaluating flake outputs (job {job_id}/{total_jobs})")
+    with contextlib.ExitStack() as stack:
+        profile = None
+        if args.profile:
+            profile = stack.enter_context(open(args.profile, "w", encoding="utf-8"))
+        report = Report(
+            slowest=args.slowest,
+            profile=profile,
+            baseline=load_profile(args.baseline) if args.baseline else None,
+            threshold=args.threshold / 100,
+            timings=bool(args.record),
+            drv_paths=bool(args.base),
+        )
+        start_time = time.time()
 
-    start_time = time.time()
-    successes, errors = run_eval(job_id, total_jobs)
-    elapsed = time.time() - start_time
-    print_results(successes, errors, elapsed)
+        selects = {}
+        writers = {}
+        command = shlex.split(args.nix_eval_jobs) if args.nix_eval_jobs else None
+        cache = ResultCache(args.cache) if args.cache else None
+        tree = InputTree.read() if cache else None
+        if cache and tree is None:
+            print("[!] Not in a git checkout; evaluating without the cache")
+        for job_id in job_ids:
+            select = select_expr(job_id, total_jobs, assigned)
+            if cache is None or tree is None:
+                selects[job_id] = select
+                continue
+            # The memory cap changes how it is run, not what comes out.
+            cmd = eval_command(select, None, command)
+            digests = cache.digests(cache.index(tree, cmd))
+            if digests is not None:
+                replay(report, cache, digests, known)
+                print(f"[+] Shard {job_id}: tree unchanged, {len(digests)} cached")
+                continue
+            writers[job_id] = cache.writer(tree, cmd)
+            skipped = []
+            for attr, shard in assigned.items():
+                if shard != job_id:
+                    continue
+                digests = cache.digests(cache.attr_index(tree, attr))
+                if digests is not None:
+                    replay(report, cache, digests, known, writers[job_id])
+                    skipped.append(attr)
+            if skipped:
+                print(f"[+] Shard {job_id}: {len(skipped)} unchanged attributes cached")
+            selects[job_id] = select_expr(job_id, total_jobs, assigned, skipped)
+
+        if selects:
+            run_eval(selects, report, max_memory, args.fail_fast, writers, command)
+        elapsed = time.time() - start_time
+
+    print_results(report, elapsed)
+
+    if args.base:
+        current = report.drv_paths or {}
+        base_tree = InputTree.read(args.base) if cache else None
+        base = cache.drv_paths(base_tree, current) if cache and base_tree else {}
+        if not base:
+            print(f"\n[!] No cached results for {args.base}; nothing to compare")
+        else:
+            marks = affected_outputs(
+                {attr: path for key in base for attr, path in base[key].items()},
+                {attr: path for key in base for attr, path in current[key].items()},
+            )
+            # Attributes REV has no cached results for may differ or not.
+            marks += [
+                ("?", attr)
+                for key in current.keys() - base.keys()
+                for attr in current[key]
+            ]
+            marks.sort(key=lambda mark: mark[1])
+            print(f"\nAffected outputs against {args.base}: {len(marks)}")
+            for mark, attr in marks:
+                print(f"  {mark} {attr}")
+            if args.affected:
+                with open(args.affected, "w", encoding="utf-8") as f:
+                    f.writelines(f"{attr}\n" for mark, attr in marks if mark != "-")
+    if args.record and report.timings is not None:
+        save_timings(args.record, report.timings)
     sys.stdout.flush()
 
-    return 1 if errors else 0
+    return 1 if report.errors else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+"""Stand in for nix-eval-jobs, streaming made-up or recorded results.
+
+  eval.py --local 4 --nix-eval-jobs ".github/fake-nix-eval-jobs.py --attrs 10000"
+
+Takes nix-eval-jobs' own arguments after its options and ignores all but
+--select, from which it reads the shard the way eval.py's SELECT_EXPR would
+evaluate it: jobId, totalJobs and the assigned map, then (globalIdx +
+localIdx) mod totalJobs over sorted names for the rest, less the skipped
+ones eval.py replays from its cache. So every attribute lands on exactly one
+shard, the same one Nix would put it on, and sharding can be checked without
+Nix.
+
+Synthetic attributes are packages and devShells spread over two systems.
+--error-rate of them fail with a --trace-lines trace, the same ones in every
+run, and --warn-every puts a non-JSON line on stdout between results, which is
+where eval.py has to tell them apart. --replay streams a recorded nix-eval-jobs
+stdout instead (`nix-eval-jobs ... > stream.jsonl`), resharded the same way.
+--rate caps results per second; by default they come as fast as they can.
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+import time
+import zlib
+from collections.abc import Iterator
+from typing import Any
+
+SYSTEMS = ("aarch64-linux", "x86_64-linux")
+# Synthetic attributes that are devShells rather than packages, one in this many.
+DEVSHELL_EVERY = 10
+
+
+def nix_unquote(literal: str) -> str:
+    """The text of a Nix string literal as eval.py's nix_string writes it."""
+    return re.sub(r"\\(.)", r"\1", literal)
+
+
+def parse_select(select: str) -> tuple[int, int, dict[str, int], dict[str, bool]]:
+    """(jobId, totalJobs, assigned, skipped) from eval.py's --select expression."""
+    job_id = re.search(r"jobId = (\d+);", select)
+    total_jobs = re.search(r"totalJobs = (\d+);", select)
+    if job_id is None or total_jobs is None:
+        sys.exit("fake-nix-eval-jobs: --select is not eval.py's")
+    maps = [
+        re.search(rf'{name} = builtins\.fromJSON "((?:[^"\\]|\\.)*)";', select)
+        for name in ("assigned", "skipped")
+    ]
+    return (
+        int(job_id.group(1)),
+        int(total_jobs.group(1)),
+        *(json.loads(nix_unquote(found.group(1))) if found else {} for found in maps),
+    )
+
+
+def synthetic_layout(attrs: int) -> dict[str, dict[str, int]]:
+    """output -> system -> how many attributes, adding up to attrs."""
+    shells = attrs // DEVSHELL_EVERY
+    layout: dict[str, dict[str, int]] = {}
+    for output, count in (("devShells", shells), ("packages", attrs - shells)):
+        per, extra = divmod(count, len(SYSTEMS))
+        layout[output] = {system: per + (i < extra) for i, system in enumerate(SYSTEMS)}
+    return layout
+
+
+def synthetic_names(layout: dict[str, dict[str, int]]) -> Iterator[list[str]]:
+    """attrPath per attribute, in attrNames order, generated as it goes."""
+    for output in sorted(layout):
+        for system in sorted(layout[output]):
+            for i in range(layout[output][system]):
+                # Zero-padded, so sorted names keep their numeric order.
+                yield [output, system, f"pkg-{i:06d}"]
+
+
+def recorded_layout(path: str) -> dict[str, dict[str, list[str]]]:
+    """output -> system -> sorted names in a recorded stream."""
+    names: dict[str, dict[str, set[str]]] = {}
+    for result in read_recorded(path):
+        if isinstance(result, dict) and len(result.get("attrPath", [])) >= 3:
+            output, system, name = result["attrPath"][:3]
+            names.setdefault(output, {}).setdefault(system, set()).add(name)
+    return {
+        output: {system: sorted(n) for system, n in systems.items()}
+        for output, systems in names.items()
+    }
+
+
+def read_recorded(path: str) -> Iterator[dict[str, Any] | str]:
+    """Each line of a recorded stream, parsed if it is JSON."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield line
+
+
+def shard_of(
+    path: list[str],
+    offsets: dict[tuple[str, str], int],
+    index: int,
+    total_jobs: int,
+    assigned: dict[str, int],
+    skipped: dict[str, bool],
+) -> int | None:
+    """The shard SELECT_EXPR's shardAttrs puts an attribute on; None if skipped."""
+    output, system, name = path[:3]
+    key = f"{output}.{system}.{name}"
+    if key in skipped:
+        return None
+    if key in assigned:
+        return assigned[key]
+    return (offsets[output, system] + index) % total_jobs
+
+
+def system_offsets(counts: dict[str, dict[str, int]]) -> dict[tuple[str, str], int]:
+    """globalIdx per (output, system): the attributes in earlier systems."""
+    offsets = {}
+    for output, systems in counts.items():
+        total = 0
+        for system in sorted(systems):
+            offsets[output, system] = total
+            total += systems[system]
+    return offsets
+
+
+def synthetic_results(
+    args: argparse.Namespace,
+    job_id: int,
+    total_jobs: int,
+    assigned: dict[str, int],
+    skipped: dict[str, bool],
+) -> Iterator[Any]:
+    layout = synthetic_layout(args.attrs)
+    offsets = system_offsets(layout)
+    trace = "\n".join(
+        f"       … while evaluating attribute 'level{i}' at /nix/store/"
+        f"{'0' * 32}-source/modules/level{i}.nix:{i + 1}:3"
+        for i in range(args.trace_lines)
+    )
+    for path in synthetic_names(layout):
+        index = int(path[2].removeprefix("pkg-"))
+        if shard_of(path, offsets, index, total_jobs, assigned, skipped) != job_id:
+            continue
+        attr = ".".join(path)
+        # The same attributes fail whichever shard and run they are in.
+        if zlib.crc32(attr.encode()) % 10000 < args.error_rate * 10000:
+            yield {
+                "attr": attr,
+                "attrPath": path,
+                "error": f"error: {path[2]} failed to evaluate\n{trace}",
+            }
+            continue
+        digest = hashlib.sha256(attr.encode()).hexdigest()[:32]
+        yield {
+            "attr": attr,
+            "attrPath": path,
+            "drvPath": f"/nix/store/{digest}-{path[2]}.drv",
+            "name": path[2],
+            "outputs": {"out": f"/nix/store/{digest}-{path[2]}"},
+            "system": path[1],
+        }
+
+
+def replayed_results(
+    args: argparse.Namespace,
+    job_id: int,
+    total_jobs: int,
+    assigned: dict[str, int],
+    skipped: dict[str, bool],
+) -> Iterator[Any]:
+    layout = recorded_layout(args.replay)
+    offsets = system_offsets(
+        {o: {s: len(n) for s, n in systems.items()} for o, systems in layout.items()}
+    )
+    indices = {
+        (output, system, name): i
+        for output, systems in layout.items()
+        for system, names in systems.items()
+        for i, name in enumerate(names)
+    }
+    for result in read_recorded(args.replay):
+        if isinstance(result, dict) and len(result.get("attrPath", [])) >= 3:
+            path = result["attrPath"]
+            index = indices[tuple(path[:3])]
+            if shard_of(path, offsets, index, total_jobs, assigned, skipped) != job_id:
+                continue
+        yield result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--attrs", type=int, default=1000, help="synthetic attributes (default: 1000)"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="share of synthetic attributes that fail",
+    )
+    parser.add_argument(
+        "--trace-lines",
+        type=int,
+        default=20,
+        metavar="N",
+        help="lines of trace per failure (default: 20)",
+    )
+    parser.add_argument(
+        "--warn-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="print a warning line to stdout after every N results",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        metavar="PER_SECOND",
+        help="results per second (default: unlimited)",
+    )
+    parser.add_argument(
+        "--replay", metavar="FILE", help="stream a recorded nix-eval-jobs stdout"
+    )
+    parser.add_argument("--select", required=True, help=argparse.SUPPRESS)
+    # nix-eval-jobs' other arguments, which eval.py passes and nothing here needs.
+    args, _ = parser.parse_known_args()
+
+    job_id, total_jobs, assigned, skipped = parse_select(args.select)
+    source = replayed_results if args.replay else synthetic_results
+    started = time.monotonic()
+    out = sys.stdout
+    results = source(args, job_id, total_jobs, assigned, skipped)
+    for count, result in enumerate(results, 1):
+        if args.rate:
+            delay = started + count / args.rate - time.monotonic()
+            if delay > 0:
+                out.flush()
+                time.sleep(delay)
+        out.write(result if isinstance(result, str) else json.dumps(result))
+        out.write("\n")
+        if args.warn_every and count % args.warn_every == 0:
+            out.write(f"warning: result {count} is followed by a warning\n")
+    out.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""
+Benchmark FailureAnalyzer on a large synthetic pattern set.
+
+    python3 failure_analyzer_bench.py [--categories 120] [--messages 3000]
+
+Adds synthetic categories -- plain strings and regexes, five patterns each --
+to the failure_patterns of config.yaml, and classifies synthetic failure
+messages, some of which carry a pattern's text, two ways: the way
+FailureAnalyzer used to, re.search over every pattern with re.IGNORECASE,
+and with FailureAnalyzer. Reports the time each took and checks both
+matched the same patterns. An escapes category adds patterns whose
+escapes spell character codes and backreferences, and a third of the messages
+carry text one of them matches, so those are compared too.
+"""
+
+import argparse
+import random
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE))
+
+from result_parser import FailureAnalyzer, TestResult
+
+# One list of words, as prose; SIM905 wants it one per line.
+WORDS = (  # noqa: SIM905
+    "ssh vm netvm guivm appvm givc microvm systemd unit service failed error "
+    "timeout connection refused started stopped kernel panic boot greetd "
+    "login wayland weston display audio usb device network interface address "
+    "route dns firewall nftables storage mount disk partition encrypt tpm "
+    "secure keyword variable expected actual should be equal contain match"
+).split()
+# Patterns whose text is not what they match, and text each one matches
+ESCAPES = {
+    r"\x45rror code \d+": "Error code 7",
+    r"\u0045rror: disk full": "Error: disk full",
+    r"\U00000045xit status \d": "Exit status 2",
+    r"\N{LATIN CAPITAL LETTER E}rror in unit": "Error in unit",
+    r"\105rror in [\x61-z]+ module": "Error in audio module",
+    r"unit\0 stopped": "unit\0 stopped",
+    r"(\w+) failed, \1 restarted": "netvm failed, netvm restarted",
+    r"(?P<vm>\w+) lost (?P=vm) address": "guivm lost guivm address",
+}
+
+
+def make_config(base: Path, categories: int, rng: random.Random) -> dict:
+    """config.yaml's failure_patterns plus the synthetic categories."""
+    with open(base) as f:
+        config = yaml.safe_load(f) or {}
+    patterns = config.setdefault("failure_patterns", {})
+    for n in range(categories):
+        made = []
+        for p in range(5):
+            first, second = rng.sample(WORDS, 2)
+            token = f"e{n}x{p}"
+            if p % 2:
+                made.append(f"{first} {token}.*{second}")
+            else:
+                made.append(f"{token} {first} {second}")
+        patterns[f"synthetic_{n}"] = {
+            "patterns": made,
+            "likely_modules": [f"modules/synthetic/{n}/"],
+            "suggestion": f"Synthetic category {n}",
+        }
+    patterns["escapes"] = {
+        "patterns": list(ESCAPES),
+        "likely_modules": ["modules/synthetic/escapes/"],
+        "suggestion": "Patterns with escapes",
+    }
+    return config
+
+
+def make_messages(config: dict, count: int, rng: random.Random) -> list[str]:
+    """Robot-like failure messages, two thirds of them carrying a pattern."""
+    patterns = [p for c in config["failure_patterns"].values() for p in c["patterns"]]
+    messages = []
+    for n in range(count):
+        words = rng.choices(WORDS, k=rng.randint(10, 150))
+        if n % 3 == 0:
+            # A regex stands in for text it matches well enough here
+            text = re.sub(r"\.\*|\\", " ", rng.choice(patterns))
+            words.insert(rng.randrange(len(words) + 1), text.upper())
+        elif n % 3 == 1:
+            text = rng.choice(list(ESCAPES.values()))
+            words.insert(rng.randrange(len(words) + 1), text)
+        messages.append(" ".join(words))
+    return messages
+
+
+def old_match(failure_patterns: dict, message: str) -> list[str]:
+    """The patterns FailureAnalyzer used to find, one re.search at a time."""
+    return [
+        pattern
+        for pattern_config in failure_patterns.values()
+        for pattern in pattern_config.get("patterns", [])
+        if re.search(pattern, message, re.IGNORECASE)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--categories",
+        type=int,
+        default=120,
+        help="synthetic categories to add (default: 120)",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=3000,
+        help="failure messages to classify (default: 3000)",
+    )
+    parser.add_argument("--seed", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    config = make_config(HERE.parent / "config.yaml", args.categories, rng)
+    messages = make_messages(config, args.messages, rng)
+    pattern_count = sum(len(c["patterns"]) for c in config["failure_patterns"].values())
+    print(
+        f"{len(config['failure_patterns'])} categories, {pattern_count} patterns, "
+        f"{len(messages)} messages"
+    )
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+        yaml.safe_dump(config, f)
+        f.flush()
+        started = time.perf_counter()
+        analyzer = FailureAnalyzer(f.name)
+        loaded = time.perf_counter() - started
+
+    started = time.perf_counter()
+    old = [old_match(config["failure_patterns"], m) for m in messages]
+    old_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    new = [
+        analyzer.analyze(TestResult("bench", "FAIL", m))["patterns_matched"]
+        for m in messages
+    ]
+    new_seconds = time.perf_counter() - started
+
+    matched = sum(1 for patterns in new if patterns)
+    print(f"  re.search loop   {old_seconds:7.2f}s")
+    print(f"  FailureAnalyzer  {new_seconds:7.2f}s  (+{loaded:.2f}s to compile)")
+    print(f"  {matched} messages matched, {old_seconds / new_seconds:.1f}x faster")
+    if [set(p) for p in old] != [set(p) for p in new]:
+        print("Matched patterns differ", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
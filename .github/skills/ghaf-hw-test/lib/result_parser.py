@@ -25,8 +25,14 @@ except ImportError as e:
 class TestResult:
     """Represents a single test result."""
 
-    def __init__(self, name: str, status: str, message: str = "",
-                 suite: str = "", tags: list | None = None):
+    def __init__(
+        self,
+        name: str,
+        status: str,
+        message: str = "",
+        suite: str = "",
+        tags: list | None = None,
+    ):
         self.name = name
         self.status = status  # PASS, FAIL, SKIP
         self.message = message
@@ -38,12 +44,16 @@ class TestResult:
 
 
 class ResultParser:
-    """Parses Robot Framework output.xml files."""
+    """Parses Robot Framework output.xml files.
+
+    The file is streamed with iterparse and every element is dropped as soon
+    as it ends, so memory does not grow with the keywords and log messages
+    in it, only with the number of tests.
+    """
 
     def __init__(self, output_xml: str):
         self.output_xml = Path(output_xml)
         self.results: list[TestResult] = []
-        self._parent_map: dict[ET.Element, ET.Element] = {}
         self.total = 0
         self.passed = 0
         self.failed = 0
@@ -54,63 +64,62 @@ class ResultParser:
         if not self.output_xml.exists():
             raise FileNotFoundError(f"Output file not found: {self.output_xml}")
 
-        tree = ET.parse(self.output_xml)
-        root = tree.getroot()
-
-        # Build parent map once for efficient lookups
-        self._parent_map = {c: p for p in root.iter() for c in p}
-
-        # Find all test elements
-        for test in root.iter("test"):
-            name = test.get("name", "Unknown")
-
-            # Get status
-            status_elem = test.find("status")
-            if status_elem is not None:
-                status = status_elem.get("status", "UNKNOWN")
-                message = status_elem.text or ""
-            else:
-                status = "UNKNOWN"
-                message = ""
-
-            # Get tags
-            tags = []
-            for tag in test.findall(".//tag"):
-                if tag.text:
-                    tags.append(tag.text)
-
-            # Get suite name from parent
-            parent = test
-            suite = ""
-            while parent is not None:
-                parent = self._get_parent(root, parent)
-                if parent is not None and parent.tag == "suite":
-                    suite = parent.get("name", "")
-                    break
-
-            result = TestResult(
-                name=name,
-                status=status,
-                message=message,
-                suite=suite,
-                tags=tags
-            )
-            self.results.append(result)
-
-            # Update counts
-            self.total += 1
-            if status == "PASS":
-                self.passed += 1
-            elif status == "FAIL":
-                self.failed += 1
-            else:
-                self.skipped += 1
+        # Open elements from the root down, and the names of the open suites
+        stack: list[ET.Element] = []
+        suites: list[str] = []
+        test: dict | None = None
+
+        for event, elem in ET.iterparse(self.output_xml, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                if elem.tag == "suite":
+                    suites.append(elem.get("name", ""))
+                elif elem.tag == "test":
+                    test = {
+                        "name": elem.get("name", "Unknown"),
+                        "status": "UNKNOWN",
+                        "message": "",
+                        "tags": [],
+                    }
+                continue
+
+            stack.pop()
+            parent = stack[-1].tag if stack else None
+            if test is not None:
+                if elem.tag == "status" and parent == "test":
+                    test["status"] = elem.get("status", "UNKNOWN")
+                    test["message"] = elem.text or ""
+                elif elem.tag == "tag" and elem.text:
+                    # <tag> under <test> since RF 4, under <tags> before it;
+                    # keyword tags lie deeper and are not the test's own.
+                    if parent == "test" or (
+                        parent == "tags" and len(stack) > 1 and stack[-2].tag == "test"
+                    ):
+                        test["tags"].append(elem.text)
+                elif elem.tag == "test":
+                    self._add(TestResult(suite=suites[-1] if suites else "", **test))
+                    test = None
+            if elem.tag == "suite":
+                suites.pop()
+
+            # A finished element is its parent's last child: drop it there too,
+            # or the emptied husks of every keyword would pile up under it.
+            elem.clear()
+            if stack and len(stack[-1]) and stack[-1][-1] is elem:
+                del stack[-1][-1]
 
         return self.results
 
-    def _get_parent(self, root: ET.Element, child: ET.Element) -> ET.Element | None:
-        """Find parent element using the cached parent map."""
-        return self._parent_map.get(child)
+    def _add(self, result: TestResult) -> None:
+        """Record a result and update the counts."""
+        self.results.append(result)
+        self.total += 1
+        if result.status == "PASS":
+            self.passed += 1
+        elif result.status == "FAIL":
+            self.failed += 1
+        else:
+            self.skipped += 1
 
     def get_failures(self) -> list[TestResult]:
         """Return only failing tests."""
@@ -126,13 +135,89 @@ class ResultParser:
         )
 
 
+# A {m,n} quantifier; any other brace is a literal one
+COUNTED = re.compile(r"\{(?:\d+,?\d*|,\d+)\}")
+# Escapes after which the next characters spell a character code or a group
+# number, not text: \x41, \u0041, \U00000041, \N{...}, \0, \101 and \1
+CODED_ESCAPES = "xuUN0123456789"
+
+
+def required_literal(pattern: str) -> str | None:
+    """A lowercase string every match of pattern contains, or None.
+
+    Only plain characters outside groups and classes count, and not one a
+    quantifier makes optional; any alternation, and any character code or
+    backreference escape, gives up. The longest such run is kept, if it is
+    long enough to rule much out.
+    """
+    if "|" in pattern:
+        return None
+    runs = [""]
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            i += 1
+            if pattern[i] in CODED_ESCAPES:
+                return None
+            if depth == 0 and not pattern[i].isalnum():
+                runs[-1] += pattern[i]
+            elif depth == 0:
+                runs.append("")
+        elif char == "[":
+            # Skip the class, minding a leading ] or ^] and escapes in it
+            i += 1
+            if i < len(pattern) and pattern[i] == "^":
+                i += 1
+            if i < len(pattern) and pattern[i] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                if pattern[i] == "\\":
+                    if pattern[i + 1 : i + 2] in tuple(CODED_ESCAPES):
+                        return None
+                    i += 1
+                i += 1
+            runs.append("")
+        elif char == "(":
+            depth += 1
+            runs.append("")
+        elif char == ")":
+            depth -= 1
+            runs.append("")
+        elif char in "?*+" or (char == "{" and COUNTED.match(pattern, i)):
+            # The atom before a quantifier may match nothing
+            runs[-1] = runs[-1][:-1]
+            runs.append("")
+            if char == "{":
+                i = pattern.index("}", i)
+        elif char in ".^$":
+            runs.append("")
+        elif depth == 0:
+            runs[-1] += char
+        i += 1
+    literal = max(runs, key=len)
+    if len(literal) < 3 or not literal.isascii():
+        return None
+    return literal.lower()
+
+
 class FailureAnalyzer:
-    """Analyzes test failures and maps them to Ghaf modules."""
+    """Analyzes test failures and maps them to Ghaf modules.
+
+    Patterns are compiled once, at load. A message is first lowercased and
+    checked for each pattern's required literal, a plain substring search,
+    and only patterns whose literal is there are run as regexes. Every
+    matching category is reported, highest priority first: a category's
+    optional `priority` (default 0, higher wins), then its place in the file.
+    """
 
     def __init__(self, config_path: str):
         self.config_path = Path(config_path)
         self.config = self._load_config()
         self.failure_patterns = self.config.get("failure_patterns", {})
+        # (category, config, [(pattern, literal, compiled)]) by priority
+        self.categories = self._compile(self.failure_patterns)
 
     def _load_config(self) -> dict:
         """Load configuration from YAML file."""
@@ -141,6 +226,47 @@ class FailureAnalyzer:
         with open(self.config_path) as f:
             return yaml.safe_load(f) or {}
 
+    @staticmethod
+    def _compile(failure_patterns: dict) -> list[tuple[str, dict, list]]:
+        """Compile every category's patterns, ordered by priority."""
+        categories = []
+        for category, pattern_config in failure_patterns.items():
+            compiled = []
+            for pattern in pattern_config.get("patterns", []):
+                try:
+                    regex = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    print(
+                        f"Ignoring failure pattern {pattern!r} of {category}: {e}",
+                        file=sys.stderr,
+                    )
+                    continue
+                # Verbose patterns ignore their own whitespace: no literal
+                literal = (
+                    None if regex.flags & re.VERBOSE else required_literal(pattern)
+                )
+                compiled.append((pattern, literal, regex))
+            categories.append((category, pattern_config, compiled))
+        # sorted() is stable, so equal priorities keep the file's order
+        return sorted(categories, key=lambda c: -int(c[1].get("priority", 0)))
+
+    def match(self, message: str) -> list[tuple[str, list[str]]]:
+        """Every matching category and its matched patterns, by priority."""
+        # Case folding outside ASCII can change lengths and so break a
+        # substring check that re.IGNORECASE would pass; those skip the filter
+        lowered = message.lower() if message.isascii() else None
+        matches = []
+        for category, _, compiled in self.categories:
+            matched = [
+                pattern
+                for pattern, literal, regex in compiled
+                if (lowered is None or literal is None or literal in lowered)
+                and regex.search(message)
+            ]
+            if matched:
+                matches.append((category, matched))
+        return matches
+
     def analyze(self, result: TestResult) -> dict:
         """Analyze a single test failure and return analysis."""
         analysis = {
@@ -148,20 +274,22 @@ class FailureAnalyzer:
             "suite": result.suite,
             "message": result.message,
             "category": "unknown",
+            "categories": [],
             "likely_modules": [],
             "suggestion": "",
-            "patterns_matched": []
+            "patterns_matched": [],
         }
 
-        # Match against known failure patterns
-        for category, pattern_config in self.failure_patterns.items():
-            patterns = pattern_config.get("patterns", [])
-            for pattern in patterns:
-                if re.search(pattern, result.message, re.IGNORECASE):
-                    analysis["category"] = category
-                    analysis["likely_modules"] = pattern_config.get("likely_modules", [])
-                    analysis["suggestion"] = pattern_config.get("suggestion", "")
-                    analysis["patterns_matched"].append(pattern)
+        matches = self.match(result.message)
+        if matches:
+            # The highest-priority category speaks for the failure
+            primary = self.failure_patterns[matches[0][0]]
+            analysis["category"] = matches[0][0]
+            analysis["likely_modules"] = primary.get("likely_modules", [])
+            analysis["suggestion"] = primary.get("suggestion", "")
+        for category, patterns in matches:
+            analysis["categories"].append(category)
+            analysis["patterns_matched"].extend(patterns)
 
         return analysis
 
@@ -181,6 +309,8 @@ class FixProposer:
         if analysis["suite"]:
             lines.append(f"**Test Suite:** {analysis['suite']}")
         lines.append(f"**Category:** {analysis['category']}")
+        if len(analysis.get("categories", [])) > 1:
+            lines.append(f"**Also matches:** {', '.join(analysis['categories'][1:])}")
         lines.append("")
 
         if analysis["message"]:
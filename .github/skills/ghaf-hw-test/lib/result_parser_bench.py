@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""
+Benchmark ResultParser on a synthetic Robot Framework output.xml.
+
+    python3 result_parser_bench.py [--size-mb 300] [--keep FILE]
+
+Writes an output.xml shaped like a trace-level pre-merge run -- nested
+suites, tests with hundreds of keywords, each logging a few lines -- then
+parses it in a fresh process twice: once the way ResultParser used to, with
+ET.parse and a parent map over every element, and once with ResultParser.
+Reports wall time and peak RSS of each, and checks both found the same tests.
+"""
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+HERE = Path(__file__).resolve().parent
+KEYWORDS_PER_TEST = 200
+MESSAGES_PER_KEYWORD = 4
+
+
+def write_output(path: Path, size_mb: int) -> int:
+    """Write an output.xml of about size_mb megabytes; the number of tests."""
+    target = size_mb * 1024 * 1024
+    tests = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<robot generator="Robot 7.0" generated="2026-01-01T00:00:00">\n')
+        f.write('<suite id="s1" name="Ghaf">\n')
+        suite = 0
+        while f.tell() < target:
+            suite += 1
+            f.write(f'<suite id="s1-s{suite}" name="Suite {suite}">\n')
+            for _ in range(10):
+                tests += 1
+                status = "FAIL" if tests % 7 == 0 else "PASS"
+                f.write(f'<test id="t{tests}" name="Test {tests}">\n')
+                for kw in range(KEYWORDS_PER_TEST):
+                    f.write(f'<kw name="Step {kw}" library="BuiltIn">\n')
+                    for m in range(MESSAGES_PER_KEYWORD):
+                        text = escape(
+                            f"step {kw} trace {m}: ${{vm}} = <ghaf-host> " * 3
+                        )
+                        f.write(
+                            '<msg time="2026-01-01T00:00:00.000000" '
+                            f'level="TRACE">{text}</msg>\n'
+                        )
+                    f.write(
+                        '<status status="PASS" start="2026-01-01T00:00:00" '
+                        'elapsed="0.001"/>\n</kw>\n'
+                    )
+                f.write(f"<tag>suite{suite}</tag>\n<tag>pre-merge</tag>\n")
+                message = (
+                    "Connection to ghaf-host timed out" if status == "FAIL" else ""
+                )
+                f.write(
+                    f'<status status="{status}" start="2026-01-01T00:00:00" '
+                    f'elapsed="1.0">{message}</status>\n</test>\n'
+                )
+            f.write(
+                '<status status="PASS" start="2026-01-01T00:00:00" '
+                'elapsed="10.0"/>\n</suite>\n'
+            )
+        f.write(
+            '<status status="FAIL" start="2026-01-01T00:00:00" '
+            'elapsed="100.0"/>\n</suite>\n</robot>\n'
+        )
+    return tests
+
+
+def parse_tree(path: str) -> list[tuple]:
+    """The parse ResultParser used to do: whole tree plus a parent map."""
+    root = ET.parse(path).getroot()
+    parent_map = {c: p for p in root.iter() for c in p}
+    results = []
+    for test in root.iter("test"):
+        status = test.find("status")
+        tags = [tag.text for tag in test.findall(".//tag") if tag.text]
+        parent = parent_map.get(test)
+        while parent is not None and parent.tag != "suite":
+            parent = parent_map.get(parent)
+        results.append(
+            (
+                test.get("name", "Unknown"),
+                status.get("status", "UNKNOWN") if status is not None else "UNKNOWN",
+                (status.text or "") if status is not None else "",
+                parent.get("name", "") if parent is not None else "",
+                tags,
+            )
+        )
+    return results
+
+
+def parse_stream(path: str) -> list[tuple]:
+    sys.path.insert(0, str(HERE))
+    from result_parser import ResultParser
+
+    return [
+        (r.name, r.status, r.message, r.suite, r.tags)
+        for r in ResultParser(path).parse()
+    ]
+
+
+def measure(how: str, path: Path) -> tuple[float, float, str]:
+    """Wall seconds, peak RSS in MB and a digest of the results of one parse."""
+    started = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, __file__, "--run", how, str(path)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        sys.exit(f"{how} parse failed")
+    return time.monotonic() - started, usage.ru_maxrss / 1024, output.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--size-mb",
+        type=int,
+        default=300,
+        help="size of the synthetic output.xml (default: 300)",
+    )
+    parser.add_argument(
+        "--keep", metavar="FILE", help="write the output.xml here and leave it"
+    )
+    parser.add_argument(
+        "--run", nargs=2, metavar=("HOW", "FILE"), help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.run:
+        how, path = args.run
+        results = parse_tree(path) if how == "tree" else parse_stream(path)
+        failed = sum(1 for result in results if result[1] == "FAIL")
+        digest = hashlib.sha256(repr(results).encode()).hexdigest()[:12]
+        print(f"{len(results)} tests, {failed} failed, results {digest}")
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="result-parser-bench-") as tmp:
+        path = Path(args.keep or os.path.join(tmp, "output.xml"))
+        started = time.monotonic()
+        tests = write_output(path, args.size_mb)
+        print(
+            f"Wrote {path.stat().st_size / 1e6:.0f} MB, {tests} tests, "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+
+        digests = {}
+        for how in ("tree", "stream"):
+            seconds, peak, digests[how] = measure(how, path)
+            print(f"  {how:<6} {seconds:7.1f}s {peak:9.0f} MB peak  {digests[how]}")
+        if digests["tree"] != digests["stream"]:
+            print("Results differ", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -79,6 +79,21 @@ let
             wants = [ "network-online.target" ];
             after = [ "network-online.target" ];
           };
+
+          # ghaf-netboot --multicast sends the image to this port, and adds
+          # ghaf.image_multicast to the kernel command line, which is what
+          # starts the receiver; only then is the port opened. The default
+          # firewall would drop every datagram and leave ghaf-image-fetch to
+          # fall back to HTTP after its start grace. Same idiom as the
+          # installer's own cmdline parsing: the firewall's PATH has no grep.
+          networking.firewall.extraCommands = ''
+            read -r cmdline < /proc/cmdline
+            case " $cmdline " in
+            *" ghaf.image_multicast "*)
+              ip46tables -A nixos-fw -p udp --dport 48080 -j nixos-fw-accept
+              ;;
+            esac
+          '';
         }
         // lib.optionalAttrs (imageBaseUrl != null) {
           ghaf.installer.imageSource = imageBaseUrl;
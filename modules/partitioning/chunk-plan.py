@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Work out which root image chunks a device already has.
+
+Reads a version 1 manifest written by mk-manifest.py --chunk-index, chunks the
+currently active root volume (or any file standing in for it) with the
+parameters recorded in that manifest, and prints a JSON plan: the chunks of the
+new image that can be copied locally from the current slot, and the ones that
+have to be downloaded.
+
+The chunking rule must match ChunkIndex in mk-manifest.py exactly; the manifest
+records its parameters so the two can only disagree on the rule itself.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+parser = argparse.ArgumentParser(
+    description="Plan a delta update from the chunk index in a verity manifest."
+)
+parser.add_argument("--manifest", required=True, help="Path to the new manifest.")
+parser.add_argument(
+    "--current",
+    required=True,
+    help="Current root volume, e.g. /dev/pool/root_<version>_<hash>.",
+)
+parser.add_argument(
+    "--current-size",
+    type=int,
+    help="Bytes of --current to scan (default: all). A logical volume is "
+    "usually larger than the image it holds.",
+)
+parser.add_argument("--output", help="Write the plan here instead of stdout.")
+
+
+def scan(path: str, index: dict, limit: int | None) -> dict[str, int]:
+    """Chunk `path` like mk-manifest.py does and map each digest to its offset."""
+    block_size = index["block_size"]
+    min_size = index["min_size"]
+    max_size = index["max_size"]
+    mask = (1 << index["mask_bits"]) - 1
+
+    found: dict[str, int] = {}
+    offset = 0
+    length = 0
+    digest = hashlib.sha256()
+    remaining = limit
+
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while remaining is None or remaining > 0:
+            want = block_size if remaining is None else min(block_size, remaining)
+            block = f.read(want)
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            digest.update(block)
+            length += len(block)
+            if length >= max_size or (
+                length >= min_size and zlib.crc32(block) & mask == 0
+            ):
+                found.setdefault(digest.hexdigest(), offset)
+                offset += length
+                length = 0
+                digest = hashlib.sha256()
+    if length:
+        found.setdefault(digest.hexdigest(), offset)
+    return found
+
+
+def main() -> int:
+    args = parser.parse_args()
+
+    with open(args.manifest, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    index = manifest.get("root", {}).get("chunk_index")
+    if manifest.get("manifest_version", 0) < 1 or index is None:
+        print(
+            f"Error: {args.manifest} has no root chunk index "
+            "(build it with mk-manifest.py --chunk-index)",
+            file=sys.stderr,
+        )
+        return 1
+
+    have = scan(args.current, index, args.current_size)
+
+    copy = []
+    fetch = []
+    for chunk in index["chunks"]:
+        source = have.get(chunk["sha256"])
+        if source is None:
+            fetch.append(chunk)
+        else:
+            copy.append(dict(chunk, source_offset=source))
+
+    copy_bytes = sum(c["length"] for c in copy)
+    fetch_bytes = sum(c["length"] for c in fetch)
+    plan = {
+        "version": manifest["version"],
+        "root_verity_hash": manifest["root_verity_hash"],
+        "copy": copy,
+        "fetch": fetch,
+        "copy_bytes": copy_bytes,
+        "fetch_bytes": fetch_bytes,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        json.dump(plan, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    total = copy_bytes + fetch_bytes
+    print(
+        f"{len(copy)} chunks ({copy_bytes} B) present locally, "
+        f"{len(fetch)} chunks ({fetch_bytes} B) to fetch, "
+        f"{100 * copy_bytes / total if total else 100:.1f}% reused",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Benchmark mk-manifest.py's concurrent artifact stage against a sequential one.
+
+  python3 modules/partitioning/mk-manifest-bench.py [--root-mb 4096]
+
+Builds sparse root, verity and kernel files -- mostly holes, with a seeded
+random megabyte every --stride megabytes so zstd has real data to chew on --
+and turns them into a manifest twice, each time from a fresh copy and in a
+fresh process: once the way mk-manifest.py used to, compressing root, then
+verity, then hashing the kernel, and once with mk-manifest.py itself, which
+runs the three side by side. Reports wall time and peak RSS of each and checks
+that both wrote the same manifest, which carries the sha256 of every output.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MK_MANIFEST = os.path.join(HERE, "mk-manifest.py")
+MB = 1024 * 1024
+VERSION = "1.0"
+ROOT_VERITY_HASH = hashlib.sha256(b"mk-manifest-bench").hexdigest()
+
+
+def write_sparse(path: str, size_mb: int, stride: int, seed: int) -> None:
+    """A size_mb file of holes with one random megabyte every stride."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f:
+        f.truncate(size_mb * MB)
+        for offset in range(0, size_mb, stride):
+            f.seek(offset * MB)
+            f.write(rng.randbytes(MB))
+
+
+def build(workdir: str, args: argparse.Namespace) -> list[str]:
+    """Write the inputs into workdir; mk-manifest.py's arguments for them."""
+    os.mkdir(workdir)
+    inputs = {
+        "root": (f"{workdir}/root_@v_@u.raw", args.root_mb),
+        "verity": (f"{workdir}/verity_@v_@u.raw", args.verity_mb),
+        "kernel": (f"{workdir}/kernel_@v_@u.efi", args.kernel_mb),
+    }
+    for seed, (path, size_mb) in enumerate(inputs.values()):
+        write_sparse(path, size_mb, args.stride, seed)
+    hash_file = os.path.join(workdir, "root.hash")
+    with open(hash_file, "w", encoding="utf-8") as f:
+        f.write(ROOT_VERITY_HASH + "\n")
+    return [
+        f"--version={VERSION}",
+        "--system=x86_64-linux",
+        f"--hash-file={hash_file}",
+        f"--root-image={inputs['root'][0]}",
+        f"--verity-image={inputs['verity'][0]}",
+        f"--kernel-image={inputs['kernel'][0]}",
+        f"--manifest={workdir}/manifest_@v_@u.json",
+        f"--zstd={args.zstd}",
+        f"--threads={args.threads}",
+    ]
+
+
+def run_sequential(argv: list[str]) -> None:
+    """mk-manifest.py's main() as it was before its stages ran concurrently."""
+    spec = importlib.util.spec_from_file_location("mk_manifest", MK_MANIFEST)
+    mk = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mk)
+    args = mk.parser.parse_args(argv)
+    storehash = ROOT_VERITY_HASH[:16]
+
+    kernel = mk.rename(args.kernel_image, args.version, storehash)
+    stages = (args.zstd, args.threads, args.block_size, args.fadvise)
+    manifest = {
+        "manifest_version": 0,
+        "system": args.system,
+        "meta": {},
+        "version": args.version,
+        "root_verity_hash": ROOT_VERITY_HASH,
+        "root": mk.compress(args.root_image, args.version, storehash, *stages),
+        "verity": mk.compress(args.verity_image, args.version, storehash, *stages),
+        "kernel": {
+            "file": os.path.basename(kernel),
+            "sha256": mk.sha256_file(kernel, args.block_size, args.fadvise),
+            "unpacked_size": mk.file_size(kernel),
+        },
+    }
+    with open(
+        mk.fixname(args.manifest, args.version, storehash), "w", encoding="utf-8"
+    ) as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def measure(how: str, argv: list[str]) -> tuple[float, float]:
+    """Wall seconds and peak RSS in MB, zstd included, of one manifest step."""
+    if how == "sequential":
+        cmd = [sys.executable, __file__, "--run-sequential", *argv]
+    else:
+        cmd = [sys.executable, MK_MANIFEST, *argv]
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        sys.exit(f"{how} manifest step failed")
+    return time.monotonic() - started, usage.ru_maxrss / 1024
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--root-mb",
+        type=int,
+        default=4096,
+        help="size of the sparse root image (default: 4096)",
+    )
+    parser.add_argument(
+        "--verity-mb",
+        type=int,
+        default=64,
+        help="size of the sparse verity image (default: 64)",
+    )
+    parser.add_argument(
+        "--kernel-mb",
+        type=int,
+        default=64,
+        help="size of the sparse kernel image (default: 64)",
+    )
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=16,
+        metavar="MB",
+        help="one random megabyte every this many (default: 16)",
+    )
+    parser.add_argument("--zstd", default="zstd", help="path to the zstd binary")
+    parser.add_argument(
+        "--threads", type=int, default=0, help="zstd worker threads (default: 0)"
+    )
+    # The sequential run takes mk-manifest.py's arguments, not these.
+    if sys.argv[1:2] == ["--run-sequential"]:
+        run_sequential(sys.argv[2:])
+        return 0
+    args = parser.parse_args()
+
+    manifests = {}
+    with tempfile.TemporaryDirectory(prefix="mk-manifest-bench-") as tmp:
+        for how in ("sequential", "concurrent"):
+            workdir = os.path.join(tmp, how)
+            started = time.monotonic()
+            argv = build(workdir, args)
+            built = time.monotonic() - started
+            seconds, peak = measure(how, argv)
+            path = os.path.join(
+                workdir, f"manifest_{VERSION}_{ROOT_VERITY_HASH[:16]}.json"
+            )
+            with open(path, "rb") as f:
+                manifests[how] = f.read()
+            digest = hashlib.sha256(manifests[how]).hexdigest()[:12]
+            print(
+                f"  {how:<10} {seconds:7.1f}s {peak:7.0f} MB peak  "
+                f"manifest {digest}  (inputs built in {built:.1f}s)",
+                flush=True,
+            )
+    if manifests["sequential"] != manifests["concurrent"]:
+        print("Manifests differ", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,12 +2,20 @@
 # SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 import argparse
+import contextlib
 import hashlib
 import json
 import os
+import subprocess
+import threading
+import zlib
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Self
 
 parser = argparse.ArgumentParser(
-    description="Rename verity artifacts and generate manifest."
+    description="Compress and rename verity artifacts and generate manifest."
 )
 parser.add_argument(
     "--version", required=True, help="Version string for @v placeholder."
@@ -19,24 +27,57 @@ parser.add_argument(
     "--hash-file", required=True, help="Path to dm-verity root hash file."
 )
 parser.add_argument(
-    "--root-image", required=True, help="Path to compressed root image."
+    "--root-image", required=True, help="Path to uncompressed root image."
 )
 parser.add_argument(
-    "--verity-image", required=True, help="Path to compressed verity image."
+    "--verity-image", required=True, help="Path to uncompressed verity image."
 )
 parser.add_argument("--kernel-image", required=True, help="Path to kernel/UKI image.")
 parser.add_argument("--manifest", required=True, help="Output manifest path template.")
+parser.add_argument("--zstd", default="zstd", help="Path to the zstd binary.")
 parser.add_argument(
-    "--root-unpacked-size",
+    "--threads", type=int, default=0, help="zstd worker threads (0: one per core)."
+)
+parser.add_argument(
+    "--block-size",
+    type=int,
+    default=1024 * 1024,
+    help="Read block size in bytes for compressing and hashing.",
+)
+parser.add_argument(
+    "--no-fadvise",
+    dest="fadvise",
+    action="store_false",
+    help="Do not hint sequential access to the kernel when reading artifacts.",
+)
+parser.add_argument(
+    "--tree-hash",
+    action="store_true",
+    help="Also record a chunked sha256 tree hash of the compressed images.",
+)
+parser.add_argument(
+    "--tree-leaf-size",
     type=int,
-    required=True,
-    help="Uncompressed root image size in bytes.",
+    default=4 * 1024 * 1024,
+    help="Leaf size in bytes for --tree-hash.",
+)
+parser.add_argument(
+    "--chunk-index",
+    action="store_true",
+    help="Record a content-defined chunk index of the unpacked root and verity "
+    "images (manifest version 1).",
+)
+parser.add_argument(
+    "--base-manifest",
+    help="Manifest of the previous release, built with --chunk-index. Also "
+    "write root and verity deltas against it. Requires --chunk-index.",
 )
 parser.add_argument(
-    "--verity-unpacked-size",
+    "--frame-size",
     type=int,
-    required=True,
-    help="Uncompressed verity image size in bytes.",
+    default=0,
+    help="Compress root and verity as independent zstd frames of this many "
+    "unpacked bytes and record the frame table (0: one opaque stream).",
 )
 
 
@@ -53,14 +94,432 @@ def rename(filename: str, version: str, fragment: str) -> str:
     return new
 
 
-def sha256_file(path: str) -> str:
-    h = hashlib.sha256()
+@contextlib.contextmanager
+def open_sequential(path: str, fadvise: bool = True):
+    """Open a file for a single front-to-back read.
+
+    POSIX_FADV_SEQUENTIAL doubles the kernel's readahead window, which is what
+    keeps several concurrent multi-GB reads from degrading into seeks.
+    """
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        if fadvise and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        yield f
+
+
+def sha256_file(path: str, block_size: int, fadvise: bool = True) -> str:
+    h = hashlib.sha256()
+    with open_sequential(path, fadvise) as f:
+        for chunk in iter(lambda: f.read(block_size), b""):
             h.update(chunk)
     return h.hexdigest()
 
 
+class TreeHash:
+    """sha256 over fixed-size leaves, combined into one top hash.
+
+    The top hash is the sha256 of the concatenated binary leaf digests. Leaves
+    are hashed on a thread pool while the data is still streaming in, and a
+    verifier can likewise check them on every core and name the corrupt one.
+    """
+
+    def __init__(self, leaf_size: int, pool: ThreadPoolExecutor):
+        if leaf_size <= 0:
+            raise ValueError("tree hash leaf size must be positive")
+        self.leaf_size = leaf_size
+        self.pool = pool
+        self.pending = bytearray()
+        self.leaves = []
+
+    def _submit(self, leaf: bytes) -> None:
+        self.leaves.append(self.pool.submit(hashlib.sha256, leaf))
+
+    def update(self, data: bytes) -> None:
+        self.pending += data
+        while len(self.pending) >= self.leaf_size:
+            self._submit(bytes(self.pending[: self.leaf_size]))
+            del self.pending[: self.leaf_size]
+
+    def result(self) -> dict:
+        if self.pending:
+            self._submit(bytes(self.pending))
+            self.pending.clear()
+        digests = [leaf.result().digest() for leaf in self.leaves]
+        return {
+            "leaf_size": self.leaf_size,
+            "root": hashlib.sha256(b"".join(digests)).hexdigest(),
+            "leaves": [digest.hex() for digest in digests],
+        }
+
+
+class Delta:
+    """Chunk-level delta of an image against the same image in a base release.
+
+    Chunks whose digest also appears in the base release's chunk index are
+    already on a device running that release, so the delta file carries only
+    the others, concatenated in order and zstd-compressed. `base_offsets`
+    tells the writer, per chunk, where to copy it from in the base image, or
+    null when it is the next piece of the delta file.
+    """
+
+    def __init__(
+        self, path: str, base: dict, name: str, zstd: str, threads: int
+    ) -> None:
+        index = (base.get(name) or {}).get("chunk_index")
+        if index is None:
+            raise ValueError(f"base manifest has no {name} chunk index")
+        if any(
+            index[key] != getattr(ChunkIndex, key)
+            for key in ("block_size", "min_size", "max_size", "mask_bits")
+        ):
+            raise ValueError(f"base manifest {name} chunk index parameters differ")
+
+        self.path = path
+        self.base_version = base["version"]
+        self.base_root_verity_hash = base["root_verity_hash"]
+        self.base = {}
+        for chunk in index["chunks"]:
+            self.base.setdefault(chunk["sha256"], chunk["offset"])
+        self.base_offsets = []
+        self.unpacked_size = 0
+        self.packed_size = 0
+        self.digest = hashlib.sha256()
+
+        self.dst = open(path, "wb")  # noqa: SIM115 -- closed in result() or abort()
+        try:
+            self.proc = subprocess.Popen(
+                [zstd, f"-T{threads}", "--compress", "--stdout", "--quiet"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        except BaseException:
+            self.dst.close()
+            os.unlink(path)
+            raise
+        self.drainer = threading.Thread(target=self._drain, daemon=True)
+        self.drainer.start()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.abort()
+
+    def abort(self) -> None:
+        """Kill zstd and remove the partial delta file."""
+        self.proc.kill()
+        self.proc.wait()
+        self.drainer.join()
+        assert self.proc.stdin is not None
+        with contextlib.suppress(BrokenPipeError):
+            self.proc.stdin.close()
+        self.dst.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    def _drain(self) -> None:
+        assert self.proc.stdout is not None
+        for chunk in iter(lambda: self.proc.stdout.read(1024 * 1024), b""):
+            self.digest.update(chunk)
+            self.dst.write(chunk)
+            self.packed_size += len(chunk)
+
+    def add(self, chunk: dict, data: bytes) -> None:
+        offset = self.base.get(chunk["sha256"])
+        self.base_offsets.append(offset)
+        if offset is None:
+            assert self.proc.stdin is not None
+            self.proc.stdin.write(data)
+            self.unpacked_size += len(data)
+
+    def result(self) -> dict:
+        assert self.proc.stdin is not None
+        self.proc.stdin.close()
+        self.drainer.join()
+        self.dst.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(
+                f"zstd failed on {self.path} (exit {self.proc.returncode})"
+            )
+        print(f"delta -> {self.path}")
+        return {
+            "file": os.path.basename(self.path),
+            "sha256": self.digest.hexdigest(),
+            "packed_size": self.packed_size,
+            "unpacked_size": self.unpacked_size,
+            "base_version": self.base_version,
+            "base_root_verity_hash": self.base_root_verity_hash,
+            "base_offsets": self.base_offsets,
+        }
+
+
+class ChunkIndex:
+    """Content-defined chunk index over an unpacked image.
+
+    Cut points fall on block boundaries: a chunk ends after a block whose
+    crc32 has its low `mask_bits` clear once the chunk is at least `min_size`
+    long, or unconditionally at `max_size`. erofs allocates whole blocks, so an
+    insertion in the store shifts everything after it by whole blocks, and
+    block-granular cut points resynchronise just as a byte-wise rolling hash
+    would, at a cost Python can afford on a multi-GB image.
+    """
+
+    block_size = 4096
+    min_size = 256 * 1024
+    max_size = 4 * 1024 * 1024
+    mask_bits = 8  # one cut per 256 blocks on average, i.e. ~1 MiB chunks
+
+    def __init__(self, delta: Delta | None = None):
+        self.mask = (1 << self.mask_bits) - 1
+        self.delta = delta
+        self.data = bytearray()
+        self.pending = bytearray()
+        self.chunks = []
+        self.offset = 0
+        self.length = 0
+        self.digest = hashlib.sha256()
+
+    def _cut(self) -> None:
+        chunk = {
+            "offset": self.offset,
+            "length": self.length,
+            "sha256": self.digest.hexdigest(),
+        }
+        self.chunks.append(chunk)
+        if self.delta is not None:
+            self.delta.add(chunk, bytes(self.data))
+            self.data.clear()
+        self.offset += self.length
+        self.length = 0
+        self.digest = hashlib.sha256()
+
+    def _block(self, block) -> None:
+        self.digest.update(block)
+        if self.delta is not None:
+            self.data += block
+        self.length += len(block)
+        if self.length >= self.max_size or (
+            self.length >= self.min_size and zlib.crc32(block) & self.mask == 0
+        ):
+            self._cut()
+
+    def update(self, data: bytes) -> None:
+        self.pending += data
+        end = len(self.pending) - len(self.pending) % self.block_size
+        with memoryview(self.pending) as view:
+            for off in range(0, end, self.block_size):
+                self._block(view[off : off + self.block_size])
+        del self.pending[:end]
+
+    def result(self) -> dict:
+        if self.pending:
+            self._block(bytes(self.pending))
+            self.pending.clear()
+        if self.length:
+            self._cut()
+        return {
+            "block_size": self.block_size,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "mask_bits": self.mask_bits,
+            "chunks": self.chunks,
+        }
+
+
+def zstd_stream(
+    src,
+    zstd: str,
+    threads: int,
+    block_size: int,
+    consume: Callable[[bytes], None],
+    emit: Callable[[bytes], None],
+) -> None:
+    """Compress `src` as a single zstd stream."""
+    with subprocess.Popen(
+        [
+            zstd,
+            f"-T{threads}",
+            # Record the content size in the frame header, as compressing
+            # a named file would; `zstd --list` consumers rely on it.
+            f"--stream-size={os.fstat(src.fileno()).st_size}",
+            "--compress",
+            "--stdout",
+            "--quiet",
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    ) as proc:
+        assert proc.stdin is not None and proc.stdout is not None
+
+        # zstd buffers internally, so feed and drain it from separate threads
+        # or both ends of the pipe can fill up and deadlock.
+        failed: list[Exception] = []
+
+        def feed() -> None:
+            try:
+                for chunk in iter(lambda: src.read(block_size), b""):
+                    try:
+                        proc.stdin.write(chunk)
+                    except BrokenPipeError:
+                        return  # zstd died; reported through its exit code below
+                    consume(chunk)
+            except Exception as e:  # noqa: BLE001 -- raised after the join
+                # Reading or consume failed, not zstd, which then only sees
+                # short input: raised in place of its exit code.
+                failed.append(e)
+            finally:
+                with contextlib.suppress(BrokenPipeError):
+                    proc.stdin.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        for chunk in iter(lambda: proc.stdout.read(block_size), b""):
+            emit(chunk)
+        feeder.join()
+        if failed:
+            raise failed[0]
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"zstd failed on {src.name} (exit {proc.returncode})")
+
+
+def zstd_frame(zstd: str, data: bytes) -> bytes:
+    return subprocess.run(
+        [
+            zstd,
+            "-T1",
+            f"--stream-size={len(data)}",
+            "--compress",
+            "--stdout",
+            "--quiet",
+        ],
+        input=data,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+
+
+def zstd_frames(
+    src,
+    zstd: str,
+    threads: int,
+    frame_size: int,
+    consume: Callable[[bytes], None],
+    emit: Callable[[bytes], None],
+) -> list[dict]:
+    """Compress `src` as independent zstd frames and return the frame table.
+
+    Concatenated frames are still one valid zstd file, but each frame can be
+    decompressed on its own, so a writer can spread them across cores and
+    resume at a frame boundary. Frames are compressed concurrently by
+    single-threaded zstd processes and emitted in order; at most two per
+    worker are in flight, which bounds memory to a few frames per worker.
+    """
+    workers = threads or os.cpu_count() or 1
+    frames = []
+    inflight = deque()
+    unpacked_offset = 0
+    packed_offset = 0
+
+    def drain() -> None:
+        nonlocal packed_offset
+        offset, size, future = inflight.popleft()
+        data = future.result()
+        frames.append(
+            {
+                "compressed_offset": packed_offset,
+                "compressed_size": len(data),
+                "uncompressed_offset": offset,
+                "uncompressed_size": size,
+            }
+        )
+        emit(data)
+        packed_offset += len(data)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for frame in iter(lambda: src.read(frame_size), b""):
+            consume(frame)
+            inflight.append(
+                (unpacked_offset, len(frame), pool.submit(zstd_frame, zstd, frame))
+            )
+            unpacked_offset += len(frame)
+            if len(inflight) >= 2 * workers:
+                drain()
+        while inflight:
+            drain()
+    return frames
+
+
+def compress(
+    filename: str,
+    version: str,
+    fragment: str,
+    zstd: str,
+    threads: int,
+    block_size: int,
+    fadvise: bool = True,
+    tree: TreeHash | None = None,
+    chunks: ChunkIndex | None = None,
+    frame_size: int = 0,
+) -> dict:
+    """Compress a raw image into its final name, removing the original.
+
+    The raw image is read exactly once: it is streamed into zstd while the
+    compressed output is hashed and written out in the same pass, so nothing
+    is re-read from disk afterwards to compute sizes or digests. A non-zero
+    `frame_size` produces a seekable multi-frame file and a frame table.
+    """
+    new = fixname(filename, version, fragment) + ".zst"
+    h = hashlib.sha256()
+    unpacked_size = 0
+    packed_size = 0
+    frames = None
+
+    # The delta was started before this ran; on failure, stop its zstd and
+    # remove the partial file rather than leaving both behind.
+    delta = chunks.delta if chunks is not None else None
+    with delta if delta is not None else contextlib.nullcontext():
+        with open_sequential(filename, fadvise) as src, open(new, "wb") as dst:
+
+            def consume(data: bytes) -> None:
+                nonlocal unpacked_size
+                if chunks is not None:
+                    chunks.update(data)
+                unpacked_size += len(data)
+
+            def emit(data: bytes) -> None:
+                nonlocal packed_size
+                h.update(data)
+                if tree is not None:
+                    tree.update(data)
+                dst.write(data)
+                packed_size += len(data)
+
+            if frame_size:
+                frames = zstd_frames(src, zstd, threads, frame_size, consume, emit)
+            else:
+                zstd_stream(src, zstd, threads, block_size, consume, emit)
+
+        os.unlink(filename)
+        print(f"{filename} -> {new}")
+        entry = {
+            "file": os.path.basename(new),
+            "sha256": h.hexdigest(),
+            "packed_size": packed_size,
+            "unpacked_size": unpacked_size,
+        }
+        if tree is not None:
+            entry["sha256_tree"] = tree.result()
+        if chunks is not None:
+            entry["chunk_index"] = chunks.result()
+            if delta is not None:
+                entry["delta"] = delta.result()
+        if frames is not None:
+            entry["frames"] = frames
+        return entry
+
+
 def file_size(path: str) -> int:
     return os.path.getsize(path)
 
@@ -82,33 +541,94 @@ def main() -> None:
         )
     root_verity_hash = root_verity_hash[:64]
 
+    if args.frame_size < 0 or args.frame_size % 4096:
+        parser.error("--frame-size must be a multiple of 4096")
+    if args.base_manifest and not args.chunk_index:
+        parser.error("--base-manifest requires --chunk-index")
+
+    base = None
+    if args.base_manifest:
+        with open(args.base_manifest, "r", encoding="utf-8") as f:
+            base = json.load(f)
+
     storehash = root_verity_hash[:16]
 
-    store = rename(args.root_image, args.version, storehash)
-    verity = rename(args.verity_image, args.version, storehash)
-    kernel = rename(args.kernel_image, args.version, storehash)
+    # The artifacts are independent, and both zstd and hashlib release the
+    # GIL on large buffers, so process them side by side rather than leaving
+    # all but one core idle while the multi-GB root image streams through.
+    # Tree hash leaves get their own pool so they can never starve, or be
+    # starved by, the per-artifact workers waiting on them.
+    with (
+        ThreadPoolExecutor() as leaf_pool,
+        ThreadPoolExecutor(max_workers=3) as pool,
+    ):
+
+        def tree() -> TreeHash | None:
+            if not args.tree_hash:
+                return None
+            return TreeHash(args.tree_leaf_size, leaf_pool)
+
+        def chunks(filename: str, name: str) -> ChunkIndex | None:
+            if not args.chunk_index:
+                return None
+            if base is None:
+                return ChunkIndex()
+            path = fixname(filename, args.version, storehash) + ".delta.zst"
+            return ChunkIndex(Delta(path, base, name, args.zstd, args.threads))
+
+        # Each delta starts zstd and opens its file when built, and checks the
+        # base manifest; build both before any input is renamed or consumed,
+        # so one failing cannot leave the others already gone.
+        root_chunks = chunks(args.root_image, "root")
+        try:
+            verity_chunks = chunks(args.verity_image, "verity")
+        except BaseException:
+            if root_chunks is not None and root_chunks.delta is not None:
+                root_chunks.delta.abort()
+            raise
+        kernel = rename(args.kernel_image, args.version, storehash)
+
+        store = pool.submit(
+            compress,
+            args.root_image,
+            args.version,
+            storehash,
+            args.zstd,
+            args.threads,
+            args.block_size,
+            args.fadvise,
+            tree=tree(),
+            chunks=root_chunks,
+            frame_size=args.frame_size,
+        )
+        verity = pool.submit(
+            compress,
+            args.verity_image,
+            args.version,
+            storehash,
+            args.zstd,
+            args.threads,
+            args.block_size,
+            args.fadvise,
+            tree=tree(),
+            chunks=verity_chunks,
+            frame_size=args.frame_size,
+        )
+        kernel_sha256 = pool.submit(sha256_file, kernel, args.block_size, args.fadvise)
 
     manifest = {
-        "manifest_version": 0,
+        # Version 1 adds the chunk indexes; without them the manifest is
+        # unchanged, and readers that only know version 0 keep working.
+        "manifest_version": 1 if args.chunk_index else 0,
         "system": args.system,
         "meta": {},  # FIXME: reserved for future, just arbitrary metadata
         "version": args.version,
         "root_verity_hash": root_verity_hash,
-        "root": {
-            "file": os.path.basename(store),
-            "sha256": sha256_file(store),
-            "packed_size": file_size(store),
-            "unpacked_size": args.root_unpacked_size,
-        },
-        "verity": {
-            "file": os.path.basename(verity),
-            "sha256": sha256_file(verity),
-            "packed_size": file_size(verity),
-            "unpacked_size": args.verity_unpacked_size,
-        },
+        "root": store.result(),
+        "verity": verity.result(),
         "kernel": {
             "file": os.path.basename(kernel),
-            "sha256": sha256_file(kernel),
+            "sha256": kernel_sha256.result(),
             "unpacked_size": file_size(kernel),
         },
     }
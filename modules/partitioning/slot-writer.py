@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Write a verity payload into the inactive A/B slot, driven by its manifest.
+
+For the root and verity images in turn, four stages run as separate threads
+connected by bounded queues, so reading, hashing, decompressing and writing all
+overlap:
+
+  fetch       read the compressed artifact from disk or over HTTP
+  sha256      check it against the manifest while it passes through
+  zstd        decompress it
+  write       large aligned writes into the target logical volume
+
+All-zero runs are not written: on a block device they are handed to the kernel
+as BLKZEROOUT, which the storage can usually satisfy without transferring data,
+and a plain-file target is sparse to begin with. A per-stage throughput table
+at the end shows whether the network, the CPU or the storage was the limit.
+
+Targets default to /dev/<vg>/root_<version>_<hash> and .../verity_..., which
+must already exist as block devices. For testing, --file-target lets a path
+given with --root-target or --verity-target outside /dev be a plain file,
+created if it is missing.
+"""
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import resource
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+parser = argparse.ArgumentParser(
+    description="Write root and verity images from a manifest into a slot."
+)
+parser.add_argument("--manifest", required=True, help="Manifest path or URL.")
+parser.add_argument("--root-target", help="Root volume or file to write.")
+parser.add_argument("--verity-target", help="Verity volume or file to write.")
+parser.add_argument(
+    "--vg", default="pool", help="Volume group holding the default targets."
+)
+parser.add_argument(
+    "--file-target",
+    action="store_true",
+    help="Allow an explicitly given target outside /dev to be a plain file.",
+)
+parser.add_argument("--zstd", default="zstd", help="Path to the zstd binary.")
+parser.add_argument(
+    "--queue-depth",
+    type=int,
+    default=8,
+    help="Buffers allowed in flight between two stages.",
+)
+
+READ_SIZE = 1024 * 1024
+WRITE_SIZE = 4 * 1024 * 1024
+ZERO_GRANULE = 64 * 1024
+ZERO = bytes(ZERO_GRANULE)
+BLKZEROOUT = 0x127F  # _IO(0x12, 127)
+
+
+class WriteError(Exception):
+    pass
+
+
+class Stage:
+    """Bytes moved and time spent working, as opposed to waiting on a queue."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes = 0
+        self.busy = 0.0
+
+    @contextlib.contextmanager
+    def work(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.busy += time.monotonic() - start
+
+
+class Channel:
+    """Bounded queue between two stages, closed by a None sentinel."""
+
+    def __init__(self, depth: int):
+        self.queue: queue.Queue = queue.Queue(maxsize=depth)
+        self.closed = False
+
+    def put(self, item: bytes) -> None:
+        self.queue.put(item)
+
+    def close(self) -> None:
+        self.queue.put(None)
+
+    def __iter__(self):
+        while (item := self.queue.get()) is not None:
+            yield item
+        self.closed = True
+
+    def drain(self) -> None:
+        if not self.closed:
+            for _ in self:
+                pass
+
+
+class Pipeline:
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.errors: list[Exception] = []
+        self.threads: list[threading.Thread] = []
+
+    def channel(self) -> Channel:
+        return Channel(self.depth)
+
+    def run(self, target, inq: Channel | None, outq: Channel | None) -> None:
+        """Run a stage; on failure keep draining so upstream never blocks."""
+
+        def body() -> None:
+            try:
+                target()
+            except Exception as e:  # noqa: BLE001 -- reported by wait()
+                self.errors.append(e)
+                if inq is not None:
+                    inq.drain()
+            finally:
+                if outq is not None:
+                    outq.close()
+
+        thread = threading.Thread(target=body, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def wait(self) -> None:
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def open_source(url: str):
+    if urllib.parse.urlparse(url).scheme in ("http", "https"):
+        return urllib.request.urlopen(url)
+    return open(url, "rb")
+
+
+def is_block_target(path: str, file_allowed: bool) -> bool:
+    """Whether a target is a block device; raises if it is not and must be.
+
+    Under /dev a missing or mistyped volume must not turn into a file, which
+    would quietly fill devtmpfs instead of writing the slot.
+    """
+    try:
+        if stat.S_ISBLK(os.stat(path).st_mode):
+            return True
+    except FileNotFoundError:
+        pass
+    if os.path.realpath(path).startswith("/dev/"):
+        raise WriteError(f"{path} is not a block device")
+    if not file_allowed:
+        raise WriteError(
+            f"{path} is not a block device (--file-target writes plain files)"
+        )
+    return False
+
+
+def open_target(path: str, size: int, is_block: bool) -> int:
+    """Open a target checked by is_block_target() for writing."""
+    if not is_block:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, size)
+        return fd
+    # O_EXCL on a block device fails with EBUSY while it is mounted or held by
+    # a device-mapper table, i.e. while it is the active slot.
+    fd = os.open(path, os.O_WRONLY | os.O_EXCL)
+    if os.lseek(fd, 0, os.SEEK_END) < size:
+        os.close(fd)
+        raise WriteError(f"{path} is smaller than the {size} byte image")
+    return fd
+
+
+def write_image(
+    url: str, entry: dict, target: str, is_block: bool, zstd: str, depth: int
+) -> list[Stage]:
+    fetch = Stage("fetch")
+    check = Stage("sha256")
+    unpack = Stage("zstd")
+    write = Stage("write")
+    pipeline = Pipeline(depth)
+    fetched, checked, unpacked = (
+        pipeline.channel(),
+        pipeline.channel(),
+        pipeline.channel(),
+    )
+    digest = hashlib.sha256()
+    verified = False
+
+    def do_fetch() -> None:
+        with open_source(url) as src:
+            while True:
+                with fetch.work():
+                    chunk = src.read(READ_SIZE)
+                if not chunk:
+                    return
+                fetch.bytes += len(chunk)
+                fetched.put(chunk)
+
+    def do_check() -> None:
+        nonlocal verified
+        for chunk in fetched:
+            with check.work():
+                digest.update(chunk)
+            check.bytes += len(chunk)
+            checked.put(chunk)
+        if digest.hexdigest() != entry["sha256"]:
+            raise WriteError(f"{entry['file']}: sha256 does not match the manifest")
+        verified = True
+
+    # A file rather than a pipe, so nobody has to drain it.
+    stderr = tempfile.TemporaryFile()  # noqa: SIM115 -- closed after the pipeline
+    proc = subprocess.Popen(
+        [zstd, "--decompress", "--stdout", "--quiet"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+    )
+    assert proc.stdin is not None and proc.stdout is not None
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def do_feed() -> None:
+        try:
+            for chunk in checked:
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+
+    def do_unpack() -> None:
+        for chunk in iter(lambda: proc.stdout.read(WRITE_SIZE), b""):
+            unpack.bytes += len(chunk)
+            unpacked.put(chunk)
+
+    def do_write() -> None:
+        fd = open_target(target, entry["unpacked_size"], is_block)
+        try:
+            offset = 0
+            for chunk in unpacked:
+                with write.work():
+                    write_chunk(fd, offset, chunk, is_block)
+                offset += len(chunk)
+                write.bytes += len(chunk)
+            if offset != entry["unpacked_size"]:
+                raise WriteError(
+                    f"{entry['file']}: unpacked to {offset} bytes, "
+                    f"manifest says {entry['unpacked_size']}"
+                )
+            with write.work():
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    pipeline.run(do_fetch, None, fetched)
+    pipeline.run(do_check, fetched, checked)
+    pipeline.run(do_feed, checked, None)
+    pipeline.run(do_unpack, None, unpacked)
+    pipeline.run(do_write, unpacked, None)
+    with stderr:
+        try:
+            pipeline.wait()
+        except Exception:
+            # zstd failing on verified input is why the feed hit a broken pipe
+            # or the image came up short; report zstd instead of the symptom.
+            if not verified or proc.wait() == 0:
+                raise
+        finally:
+            proc.wait()
+        if proc.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors="replace").strip()
+            raise WriteError(
+                f"{entry['file']}: zstd exited with {proc.returncode}"
+                + (f": {message}" if message else "")
+            )
+
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    unpack.busy = (after.ru_utime + after.ru_stime) - (
+        children.ru_utime + children.ru_stime
+    )
+    return [fetch, check, unpack, write]
+
+
+def write_chunk(fd: int, offset: int, chunk: bytes, is_block: bool) -> None:
+    """Write one buffer, skipping all-zero runs of ZERO_GRANULE bytes."""
+    runs = []
+    for start in range(0, len(chunk), ZERO_GRANULE):
+        # Comparing bytes is a memcmp; comparing memoryviews is not.
+        piece = chunk[start : start + ZERO_GRANULE]
+        zero = piece == ZERO[: len(piece)]
+        end = start + len(piece)
+        if runs and runs[-1][2] == zero:
+            runs[-1] = (runs[-1][0], end, zero)
+        else:
+            runs.append((start, end, zero))
+    with memoryview(chunk) as view:
+        for start, end, zero in runs:
+            if not zero:
+                os.pwrite(fd, view[start:end], offset + start)
+            elif is_block:
+                fcntl.ioctl(
+                    fd, BLKZEROOUT, struct.pack("QQ", offset + start, end - start)
+                )
+            # A plain file was truncated to size, so its zeros are holes.
+
+
+def report(name: str, stages: list[Stage], wall: float) -> None:
+    print(f"{name}: {wall:.1f}s")
+    for s in stages:
+        rate = s.bytes / s.busy / 1e6 if s.busy else float("inf")
+        print(
+            f"  {s.name:<7} {s.bytes / 1e6:10.1f} MB  busy {s.busy:6.1f}s "
+            f"({100 * s.busy / wall if wall else 0:5.1f}%)  {rate:8.1f} MB/s"
+        )
+    bottleneck = max(stages, key=lambda s: s.busy)
+    print(f"  bottleneck: {bottleneck.name}")
+
+
+def load_manifest(location: str) -> dict:
+    with open_source(location) as f:
+        return json.load(f)
+
+
+def main() -> int:
+    args = parser.parse_args()
+    manifest = load_manifest(args.manifest)
+    suffix = f"{manifest['version']}_{manifest['root_verity_hash'][:16]}"
+    targets = {
+        "root": args.root_target or f"/dev/{args.vg}/root_{suffix}",
+        "verity": args.verity_target or f"/dev/{args.vg}/verity_{suffix}",
+    }
+    explicit = {"root": args.root_target, "verity": args.verity_target}
+    # Check both targets before writing either, so a bad verity target does
+    # not leave a freshly overwritten root behind.
+    try:
+        is_block = {
+            name: is_block_target(target, args.file_target and bool(explicit[name]))
+            for name, target in targets.items()
+        }
+    except (OSError, WriteError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    for name, target in targets.items():
+        entry = manifest[name]
+        # Artifact names are relative to the manifest, for URLs as for paths.
+        if urllib.parse.urlparse(args.manifest).scheme in ("http", "https"):
+            url = urllib.parse.urljoin(args.manifest, entry["file"])
+        else:
+            url = os.path.join(os.path.dirname(args.manifest), entry["file"])
+        print(f"{url} -> {target}", flush=True)
+        start = time.monotonic()
+        try:
+            stages = write_image(
+                url, entry, target, is_block[name], args.zstd, args.queue_depth
+            )
+        except (OSError, WriteError) as e:
+            print(f"Error: {name}: {e}", file=sys.stderr)
+            return 1
+        report(name, stages, time.monotonic() - start)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Check compressed root and verity images against the manifest's root hash.
+
+Decompresses both images at once and rebuilds the dm-verity hash tree from the
+root image as it streams past, one partial hash block per tree level. The
+result is compared with `root_verity_hash`, and every level of the tree is
+compared with the corresponding region of the verity image by digest, so a
+payload is fully checked without temporary files or `veritysetup verify`, in
+memory bounded by the depth of the tree.
+
+Only the on-disk format `veritysetup format` writes by default is handled:
+a version 1 superblock at the start of the verity image, salt prepended.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+parser = argparse.ArgumentParser(
+    description="Verify verity artifacts against the root hash in a manifest."
+)
+parser.add_argument("--manifest", required=True, help="Path to the manifest.")
+parser.add_argument("--zstd", default="zstd", help="Path to the zstd binary.")
+
+READ_SIZE = 1024 * 1024
+
+# struct verity_sb from cryptsetup's lib/verity/verity.c; little-endian.
+SUPERBLOCK = struct.Struct("<8sII16s32sIIQH6x256s")
+SUPERBLOCK_MAGIC = b"verity\0\0"
+
+
+class VerifyError(Exception):
+    pass
+
+
+class Superblock:
+    def __init__(self, raw: bytes):
+        (
+            magic,
+            version,
+            self.hash_type,
+            _uuid,
+            algorithm,
+            self.data_block_size,
+            self.hash_block_size,
+            self.data_blocks,
+            salt_size,
+            salt,
+        ) = SUPERBLOCK.unpack_from(raw)
+        if magic != SUPERBLOCK_MAGIC or version != 1:
+            raise VerifyError("verity image has no version 1 superblock")
+        if self.hash_type != 1:
+            raise VerifyError(f"unsupported verity hash type {self.hash_type}")
+        self.algorithm = algorithm.rstrip(b"\0").decode()
+        self.salt = salt[:salt_size]
+
+        digest_size = hashlib.new(self.algorithm).digest_size
+        # Digests are stored padded to a power of two, and a hash block holds
+        # a power-of-two number of them; see hash_levels() in verity_hash.c.
+        self.digest_stride = 1 << (digest_size - 1).bit_length()
+        self.per_block_bits = (self.hash_block_size // digest_size).bit_length() - 1
+
+        self.levels = 0
+        while (self.data_blocks - 1) >> (self.per_block_bits * self.levels):
+            self.levels += 1
+        self.level_blocks = [
+            -(-self.data_blocks >> (self.per_block_bits * (i + 1)))
+            for i in range(self.levels)
+        ]
+
+
+class HashTree:
+    """Bottom-up dm-verity hash tree, fed one data block at a time.
+
+    Keeps one partially filled hash block per level, and a running digest of
+    every completed block per level to compare with the verity image.
+    """
+
+    def __init__(self, sb: Superblock):
+        self.sb = sb
+        self.salted = hashlib.new(sb.algorithm, sb.salt)
+        self.pending = [bytearray() for _ in range(sb.levels)]
+        self.level_digests = [hashlib.sha256() for _ in range(sb.levels)]
+        self.top = None
+
+    def _digest(self, block) -> bytes:
+        h = self.salted.copy()
+        h.update(block)
+        return h.digest()
+
+    def _add(self, level: int, digest: bytes) -> None:
+        if level == self.sb.levels:
+            self.top = digest
+            return
+        pending = self.pending[level]
+        pending += digest.ljust(self.sb.digest_stride, b"\0")
+        if len(pending) == self.sb.hash_block_size:
+            self._emit(level)
+
+    def _emit(self, level: int) -> None:
+        block = self.pending[level].ljust(self.sb.hash_block_size, b"\0")
+        self.pending[level].clear()
+        self.level_digests[level].update(block)
+        self._add(level + 1, self._digest(block))
+
+    def update(self, block) -> None:
+        self._add(0, self._digest(block))
+
+    def root_hash(self) -> str:
+        for level in range(self.sb.levels):
+            if self.pending[level]:
+                self._emit(level)
+        assert self.top is not None
+        return self.top.hex()
+
+
+def decompress(zstd: str, path: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [zstd, "--decompress", "--stdout", "--quiet", path],
+        stdout=subprocess.PIPE,
+    )
+
+
+def read_exact(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise VerifyError("verity image is truncated")
+    return data
+
+
+def hash_verity_levels(stream, sb: Superblock) -> list[str]:
+    """Digest each level's region of the verity image, in level order."""
+    digests = [""] * sb.levels
+    # Levels are stored top-down, straight after the superblock's block.
+    for level in reversed(range(sb.levels)):
+        h = hashlib.sha256()
+        remaining = sb.level_blocks[level] * sb.hash_block_size
+        while remaining:
+            chunk = read_exact(stream, min(READ_SIZE, remaining))
+            h.update(chunk)
+            remaining -= len(chunk)
+        digests[level] = h.hexdigest()
+    return digests
+
+
+def verify(manifest_path: str, zstd: str) -> None:
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    base = os.path.dirname(manifest_path)
+    root = manifest["root"]
+    verity = manifest["verity"]
+
+    with (
+        decompress(zstd, os.path.join(base, verity["file"])) as verity_proc,
+        decompress(zstd, os.path.join(base, root["file"])) as root_proc,
+    ):
+        assert verity_proc.stdout is not None and root_proc.stdout is not None
+        head = verity_proc.stdout.read(4096)
+        sb = Superblock(head)
+        if sb.levels == 0:
+            raise VerifyError("single-block images are not supported")
+        # The superblock occupies the whole first hash block.
+        read_exact(verity_proc.stdout, sb.hash_block_size - len(head))
+
+        # The verity image is read on its own thread while this one hashes
+        # the root image, so both decompressors run flat out side by side.
+        image_levels: list[str] = []
+        failure: list[Exception] = []
+
+        def read_verity() -> None:
+            try:
+                image_levels.extend(hash_verity_levels(verity_proc.stdout, sb))
+                verity_proc.stdout.read()  # alignment padding, if any
+            except Exception as e:  # noqa: BLE001 -- re-raised below
+                failure.append(e)
+
+        reader = threading.Thread(target=read_verity)
+        reader.start()
+
+        tree = HashTree(sb)
+        block_size = sb.data_block_size
+        pending = bytearray()
+        size = 0
+        for chunk in iter(lambda: root_proc.stdout.read(READ_SIZE), b""):
+            pending += chunk
+            size += len(chunk)
+            end = len(pending) - len(pending) % block_size
+            with memoryview(pending) as view:
+                for off in range(0, end, block_size):
+                    tree.update(view[off : off + block_size])
+            del pending[:end]
+        reader.join()
+
+    if root_proc.returncode or verity_proc.returncode:
+        raise VerifyError("zstd failed to decompress the images")
+    if failure:
+        raise failure[0]
+    if pending or size != sb.data_blocks * block_size:
+        raise VerifyError(
+            f"root image is {size} bytes, verity image covers "
+            f"{sb.data_blocks * block_size}"
+        )
+    if size != root["unpacked_size"]:
+        raise VerifyError(
+            f"root image is {size} bytes, manifest says {root['unpacked_size']}"
+        )
+
+    # Flushes the partial blocks, so it has to come before the level checks.
+    root_hash = tree.root_hash()
+    if root_hash != manifest["root_verity_hash"].lower():
+        raise VerifyError(
+            f"root hash {root_hash} does not match manifest "
+            f"{manifest['root_verity_hash']}"
+        )
+
+    for level, (ours, theirs) in enumerate(
+        zip(
+            (h.hexdigest() for h in tree.level_digests),
+            image_levels,
+            strict=True,
+        )
+    ):
+        if ours != theirs:
+            raise VerifyError(f"verity image hash tree level {level} does not match")
+
+
+def main() -> int:
+    args = parser.parse_args()
+    try:
+        verify(args.manifest, args.zstd)
+    except VerifyError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(f"{args.manifest}: root and verity images match root_verity_hash")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -123,24 +123,24 @@ in
               --output ${kernelImage} ${kernelImage}
           ''}
 
-          # FIXME: move compression into mk-manifest.py and compute unpacked sizes there.
-          rootUnpackedSize=$(stat -c%s ${fsImage})
-          verityUnpackedSize=$(stat -c%s ${verityImage})
-
-          # Compress the image
-          ${lib.getExe pkgs.buildPackages.zstd} -T''${cores} --compress $out/*raw --rm
-
-          # Create artifacts and manifest.
+          # Compress the images and create artifacts and manifest. mk-manifest.py
+          # owns compression so each raw image is read from disk exactly once.
           ${pkgs.buildPackages.python3}/bin/python ${./mk-manifest.py} \
             --version ${version} \
             --system ${config.nixpkgs.hostPlatform.system} \
             --hash-file $out/dm-verity-root-hash \
-            --root-image ${fsImage}.zst \
-            --verity-image ${verityImage}.zst \
+            --root-image ${fsImage} \
+            --verity-image ${verityImage} \
             --kernel-image ${kernelImage} \
             --manifest $out/${id}_@v_@u.manifest \
-            --root-unpacked-size "$rootUnpackedSize" \
-            --verity-unpacked-size "$verityUnpackedSize"
+            --zstd ${lib.getExe pkgs.buildPackages.zstd} \
+            --threads "''${NIX_BUILD_CORES:-0}"
+
+          # Check the compressed payload against the root hash it will be
+          # activated with, exactly as a device receives it.
+          ${pkgs.buildPackages.python3}/bin/python ${./verity-verify.py} \
+            --manifest $out/${id}_*.manifest \
+            --zstd ${lib.getExe pkgs.buildPackages.zstd}
 
           # Clean-up
           rm -f $out/dm-verity-root-hash
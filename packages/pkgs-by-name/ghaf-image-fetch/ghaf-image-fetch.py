@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Fetch a netboot image to stdout, from ghaf-netboot's multicast if it can.
+
+  ghaf-image-fetch http://192.0.2.1:8080/ghaf-image/ghaf-image.raw.zst | zstdcat
+
+Asks the server to join the next multicast session for the file (GET
+/v1/multicast/<path>), joins the group, and writes the file to stdout in
+order as the datagrams arrive. Every datagram carries one BLOCK of the file;
+a block that does not arrive -- a gap that stays open while later blocks
+pass, or the stream ending -- is fetched with an HTTP Range request over one
+keep-alive connection, which is the repair: the server needs no NACK channel
+of its own and a receiver needs no back-channel but the one it already has.
+
+Falls back to a plain HTTP download from wherever it has got to, resuming on
+errors the way `curl --retry` would, when the server offers no session, when
+nothing arrives, or when stdout drains slower than the session sends and
+more than MAX_BUFFER would pile up. Nothing here checks the content; the
+block map that bmaptool writes against does.
+"""
+
+import argparse
+import http.client
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+# Must match ghaf-netboot-api.
+HEADER = struct.Struct("!4sIQ")
+MAGIC = b"GHMC"
+MAX_DATAGRAM = 65536
+# Blocks held for stdout before the session counts as too fast for us.
+MAX_BUFFER = 256 * 1024 * 1024
+# A missing block is lost once a block this much further on has arrived.
+REORDER = 64
+# Seconds without a datagram after which the session is over for us.
+IDLE = 1.0
+# Seconds past the announced start to wait for the first datagram.
+START_GRACE = 5.0
+# Largest single repair request, in bytes.
+MAX_REPAIR = 4 * 1024 * 1024
+# Stdout writes are batched up to this many bytes.
+WRITE_BATCH = 1024 * 1024
+RETRIES = 5
+RETRY_DELAY = 2
+TIMEOUT = 10
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument("url", help="http:// URL of the file")
+parser.add_argument(
+    "--no-multicast", action="store_true", help="plain HTTP download only"
+)
+
+
+class FetchError(Exception):
+    pass
+
+
+def log(fmt, *args):
+    print(f"ghaf-image-fetch: {fmt % args}", file=sys.stderr, flush=True)
+
+
+class Origin:
+    """The HTTP server the file comes from, over one keep-alive connection."""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "http":
+            raise FetchError(f"only http:// URLs are supported, not {url}")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.conn = None
+
+    def request(self, path, headers=None):
+        """GET `path`; returns the response, reconnecting once if stale."""
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=TIMEOUT
+                )
+            try:
+                self.conn.request("GET", path, headers=headers or {})
+                return self.conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        raise AssertionError("unreachable")
+
+    def local_address(self):
+        """The address we reach the server from: the interface to join on."""
+        with socket.create_connection((self.host, self.port), TIMEOUT) as s:
+            return s.getsockname()[0]
+
+    def read_range(self, start, end):
+        """Bytes [start, end) of the file."""
+        response = self.request(self.path, {"Range": f"bytes={start}-{end - 1}"})
+        data = response.read()
+        if response.status != 206 or len(data) != end - start:
+            raise FetchError(
+                f"repair of bytes {start}-{end - 1} got {response.status}, "
+                f"{len(data)} bytes"
+            )
+        return data
+
+    def stream(self, offset, size, out):
+        """Write bytes [offset, size) to `out`, resuming on errors."""
+        failures = 0
+        while offset < size:
+            try:
+                response = self.request(self.path, {"Range": f"bytes={offset}-"})
+                if response.status != 206:
+                    raise FetchError(f"{self.path}: HTTP {response.status}")
+                while chunk := response.read(WRITE_BATCH):
+                    out.write(chunk)
+                    offset += len(chunk)
+                    failures = 0
+            except (OSError, http.client.HTTPException, FetchError) as e:
+                failures += 1
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                if failures > RETRIES:
+                    raise FetchError(f"giving up at byte {offset}: {e}") from e
+                log("%s; resuming at byte %d", e, offset)
+                time.sleep(RETRY_DELAY)
+
+
+class Receiver:
+    """Datagrams of one session, collected on a thread of their own.
+
+    The thread only stores blocks; the main thread takes them out in order.
+    Dict stores and pops are atomic, and each counter has one writer, so
+    neither side needs a lock.
+    """
+
+    def __init__(self, session, interface):
+        self.session = session
+        self.blocks: dict[int, bytes] = {}
+        self.highest = -1
+        self.last = 0.0
+        # Payload bytes stored here, and taken out by the main thread.
+        self.received = 0
+        self.taken = 0
+        # Set by the main thread: blocks before this are written already.
+        self.needed = 0
+        self.overflow = False
+        self.stop = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Room for bursts while this thread waits for the GIL. FORCE needs
+        # root, which the installer has; the plain one is capped by rmem_max.
+        for option in (getattr(socket, "SO_RCVBUFFORCE", None), socket.SO_RCVBUF):
+            if option is None:
+                continue
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, option, 16 * 1024 * 1024)
+                break
+            except OSError:
+                continue
+        self.sock.bind(("", session["port"]))
+        self.sock.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+            socket.inet_aton(session["group"]) + socket.inet_aton(interface),
+        )
+        self.sock.settimeout(0.2)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        session_id = self.session["session"]
+        while not self.stop:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+            if len(data) < HEADER.size:
+                continue
+            magic, session, index = HEADER.unpack_from(data)
+            if magic != MAGIC or session != session_id:
+                continue
+            self.last = time.monotonic()
+            self.highest = max(self.highest, index)
+            if index >= self.needed and index not in self.blocks:
+                self.blocks[index] = data[HEADER.size :]
+                self.received += len(data) - HEADER.size
+                if self.received - self.taken > MAX_BUFFER:
+                    self.overflow = True
+                    return
+
+    def close(self):
+        self.stop = True
+        self.thread.join()
+        self.sock.close()
+
+
+def multicast(origin, session, out):
+    """Write the file to `out` from `session`; returns where it stopped.
+
+    Stops at the file's size when done, or earlier once the rest is better
+    fetched over plain HTTP.
+    """
+    size, block = session["size"], session["block"]
+    count = -(-size // block)
+    receiver = Receiver(session, origin.local_address())
+    deadline = time.monotonic() + session["start"] + START_GRACE
+    started = time.monotonic()
+    index = repaired = requests = 0
+    try:
+        while index < count:
+            run = []
+            batch = 0
+            while batch < WRITE_BATCH and (data := receiver.blocks.pop(index, None)):
+                run.append(data)
+                batch += len(data)
+                index += 1
+            receiver.needed = index
+            if run:
+                receiver.taken += batch
+                out.write(b"".join(run))
+                continue
+
+            now = time.monotonic()
+            if receiver.overflow:
+                log("falling behind the session at block %d of %d", index, count)
+                return index * block
+            if receiver.highest < 0:
+                if now > deadline:
+                    log("no multicast arrived")
+                    return index * block
+                time.sleep(0.01)
+                continue
+            if receiver.highest < index + REORDER and now - receiver.last < IDLE:
+                time.sleep(0.001)
+                continue
+
+            # `index` is lost: repair it and whatever else is missing after it.
+            end = index + 1
+            while (
+                end < count
+                and end not in receiver.blocks
+                and (end - index) * block < MAX_REPAIR
+            ):
+                end += 1
+            try:
+                data = origin.read_range(index * block, min(end * block, size))
+            except (OSError, http.client.HTTPException, FetchError) as e:
+                log("repair failed: %s", e)
+                return index * block
+            out.write(data)
+            repaired += min(end * block, size) - index * block
+            requests += 1
+            index = end
+    finally:
+        receiver.close()
+    elapsed = time.monotonic() - started
+    log(
+        "%.0f MB by multicast, %.1f MB repaired in %d requests, %.1f s",
+        (size - repaired) / 1e6,
+        repaired / 1e6,
+        requests,
+        elapsed,
+    )
+    return size
+
+
+def fetch(url, use_multicast, out):
+    origin = Origin(url)
+    control = f"/v1/multicast{origin.path}"
+    session = None
+    if use_multicast:
+        try:
+            response = origin.request(control)
+            body = response.read()
+            if response.status == 200:
+                session = json.loads(body)
+            else:
+                log("no multicast session: %s", body.decode(errors="replace").strip())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            log("no multicast session: %s", e)
+
+    if session is None:
+        response = origin.request(origin.path, {"Range": "bytes=0-0"})
+        response.read()
+        if response.status != 206:
+            raise FetchError(f"{url}: HTTP {response.status}")
+        size = int(response.headers["Content-Range"].rpartition("/")[2])
+        origin.stream(0, size, out)
+        return
+
+    log(
+        "joining session %d on %s:%d, starting in %.0f s",
+        session["session"],
+        session["group"],
+        session["port"],
+        session["start"],
+    )
+    offset = multicast(origin, session, out)
+    if offset < session["size"]:
+        log("fetching the rest over HTTP from byte %d", offset)
+        origin.stream(offset, session["size"], out)
+    # Lets exit-after-serve count this machine; best effort.
+    try:
+        origin.request(f"{control}?done={session['session']}").read()
+    except (OSError, http.client.HTTPException):
+        pass
+
+
+def main():
+    args = parser.parse_args()
+    try:
+        fetch(args.url, not args.no_multicast, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        return 1
+    except (FetchError, OSError, http.client.HTTPException) as e:
+        log("%s", e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+{
+  lib,
+  python3,
+}:
+python3.pkgs.buildPythonApplication {
+  pname = "ghaf-image-fetch";
+  version = "0.1.0";
+  format = "other";
+  src = ./ghaf-image-fetch.py;
+  dontUnpack = true;
+  installPhase = ''
+    install -Dm755 $src $out/bin/ghaf-image-fetch
+    patchShebangs $out/bin/ghaf-image-fetch
+  '';
+
+  meta = {
+    description = "Fetch a netboot image from ghaf-netboot, by multicast where offered";
+    platforms = lib.platforms.linux;
+    mainProgram = "ghaf-image-fetch";
+    license = lib.licenses.asl20;
+  };
+}
@@ -191,7 +191,12 @@ resolve_image_source() {
 # Produce the decompressed image on stdout, from disk or from the network.
 # shellcheck disable=SC2329
 feed_image() {
-  if [[ ${GHAF_REMOTE:-false} == true ]]; then
+  if [[ ${GHAF_REMOTE:-false} == true && $GHAF_RAW_SRC == http://* ]] &&
+    grep -qwF ghaf.image_multicast /proc/cmdline 2>/dev/null; then
+    # Set by ghaf-netboot --multicast: joins the batch's multicast session and
+    # falls back to plain HTTP itself, resuming as curl --retry would.
+    ghaf-image-fetch "$GHAF_RAW_SRC"
+  elif [[ ${GHAF_REMOTE:-false} == true ]]; then
     # --no-progress-meter: pv already draws the progress bar the TUI shows, and
     # curl's own meter would scribble over it on the same tty.
     curl -fL --no-progress-meter --connect-timeout 10 --retry 5 --retry-delay 2 --retry-all-errors "$GHAF_RAW_SRC"
@@ -8,6 +8,7 @@
   e2fsprogs,
   efitools,
   gawk,
+  ghaf-image-fetch,
   gum,
   lib,
   lvm2,
@@ -36,6 +37,7 @@ writeShellApplication {
     e2fsprogs # chattr in efivar cleanup
     efitools # Secure Boot key enrollment
     gawk
+    ghaf-image-fetch # ghaf.image_multicast: the image from a multicast session
     gum # TUI components
     lvm2 # vgchange, pvremove
     ncurses
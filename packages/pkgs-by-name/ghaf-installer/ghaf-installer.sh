@@ -36,6 +36,8 @@ Kernel parameters, for unattended netboot installs:
   ghaf.install_secureboot            as -s
   ghaf.install_noreboot              stay in the installer after an unattended
                                      install instead of rebooting into it
+  ghaf.image_multicast               fetch the image with ghaf-image-fetch, from
+                                     the server's multicast session if it has one
 
 Examples:
   $(basename "$0") -w
@@ -59,6 +61,7 @@ ASSUME_YES=false
 # in the installer forever.
 UNATTENDED=false
 REBOOT_WHEN_DONE=true
+IMAGE_MULTICAST=false
 
 # Kernel-parameter defaults, so a netbooted lab machine can install unattended
 # with no console interaction. Command-line flags still win over these.
@@ -82,6 +85,8 @@ if [ -r /proc/cmdline ]; then
   # Escape hatch for debugging a failed unattended install: without it the
   # evidence reboots away before anyone can look at it.
   case " $_cmdline " in *" ghaf.install_noreboot "*) REBOOT_WHEN_DONE=false ;; esac
+  # Set by ghaf-netboot --multicast, which sends one batch the image once.
+  case " $_cmdline " in *" ghaf.image_multicast "*) IMAGE_MULTICAST=true ;; esac
 
   # ghaf.image_url= overrides IMG_PATH, and on netboot it is the ONLY correct
   # source. Without this the netboot installer inherits the ISO's baked-in
@@ -319,7 +324,10 @@ fi
 echo "Installing..."
 
 feed_image() {
-  if [ "$GHAF_REMOTE" = true ]; then
+  if [ "$GHAF_REMOTE" = true ] && [ "$IMAGE_MULTICAST" = true ] && [[ $GHAF_RAW_SRC == http://* ]]; then
+    # Falls back to plain HTTP itself, resuming as curl --retry would.
+    ghaf-image-fetch "$GHAF_RAW_SRC"
+  elif [ "$GHAF_REMOTE" = true ]; then
     curl -fL --no-progress-meter --connect-timeout 10 --retry 5 --retry-delay 2 --retry-all-errors "$GHAF_RAW_SRC"
   else
     cat "$GHAF_RAW_SRC"
@@ -7,6 +7,7 @@
   e2fsprogs,
   efitools,
   gawk,
+  ghaf-image-fetch,
   hwinfo,
   lvm2,
   ncurses,
@@ -25,6 +26,7 @@ writeShellApplication {
     e2fsprogs # Needed for chattr in efivar cleanup
     efitools # Needed for Secure Boot key enrollment
     gawk # Needed for the awk in find_esp_device
+    ghaf-image-fetch # ghaf.image_multicast: the image from a multicast session
     hwinfo
     lvm2 # Needed for vgchange, pvremove
     ncurses # Needed for `clear` command
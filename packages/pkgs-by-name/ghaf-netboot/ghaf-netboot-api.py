@@ -20,21 +20,181 @@ process and one port for everything on the HTTP side.
   /boot/bzImage,/initrd   the netboot kernel and initrd
   /ghaf-image/...         ghaf-image.raw.zst and ghaf-image.bmap
 
+With --fleet the allowlist, artefacts and command lines come from a profile
+file instead, so one server can install a shelf of different machines at once:
+
+  {
+    "profiles": {
+      "x1": {"netboot": "/nix/store/...-netboot-installer",
+             "image": "/nix/store/...-lenovo-x1",
+             "install_target": "/dev/nvme0n1", "encrypt": true},
+      "nuc": {"netboot": "...", "image": "...", "cmdline": "console=ttyS0"}
+    },
+    "machines": {"aa:bb:cc:dd:ee:01": "x1", "aa:bb:cc:dd:ee:02": "nuc"}
+  }
+
+Each machine is then sent to /fleet/<mac>/boot/... and /fleet/<mac>/ghaf-image/,
+which map onto its profile's directories; nothing else is served. The file is
+re-read whenever it changes. A reload swaps the whole table at once and never
+touches a download already in progress; a file that fails to load is reported
+and the previous table kept.
+
 Threaded because the image is multi-GB: a single-threaded server would block
-every API call for the duration of one machine's download.
+every API call for the duration of one machine's download. --event-loop swaps
+the threads for one asyncio loop instead, where a stalled download costs a
+socket and a coroutine rather than an OS thread, for serving many machines at
+once; both modes answer the same requests the same way.
+
+Static files honour Range requests (single and multiple ranges, If-Range
+against an ETag derived from the file's identity), so an installer whose link
+drops can resume rather than restart the image, or fetch it in parallel.
+
+File bodies go out with sendfile(2): the kernel moves page-cache pages straight
+to the socket, so the Python thread does a handful of syscalls per gigabyte
+instead of copying every byte through its own buffers under the GIL.
+ghaf-netboot-bench.py measures the difference.
+
+What can be served is fixed when the server starts (or the fleet file loads):
+ghaf-netboot.sh hands over a finished symlink farm, so every file is stat()ed
+once and its validators and response headers rendered up front. A request is
+then a dict lookup, a 304 when the client's copy is current, and HTTP/1.1
+keep-alive lets iPXE fetch the kernel and initrd over one connection.
+
+--warm-cache reads every servable file into the page cache in the background
+at startup (and after a fleet reload), smallest first, so the first machine
+to boot streams from memory rather than from a slow disk; the banner says how
+much is being warmed and progress is logged as it goes. Served files are
+marked sequential either way, which doubles the kernel's readahead for them.
+
+--metrics-port serves counters in Prometheus text format on loopback: per
+client (by IP, with the MAC from the fleet URL or the ARP table) the bytes
+sent, throughput now and on average, time to first byte and completed versus
+aborted downloads, and per MAC the boot API's hits and misses. Log lines are
+queued and written by a thread of their own, so a slow terminal or journal
+never holds up a download.
+
+--rate-limit caps what all downloads together may send, so the host's own
+uplink stays usable, and --client-rate-limit caps each client. Under the
+global cap a download's share is proportional to the bytes it has left, so a
+batch of installs finishes together rather than in whatever order their TCP
+connections happened to win the link; ghaf-netboot-bench.py --rate shows it.
+
+--multicast GROUP:PORT sends an image to a whole batch of installers at once.
+An installer run with ghaf.image_multicast GETs /v1/multicast/<image path>
+(ghaf-image-fetch does), which opens a session for that file or joins the one
+about to start; --multicast-wait seconds after the first request, the file
+goes out once, as numbered UDP datagrams at --multicast-rate. Receivers fetch
+any block they miss with an ordinary Range request, and anyone who asks once
+a session is under way gets a 409 and plain HTTP. A receiver reports the file
+written with ?done=<session>, for the session it joined; with
+--exit-after-serve and no --fleet the server then stops once every receiver
+that joined has the image, or once every allowlisted MAC does, rather than
+when the first of the batch finishes.
 """
 
 import argparse
+import asyncio
+import collections
+import email.utils
+import errno
+import http.client
 import http.server
+import io
+import ipaddress
 import json
+import math
+import mimetypes
 import os
+import queue
 import re
+import select
+import signal
+import socket
 import socketserver
+import struct
 import sys
 import threading
+import time
+import urllib.parse
+import uuid
+from http import HTTPStatus
 from typing import ClassVar
 
 MAC_RE = re.compile(r"^[0-9a-f]{2}(:[0-9a-f]{2}){5}$")
+RANGE_SPEC_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+# More ranges than this in one request is abuse, not an installer; ignore them.
+MAX_RANGES = 32
+COPY_CHUNK = 1024 * 1024
+# Per sendfile() call. Big enough that syscall overhead vanishes, small enough
+# that exit-after-serve sees progress while a slow client is downloading.
+SENDFILE_CHUNK = 64 * 1024 * 1024
+# Per read while warming the page cache, and how often progress is logged.
+WARM_CHUNK = 8 * 1024 * 1024
+WARM_PROGRESS = 1024 * 1024 * 1024
+# Per send while shaping: what one reservation against a rate limit covers.
+SHAPED_CHUNK = 256 * 1024
+# Shaping: how often each download's share is worked out again, in seconds.
+REBALANCE = 0.25
+# A download that used less than its share may grow by this much per period.
+HEADROOM = 1.5
+# A client gets this long to send its request headers, in either mode.
+REQUEST_TIMEOUT = 30
+MAX_REQUEST_HEAD = 64 * 1024
+INSTALL_TARGET_RE = re.compile(r"^/dev/[a-zA-Z0-9._-]+$")
+# Multicast: file bytes per datagram, so header, UDP and IP fit a 1500 MTU.
+MULTICAST_BLOCK = 1400
+# Magic, session, block index; ghaf-image-fetch has the same.
+MULTICAST_HEADER = struct.Struct("!4sIQ")
+MULTICAST_MAGIC = b"GHMC"
+# How often --fleet checks its profile file for changes, in seconds.
+FLEET_POLL = 1.0
+# "Current" throughput is what was sent in this many seconds, averaged.
+RATE_WINDOW = 10
+
+
+class FleetError(Exception):
+    pass
+
+
+class LogWriter:
+    """Writes log lines to stderr from a thread of its own.
+
+    log() only queues its arguments; the formatting and the write, which
+    blocks for as long as whatever reads stderr is not keeping up, happen here.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            lines, item = [], self.queue.get()
+            # Whatever piled up meanwhile goes out in one write.
+            while item is not None:
+                client, fmt, args = item
+                lines.append(f"ghaf-netboot: {client} - {fmt % args}\n")
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            sys.stderr.write("".join(lines))
+            sys.stderr.flush()
+            if item is None:
+                return
+
+    def close(self):
+        """Write out everything logged so far; call once, on the way out."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+LOG = LogWriter()
+
+
+def log(client, fmt, *args):
+    LOG.queue.put((client, fmt, args))
 
 
 def normalise_mac(value):
@@ -47,44 +207,1265 @@ def normalise_mac(value):
     return None
 
 
+def boot_json(base, cmdline):
+    """The Pixiecore answer for one machine, serialised once, up front."""
+    return json.dumps(
+        {
+            "kernel": f"{base}/boot/bzImage",
+            "initrd": [f"{base}/boot/initrd"],
+            "cmdline": cmdline,
+            "message": "Ghaf netboot installer",
+        }
+    ).encode()
+
+
+def fleet_mac(url):
+    """The MAC a /fleet/<mac>/... URL path belongs to, or None."""
+    parts = url.split("/")
+    if len(parts) < 3 or parts[1] != "fleet":
+        return None
+    return normalise_mac(":".join(re.findall("..", parts[2])))
+
+
+def arp_mac(ip):
+    """The kernel's ARP table entry for `ip`, or None.
+
+    Targets are on our own layer-2 segment, so whoever is downloading has one.
+    """
+    try:
+        with open("/proc/net/arp", encoding="ascii") as f:
+            next(f)  # column headings
+            for line in f:
+                fields = line.split()
+                if fields[0] == ip and fields[3] != "00:00:00:00:00:00":
+                    return fields[3]
+    except (OSError, StopIteration, IndexError):
+        pass
+    return None
+
+
+class BootTable:
+    """Which machines boot, with what, and which files they may fetch.
+
+    Never modified once built: --fleet builds a new table on every reload and
+    swaps it in whole, so a request sees the old table or the new one, never
+    half of each.
+    """
+
+    def __init__(self, boots, files, profiles=None):
+        # MAC -> boot API response body.
+        self.boots = boots
+        # URL path -> StaticFile: everything that can be fetched.
+        self.files = files
+        # MAC -> profile name, for log lines; empty unless --fleet.
+        self.profiles = profiles or {}
+
+
+def base_cmdline(netboot):
+    """The kernel command line from the netboot installer's own netboot.ipxe.
+
+    The same rules as ghaf-netboot.sh: the `kernel` line minus the kernel
+    itself, the ${cmdline} placeholder and the builder's own image URL.
+    """
+    path = os.path.join(netboot, "netboot.ipxe")
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("kernel "):
+                words = line.split()[2:]
+                break
+        else:
+            raise FleetError(f"could not read a 'kernel' line from {path}")
+    words = [
+        w.replace("${cmdline}", "")
+        for w in words
+        if not w.startswith("ghaf.image_url=")
+    ]
+    cmdline = " ".join(w for w in words if w)
+    if "init=" not in cmdline:
+        raise FleetError(f"no init= in {path}; targets would get an emergency shell")
+    return cmdline
+
+
+def load_fleet(path, base, multicast=False):
+    """Build a BootTable from a --fleet profile file, or raise FleetError."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            fleet = json.load(f)
+        profiles = fleet["profiles"]
+        machines = fleet["machines"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise FleetError(f"{path}: {e}") from e
+
+    boots, files, names = {}, {}, {}
+    # Profiles share artefacts; stat each file once however often it is named.
+    static: dict[str, StaticFile] = {}
+    for raw, name in machines.items():
+        mac = normalise_mac(raw)
+        if mac is None:
+            raise FleetError(f"not a MAC address: {raw}")
+        profile = profiles.get(name)
+        if profile is None:
+            raise FleetError(f"{mac}: no profile named {name!r}")
+        netboot, image = profile.get("netboot"), profile.get("image")
+        if not netboot or not image:
+            raise FleetError(f"profile {name}: needs both netboot and image")
+        prefix = f"/fleet/{mac.replace(':', '')}"
+        served = {
+            f"{prefix}/boot/bzImage": os.path.join(netboot, "bzImage"),
+            f"{prefix}/boot/initrd": os.path.join(netboot, "initrd"),
+            f"{prefix}/ghaf-image/ghaf-image.raw.zst": os.path.join(
+                image, "ghaf-image.raw.zst"
+            ),
+            # Needed to verify the image; the installer will not write without.
+            f"{prefix}/ghaf-image/ghaf-image.bmap": os.path.join(
+                image, "ghaf-image.bmap"
+            ),
+        }
+        for url, file in served.items():
+            if file not in static:
+                try:
+                    static[file] = StaticFile(file, os.stat(file))
+                except OSError as e:
+                    raise FleetError(f"profile {name}: {file} missing") from e
+            files[url] = static[file]
+
+        try:
+            cmdline = base_cmdline(netboot)
+        except OSError as e:
+            raise FleetError(f"profile {name}: {e}") from e
+        cmdline += f" ghaf.image_url={base}{prefix}/ghaf-image"
+        if multicast:
+            cmdline += " ghaf.image_multicast"
+        target = profile.get("install_target")
+        if target:
+            # An unattended install wipes a disk with nobody watching.
+            if not INSTALL_TARGET_RE.match(target):
+                raise FleetError(
+                    f"profile {name}: install_target must look like /dev/nvme0n1"
+                )
+            cmdline += f" ghaf.install_target={target}"
+            if profile.get("encrypt"):
+                cmdline += " ghaf.install_encrypt"
+            if profile.get("secureboot"):
+                cmdline += " ghaf.install_secureboot"
+        if profile.get("cmdline"):
+            cmdline += f" {profile['cmdline']}"
+
+        boots[mac] = boot_json(f"{base}{prefix}", cmdline)
+        names[mac] = name
+    return BootTable(boots, files, names)
+
+
+class Service:
+    """What both servers serve: the boot API, the files and exit-after-serve.
+
+    `table` is replaced wholesale on a --fleet reload. Everything that reads it
+    takes one reference per request, so a reload mid-request is harmless.
+    """
+
+    def __init__(
+        self, table, exit_after_serve, shaper=None, multicast=None, warmer=None
+    ):
+        self.table = table
+        self.exit_after_serve = exit_after_serve
+        self.deliveries = Deliveries()
+        self.metrics = Metrics()
+        self.shaper = shaper or Shaper()
+        self.multicast = multicast
+        self.warmer = warmer
+        # Machines that have received their image in full: by MAC, from the
+        # fleet URL or the ARP table, and by client address.
+        self.installed: set[str] = set()
+        self.completed: set[str] = set()
+
+    def boot(self, raw_mac):
+        """Answer /v1/boot/<mac>: (status, JSON body or error message)."""
+        mac = normalise_mac(raw_mac)
+        if mac is None:
+            self.metrics.boot(None, "malformed")
+            return 400, "malformed MAC"
+        body = self.table.boots.get(mac)
+        if body is None:
+            # 404 is Pixiecore's "ignore this machine". This is the allowlist.
+            self.metrics.boot(mac, "miss")
+            return 404, f"{mac} not allowlisted"
+        if mac in self.installed:
+            # Its installer is about to reboot it; booting it again would
+            # reinstall it in a loop while the rest of the fleet finishes.
+            self.metrics.boot(mac, "served")
+            return 404, f"{mac} already served its image"
+        self.metrics.boot(mac, "hit")
+        return 200, body
+
+    def multicast_session(self, client, target):
+        """Answer /v1/multicast/<path>: (status, body or message, stop).
+
+        `?done=<session>` is the receiver reporting the whole file written,
+        which counts towards exit-after-serve as a complete download would;
+        `stop` is then whether the server should stop.
+        """
+        path, _, query = target[len("/v1/multicast") :].partition("?")
+        entry = self.resolve(path)
+        if self.multicast is None or entry is None or not path.endswith(".raw.zst"):
+            return 404, "no multicast for that", False
+        try:
+            entry = entry.current(os.stat(entry.path))
+        except OSError:
+            return 404, "no multicast for that", False
+        done = urllib.parse.parse_qs(query).get("done")
+        if done:
+            joined = self.multicast.joined_session(client, entry)
+            if joined is None or done[0] != str(joined):
+                return 409, f"not the session {client} joined", False
+            log(client, "multicast session %s: %s received in full", done[0], path)
+            return 200, b"{}", self.delivered(client, path, 0, entry.size, entry.size)
+        session = self.multicast.join(entry, client)
+        if session is None:
+            return 409, "a session is under way; fetch over HTTP", False
+        log(
+            client,
+            "joining multicast session %d, starting in %.0f s",
+            session["session"],
+            session["start"],
+        )
+        return 200, json.dumps(session).encode(), False
+
+    def resolve(self, target):
+        """The StaticFile a request target names, or None."""
+        return self.table.files.get(urllib.parse.unquote(target.split("?", 1)[0]))
+
+    def delivered(self, client, target, start, end, size):
+        """Record bytes sent; returns True when the server should now stop."""
+        if not self.exit_after_serve:
+            return False
+        url = urllib.parse.unquote(target.split("?", 1)[0])
+        if not self.deliveries.completes(client, url, start, end, size):
+            return False
+        table = self.table
+        if not table.profiles:
+            if self.multicast is None:
+                log(client, "image served in full, shutting down")
+                return True
+            return self.batch_served(client)
+        mac = fleet_mac(url)
+        self.installed.add(mac)
+        log(
+            client,
+            "image served in full to %s (%s); not booting it again",
+            mac,
+            table.profiles.get(mac),
+        )
+        if self.installed.issuperset(table.boots):
+            log(client, "every machine in the fleet is served, shutting down")
+            return True
+        return False
+
+    def batch_served(self, client):
+        """Whether a --multicast batch without --fleet is now all served.
+
+        Its machines install at once, so the first one done is not the last.
+        """
+        mac = arp_mac(client)
+        if mac is not None:
+            # Booting it again would reinstall it, as with --fleet.
+            self.installed.add(mac)
+        self.completed.add(client)
+        if self.installed.issuperset(self.table.boots):
+            log(client, "every allowlisted machine is served, shutting down")
+            return True
+        waiting = self.multicast.receivers() - self.completed
+        if not waiting:
+            log(client, "every multicast receiver is served, shutting down")
+            return True
+        log(
+            client,
+            "image served in full to %s; %d multicast receivers to go",
+            mac or client,
+            len(waiting),
+        )
+        return False
+
+
+def watch_fleet(path, base, service):
+    """Reload `path` into `service` whenever it changes, on a daemon thread."""
+
+    def identity():
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def poll():
+        seen = identity()
+        while True:
+            time.sleep(FLEET_POLL)
+            current = identity()
+            if current == seen:
+                continue
+            seen = current
+            try:
+                table = load_fleet(path, base, service.multicast is not None)
+            except FleetError as e:
+                log("fleet", "not reloading, keeping the previous profiles: %s", e)
+                continue
+            service.table = table
+            log("fleet", "reloaded %s: %s", path, describe(table))
+            if service.warmer is not None:
+                service.warmer.add(table)
+
+    threading.Thread(target=poll, daemon=True).start()
+
+
+def describe(table):
+    if not table.profiles:
+        return f"allowlist: {' '.join(sorted(table.boots))}"
+    return (
+        f"{len(table.boots)} machines in {len(set(table.profiles.values()))} profiles"
+    )
+
+
+def parse_ranges(header, size):
+    """Parse a Range header against a file of `size` bytes.
+
+    Returns a list of (start, end) half-open ranges, [] when no range is
+    satisfiable (a 416), or None when the header should be ignored and the
+    whole file sent, as RFC 9110 requires for anything malformed.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        m = RANGE_SPEC_RE.match(spec)
+        if m is None:
+            return None
+        first, last = m.groups()
+        if first:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+            if last and int(last) < start:
+                return None
+        elif last:
+            start = max(size - int(last), 0)
+            end = size
+        else:
+            return None
+        if start < end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def render_headers(headers):
+    return "".join(f"{name}: {value}\r\n" for name, value in headers).encode("latin-1")
+
+
+def response_head(status, headers, close):
+    """A status line and `headers` (already rendered), ready to write."""
+    return (
+        (
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            "Server: ghaf-netboot\r\n"
+            f"Date: {email.utils.formatdate(usegmt=True)}\r\n"
+            + ("Connection: close\r\n" if close else "")
+        ).encode("latin-1")
+        + headers
+        + b"\r\n"
+    )
+
+
+class StaticFile:
+    """One servable file, with everything about its responses worked out once."""
+
+    def __init__(self, path, st):
+        self.path = path
+        self.identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.ctype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.validators = render_headers(
+            [
+                ("Accept-Ranges", "bytes"),
+                ("ETag", self.etag),
+                ("Last-Modified", self.last_modified),
+            ]
+        )
+        self.full = (
+            render_headers(
+                [("Content-Type", self.ctype), ("Content-Length", str(self.size))]
+            )
+            + self.validators
+        )
+
+    def current(self, st):
+        """This entry if `st` is still the file it describes, else a fresh one.
+
+        Only the symlink farm's own files are ever in the table, but a file
+        replaced underneath a running server must not be served with the old
+        one's ETag and length.
+        """
+        if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) == self.identity:
+            return self
+        return StaticFile(self.path, st)
+
+
+def scan_root(root):
+    """URL path -> StaticFile for every file under `root`, links followed."""
+    files = {}
+    for dirpath, _, names in os.walk(root, followlinks=True):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            url = "/" + os.path.relpath(path, root).replace(os.sep, "/")
+            try:
+                files[url] = StaticFile(path, os.stat(path))
+            except OSError:
+                continue  # a dangling link is simply not served
+    return files
+
+
+def sequential(f):
+    """Tell the kernel `f` is read front to back, for a larger readahead."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass  # only a hint
+
+
+def mem_available():
+    """MemAvailable from /proc/meminfo in bytes, or infinity if unknown."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return math.inf
+
+
+class CacheWarmer:
+    """Reads servable files into the page cache before anyone asks for them.
+
+    One thread, smallest file first, so the kernel and initrd are warm within
+    seconds and the image follows. A file that would take more than the memory
+    left is skipped: reading it would only evict its own start for its end.
+    """
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        # StaticFile.identity of everything queued, so a reload adds only news.
+        self.queued: set[tuple] = set()
+        # Bytes queued so far, and read so far; one writer each.
+        self.total = 0
+        self.done = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, table):
+        """Queue the files in `table` not warmed yet; returns the bytes queued."""
+        entries = {
+            entry.identity: entry
+            for entry in table.files.values()
+            if entry.identity not in self.queued
+        }
+        # MemAvailable counts clean page cache as available, ours included.
+        budget = mem_available() - self.total
+        queued = 0
+        for entry in sorted(entries.values(), key=lambda entry: entry.size):
+            if queued + entry.size > budget:
+                log("page cache", "not warming %s: too big for free memory", entry.path)
+                continue
+            self.queued.add(entry.identity)
+            self.queue.put(entry)
+            queued += entry.size
+        self.total += queued
+        return queued
+
+    def run(self):
+        buf = bytearray(WARM_CHUNK)
+        while True:
+            entry = self.queue.get()
+            # Idle until now: the rate is for this burst of work only.
+            started, base = time.monotonic(), self.done
+            logged = self.done
+            while True:
+                try:
+                    with open(entry.path, "rb", buffering=0) as f:
+                        sequential(f)
+                        while n := f.readinto(buf):
+                            self.done += n
+                            if self.done - logged >= WARM_PROGRESS:
+                                logged = self.done
+                                self.progress(started, base)
+                except OSError as e:
+                    log("page cache", "could not warm %s: %s", entry.path, e)
+                if self.queue.empty():
+                    break
+                entry = self.queue.get()
+            self.progress(started, base)
+
+    def progress(self, started, base):
+        elapsed = max(time.monotonic() - started, 1e-3)
+        log(
+            "page cache",
+            "%s %.1f of %.1f GB, %.0f MB/s",
+            "warm," if self.done >= self.total else "warming,",
+            self.done / 1e9,
+            self.total / 1e9,
+            (self.done - base) / elapsed / 1e6,
+        )
+
+
+def not_modified(entry, headers):
+    """True when a conditional GET's cached copy is still this file."""
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or entry.etag in tags
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return entry.mtime <= since.timestamp()
+
+
+def file_response(entry, headers):
+    """Work out the response to a GET of a file, whichever server sends it.
+
+    Returns (status, rendered response headers, parts), where each part is a
+    prefix to write followed by a [start, end) range of the file to send.
+    """
+    size = entry.size
+    if not_modified(entry, headers):
+        return 304, entry.validators, []
+
+    ranges = None
+    if_range = headers.get("If-Range")
+    # If-Range with a stale validator means "send me the whole new file". A
+    # date only validates when it is exactly our Last-Modified.
+    if "Range" in headers and if_range in (None, entry.etag, entry.last_modified):
+        ranges = parse_ranges(headers["Range"], size)
+
+    if ranges == []:
+        return (
+            416,
+            render_headers(
+                [("Content-Range", f"bytes */{size}"), ("Content-Length", "0")]
+            ),
+            [],
+        )
+    if ranges is None:
+        return 200, entry.full, [(b"", 0, size)]
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        head = render_headers(
+            [
+                ("Content-Type", entry.ctype),
+                ("Content-Range", f"bytes {start}-{end - 1}/{size}"),
+                ("Content-Length", str(end - start)),
+            ]
+        )
+        return 206, head + entry.validators, [(b"", start, end)]
+    boundary = uuid.uuid4().hex
+    parts = [
+        (
+            (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {entry.ctype}\r\n"
+                f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n"
+            ).encode(),
+            start,
+            end,
+        )
+        for start, end in ranges
+    ]
+    parts.append((f"\r\n--{boundary}--\r\n".encode(), 0, 0))
+    length = sum(len(prefix) + end - start for prefix, start, end in parts)
+    head = render_headers(
+        [
+            ("Content-Type", f"multipart/byteranges; boundary={boundary}"),
+            ("Content-Length", str(length)),
+        ]
+    )
+    return 206, head + entry.validators, parts
+
+
+class Deliveries:
+    """Which bytes of the image each client has actually been sent.
+
+    A download that resumes, or splits the image across parallel ranges, only
+    counts as complete once the union of what reached the client covers the
+    whole file. A repeated or aborted fetch never does.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received: dict[tuple[str, str], list[list[int]]] = {}
+
+    def add(self, client, path, start, end):
+        """Record [start, end) as sent; return the client's bytes covered."""
+        with self.lock:
+            spans = self.received.setdefault((client, path), [])
+            spans.append([start, end])
+            spans.sort()
+            merged = [spans[0]]
+            for span in spans[1:]:
+                if span[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], span[1])
+                else:
+                    merged.append(span)
+            spans[:] = merged
+            return sum(e - s for s, e in merged)
+
+    def completes(self, client, path, start, end, size):
+        """Record a send; True once it leaves `client` holding the whole image.
+
+        The image is the last and largest thing a client fetches, so once every
+        byte of it has reached one client, this install has what it needs and
+        exit-after-serve can stop rather than sit on the LAN answering PXE for
+        the rest of the day.
+        """
+        if not path.endswith(".raw.zst"):
+            return False
+        return self.add(client, path, start, end) == size
+
+
+class Flow:
+    """One download's place in a Shaper; a context manager around the body."""
+
+    def __init__(self, shaper, client, size):
+        self.shaper = shaper
+        self.client = client
+        self.remaining = size
+        self.rate = math.inf
+        # When the next byte may go; lagging now by at most one chunk.
+        self.next = 0.0
+        # Bytes reserved since `since`, for how much of its share it used.
+        self.taken = 0
+        self.since = time.monotonic()
+        # What it has shown it can take; unknown until a period has passed.
+        self.demand = math.inf
+
+    def __enter__(self):
+        with self.shaper.lock:
+            self.shaper.flows.add(self)
+            self.shaper.stale = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.shaper.lock:
+            self.shaper.flows.discard(self)
+            self.shaper.stale = True
+
+    def take(self, count):
+        """Reserve `count` bytes; returns the seconds to wait before sending."""
+        shaper = self.shaper
+        if not shaper.limited:
+            return 0.0
+        now = time.monotonic()
+        with shaper.lock:
+            if shaper.stale or now - shaper.updated >= REBALANCE:
+                shaper.rebalance(now)
+            self.remaining -= count
+            self.taken += count
+            start = max(self.next, now - shaper.chunk / self.rate)
+            self.next = start + count / self.rate
+        return max(start - now, 0.0)
+
+
+class Shaper:
+    """Paces file downloads under a global and a per-client rate limit.
+
+    Each download sends at the rate its Flow is given, recomputed every
+    REBALANCE seconds. The global limit is shared in proportion to the bytes
+    each download has left: a machine that is behind gets more, so a batch
+    converges on finishing together, at total bytes / limit, instead of the
+    last machine finishing long after the others. Shares are water-filled,
+    so a download that cannot use its share -- a slow link, a stalled
+    installer -- is held to what it has shown it can take, HEADROOM to grow,
+    and the rest goes to the others. A client's own limit is split among its
+    connections the same way.
+    """
+
+    def __init__(self, total=None, per_client=None):
+        self.total = total
+        self.per_client = per_client
+        self.limited = bool(total or per_client)
+        self.chunk = SHAPED_CHUNK if self.limited else SENDFILE_CHUNK
+        self.lock = threading.Lock()
+        self.flows: set[Flow] = set()
+        self.stale = False
+        self.updated = 0.0
+
+    def flow(self, client, parts):
+        """A Flow for sending `parts` of a file to `client`."""
+        return Flow(self, client, sum(end - start for _, start, end in parts))
+
+    def rebalance(self, now):
+        """Work out every flow's rate again; called with the lock held."""
+        clients: dict[str, list[Flow]] = {}
+        for flow in self.flows:
+            clients.setdefault(flow.client, []).append(flow)
+            if now - flow.since >= REBALANCE:
+                rate = flow.taken / (now - flow.since)
+                flow.demand = max(rate * HEADROOM, self.chunk / REBALANCE)
+                flow.taken, flow.since = 0, now
+
+        # (flow, weight, the most it may have); a floor of one chunk, so a
+        # download's last few bytes do not crawl.
+        shares = []
+        for flows in clients.values():
+            weights = [max(flow.remaining, self.chunk) for flow in flows]
+            for flow, weight in zip(flows, weights, strict=True):
+                limit = math.inf
+                if self.per_client:
+                    limit = self.per_client * weight / sum(weights)
+                shares.append((flow, weight, limit))
+
+        if self.total is None:
+            # Nothing to hand on to anyone else: just the client's own limit.
+            for flow, _, limit in shares:
+                flow.rate = limit
+        else:
+            shares = [
+                (flow, weight, min(limit, flow.demand))
+                for flow, weight, limit in shares
+            ]
+            # Water-filling: the most constrained flows are settled first, and
+            # whatever they cannot use is shared among the rest.
+            shares.sort(key=lambda share: share[2] / share[1])
+            budget = self.total
+            weight_left = sum(weight for _, weight, _ in shares)
+            for flow, weight, cap in shares:
+                flow.rate = max(min(budget * weight / weight_left, cap), 1.0)
+                budget = max(budget - flow.rate, 0.0)
+                weight_left -= weight
+        self.updated = now
+        self.stale = False
+
+
+class MulticastSession:
+    """One file, sent once to whoever joined before `start`."""
+
+    def __init__(self, number, entry, start):
+        self.number = number
+        self.entry = entry
+        self.start = start
+        self.receivers: set[str] = set()
+        self.sending = False
+        self.finished = False
+
+
+class Multicast:
+    """Sends files to --multicast receivers, one session per batch.
+
+    Senders are paced, since UDP has no congestion control: each session goes
+    out at `rate` bytes/s from a thread of its own, whichever server is
+    answering HTTP.
+    """
+
+    def __init__(self, group, port, interface, rate, wait):
+        self.group = group
+        self.port = port
+        self.rate = rate
+        self.wait = wait
+        self.lock = threading.Lock()
+        # StaticFile path -> the latest session for it.
+        self.sessions: dict[str, MulticastSession] = {}
+        # (client, StaticFile path) -> the session that client last joined.
+        self.joined: dict[tuple[str, str], int] = {}
+        self.count = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # One hop: installers are on our own segment, and nowhere else should
+        # see a multi-GB stream.
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+        )
+        # Receivers on this host, i.e. the loopback benchmark.
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def join(self, entry, client):
+        """Session details for `client` to receive `entry`, or None if too late."""
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(entry.path)
+            if session is None or session.finished:
+                self.count += 1
+                session = MulticastSession(self.count, entry, now + self.wait)
+                self.sessions[entry.path] = session
+                threading.Thread(target=self.send, args=(session,), daemon=True).start()
+            elif session.sending:
+                return None
+            session.receivers.add(client)
+            self.joined[client, entry.path] = session.number
+        return {
+            "group": self.group,
+            "port": self.port,
+            "session": session.number,
+            "size": session.entry.size,
+            "block": MULTICAST_BLOCK,
+            "start": round(max(session.start - now, 0.0), 3),
+        }
+
+    def joined_session(self, client, entry):
+        """The session `client` last joined for `entry`, or None."""
+        with self.lock:
+            return self.joined.get((client, entry.path))
+
+    def receivers(self):
+        """Every client that has joined a session."""
+        with self.lock:
+            return {client for client, _ in self.joined}
+
+    def send(self, session):
+        time.sleep(max(session.start - time.monotonic(), 0.0))
+        with self.lock:
+            session.sending = True
+        log(
+            "multicast",
+            "session %d: %s to %d receivers at %g Mbit/s",
+            session.number,
+            session.entry.path,
+            len(session.receivers),
+            self.rate / 125_000,
+        )
+        started = time.monotonic()
+        try:
+            self.stream(session)
+        except OSError as e:
+            log(
+                "multicast",
+                "session %d failed, receivers repair: %s",
+                session.number,
+                e,
+            )
+        else:
+            log(
+                "multicast",
+                "session %d: sent in %.1f s",
+                session.number,
+                time.monotonic() - started,
+            )
+        finally:
+            with self.lock:
+                session.finished = True
+
+    def stream(self, session):
+        destination = (self.group, self.port)
+        index = sent = 0
+        started = time.monotonic()
+        with open(session.entry.path, "rb") as f:
+            sequential(f)
+            # A burst of this many blocks, then a pause to keep to the rate:
+            # small enough for a receiver's socket buffer to absorb.
+            while chunk := f.read(MULTICAST_BLOCK * 64):
+                with memoryview(chunk) as view:
+                    for offset in range(0, len(chunk), MULTICAST_BLOCK):
+                        parts = [
+                            MULTICAST_HEADER.pack(
+                                MULTICAST_MAGIC, session.number, index
+                            ),
+                            view[offset : offset + MULTICAST_BLOCK],
+                        ]
+                        while True:
+                            try:
+                                self.sock.sendmsg(parts, (), 0, destination)
+                                break
+                            except OSError as e:
+                                if e.errno != errno.ENOBUFS:
+                                    raise
+                                time.sleep(0.001)  # the queue is full; let it drain
+                        index += 1
+                sent += len(chunk)
+                ahead = started + sent / self.rate - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+# Metric name -> (type, help), in the order they are exposed.
+METRICS = {
+    "ghaf_netboot_sent_bytes_total": (
+        "counter",
+        "File body bytes sent to the client.",
+    ),
+    "ghaf_netboot_transfers_total": (
+        "counter",
+        "File downloads finished, by whether every byte was sent.",
+    ),
+    "ghaf_netboot_transfers_active": ("gauge", "File downloads in progress."),
+    "ghaf_netboot_throughput_bytes_per_second": (
+        "gauge",
+        f"Send rate over the last {RATE_WINDOW} seconds.",
+    ),
+    "ghaf_netboot_average_throughput_bytes_per_second": (
+        "gauge",
+        "Bytes sent per second while the client had a download in progress.",
+    ),
+    "ghaf_netboot_ttfb_seconds": (
+        "summary",
+        "From a file request arriving to its response headers being sent.",
+    ),
+    "ghaf_netboot_boot_requests_total": (
+        "counter",
+        "Boot API requests by result: hit, miss, served or malformed.",
+    ),
+}
+
+
+class ClientStats:
+    """Everything Metrics keeps about one client address."""
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.bytes = 0
+        self.completed = 0
+        self.aborted = 0
+        self.active = 0
+        # Seconds with at least one download in progress, up to busy_since.
+        self.busy = 0.0
+        self.busy_since = 0.0
+        self.ttfb_sum = 0.0
+        self.ttfb_count = 0
+        # [second, bytes sent in it] for the last RATE_WINDOW seconds.
+        self.recent: collections.deque[list[int]] = collections.deque()
+
+    def expire(self, now):
+        while self.recent and self.recent[0][0] <= now - RATE_WINDOW:
+            self.recent.popleft()
+
+
+class Transfer:
+    """One file response body on its way to a client.
+
+    Created once the response headers are out, which is the time to first
+    byte; used as a context manager around sending the body, which counts as
+    aborted if it raises or stops short.
+    """
+
+    def __init__(self, metrics, stats, started, expected):
+        self.metrics = metrics
+        self.stats = stats
+        self.expected = expected
+        self.sent_bytes = 0
+        now = time.monotonic()
+        with metrics.lock:
+            stats.ttfb_sum += now - started
+            stats.ttfb_count += 1
+
+    def __enter__(self):
+        with self.metrics.lock:
+            if not self.stats.active:
+                self.stats.busy_since = time.monotonic()
+            self.stats.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stats = self.stats
+        with self.metrics.lock:
+            if exc_type is None and self.sent_bytes == self.expected:
+                stats.completed += 1
+            else:
+                stats.aborted += 1
+            stats.active -= 1
+            if not stats.active:
+                stats.busy += time.monotonic() - stats.busy_since
+
+    def sent(self, count):
+        now = time.monotonic()
+        second = int(now)
+        stats = self.stats
+        with self.metrics.lock:
+            self.sent_bytes += count
+            stats.bytes += count
+            if stats.recent and stats.recent[-1][0] == second:
+                stats.recent[-1][1] += count
+            else:
+                stats.recent.append([second, count])
+            stats.expire(now)
+
+
+class Metrics:
+    """Per-client transfer and per-MAC boot API counters, for /metrics.
+
+    Clients are keyed by address, the only thing a download carries; the MAC
+    label comes from a /fleet/<mac>/ URL or, failing that, the ARP table.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients: dict[str, ClientStats] = {}
+        # (MAC or None, result) -> count.
+        self.boots: collections.Counter[tuple[str | None, str]] = collections.Counter()
+
+    def boot(self, mac, result):
+        with self.lock:
+            self.boots[mac, result] += 1
+
+    def transfer(self, client, target, started, parts):
+        """A Transfer for sending `parts` of a file in answer to `target`."""
+        mac = fleet_mac(urllib.parse.unquote(target.split("?", 1)[0]))
+        with self.lock:
+            stats = self.clients.get(client)
+        if stats is None:
+            # Outside the lock: a file read, once per client.
+            stats = ClientStats(mac or arp_mac(client))
+            with self.lock:
+                stats = self.clients.setdefault(client, stats)
+        expected = sum(end - start for _, start, end in parts)
+        return Transfer(self, stats, started, expected)
+
+    def render(self):
+        """Everything, in the Prometheus text exposition format."""
+        now = time.monotonic()
+        samples: dict[str, list[str]] = {name: [] for name in METRICS}
+
+        def add(name, labels, value, suffix=""):
+            text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            samples[name].append(f"{name}{suffix}{{{text}}} {value}")
+
+        with self.lock:
+            for client, stats in sorted(self.clients.items()):
+                labels = {"client": client}
+                if stats.mac:
+                    labels["mac"] = stats.mac
+                busy = stats.busy
+                if stats.active:
+                    busy += now - stats.busy_since
+                stats.expire(now)
+                recent = sum(count for _, count in stats.recent)
+                add("ghaf_netboot_sent_bytes_total", labels, stats.bytes)
+                for result in ("completed", "aborted"):
+                    add(
+                        "ghaf_netboot_transfers_total",
+                        labels | {"result": result},
+                        getattr(stats, result),
+                    )
+                add("ghaf_netboot_transfers_active", labels, stats.active)
+                add(
+                    "ghaf_netboot_throughput_bytes_per_second",
+                    labels,
+                    round(recent / RATE_WINDOW),
+                )
+                add(
+                    "ghaf_netboot_average_throughput_bytes_per_second",
+                    labels,
+                    round(stats.bytes / busy) if busy else 0,
+                )
+                add("ghaf_netboot_ttfb_seconds", labels, stats.ttfb_sum, "_sum")
+                add("ghaf_netboot_ttfb_seconds", labels, stats.ttfb_count, "_count")
+            for (mac, result), count in sorted(
+                self.boots.items(), key=lambda item: (item[0][0] or "", item[0][1])
+            ):
+                labels = {"mac": mac} if mac else {}
+                add(
+                    "ghaf_netboot_boot_requests_total",
+                    labels | {"result": result},
+                    count,
+                )
+
+        lines = []
+        for name, (kind, text) in METRICS.items():
+            if samples[name]:
+                lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                lines += samples[name]
+        return "".join(f"{line}\n" for line in lines)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics, and nothing else; bound to loopback by main()."""
+
+    metrics: ClassVar[Metrics]
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = type(self).metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass  # a scrape every few seconds is not worth a log line each
+
+
+def serve_metrics(port, metrics):
+    """Serve `metrics` on 127.0.0.1:`port` from a daemon thread."""
+    MetricsHandler.metrics = metrics
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
 class Handler(http.server.SimpleHTTPRequestHandler):
+    # Keep-alive: every response carries a Content-Length, so the stock request
+    # loop can read the next request off the same connection.
+    protocol_version = "HTTP/1.1"
+    # Headers go out in one write and bodies in large ones, so Nagle only ever
+    # holds back the tail of a small response -- for the delayed-ACK timeout,
+    # 40 ms, on every multicast repair request. asyncio sets this by default.
+    disable_nagle_algorithm = True
+    # The same keep-alive idle timeout as EventLoopServer's; it also drops a
+    # client that takes no data for that long, where a thread would block.
+    timeout = REQUEST_TIMEOUT
+
     # Set by main(); class attributes so every thread sees the same values.
-    allowed: ClassVar[frozenset] = frozenset()
-    boot_json: ClassVar[dict] = {}
-    exit_after_serve: ClassVar[bool] = False
+    service: ClassVar[Service]
+    use_sendfile: ClassVar[bool] = hasattr(os, "sendfile")
 
     def log_message(self, fmt, *args):
-        sys.stderr.write(f"ghaf-netboot: {self.address_string()} - {fmt % args}\n")
+        log(self.address_string(), fmt, *args)
+
+    def version_string(self):
+        return "ghaf-netboot"
+
+    def parse_request(self):
+        # The request line is in; time to first byte counts from here.
+        self.started = time.monotonic()
+        return super().parse_request()
 
     def do_GET(self):
         if self.path.startswith("/v1/boot/"):
             return self.serve_boot_api(self.path[len("/v1/boot/") :])
+        if self.path.startswith("/v1/multicast/"):
+            return self.serve_multicast_api()
+        return self.serve_static(head=False)
 
-        result = super().do_GET()
+    def do_HEAD(self):
+        return self.serve_static(head=True)
+
+    def serve_static(self, head):
+        entry = type(self).service.resolve(self.path)
+        if entry is None:
+            self.send_error(404, "File not found")
+            return
+        try:
+            f = open(entry.path, "rb")  # noqa: SIM115 -- closed by the with below
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            sequential(f)
+            entry = entry.current(os.fstat(f.fileno()))
+            status, headers, parts = file_response(entry, self.headers)
+            self.log_request(status)
+            self.wfile.write(response_head(status, headers, self.close_connection))
+            if head or not parts:
+                return
+            service = type(self).service
+            with (
+                service.metrics.transfer(
+                    self.client_address[0], self.path, self.started, parts
+                ) as self.transfer,
+                service.shaper.flow(self.client_address[0], parts) as self.flow,
+            ):
+                for prefix, start, end in parts:
+                    self.wfile.write(prefix)
+                    self.copy_range(f, start, end, entry.size)
 
-        # The image is the last and largest thing a client fetches, so a
-        # completed transfer of it means this install has what it needs. Shut
-        # down rather than sit on the LAN answering PXE for the rest of the day.
-        if type(self).exit_after_serve and self.path.endswith(".raw.zst"):
-            self.log_message("image served in full, shutting down")
+    def copy_range(self, f, start, end, size):
+        """Send [start, end) of f, recording each byte that left the socket."""
+        if type(self).use_sendfile:
+            start = self.sendfile_range(f, start, end, size)
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            count = min(COPY_CHUNK, self.flow.shaper.chunk, remaining)
+            if delay := self.flow.take(count):
+                time.sleep(delay)
+            chunk = f.read(count)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            self.delivered(start, start + len(chunk), size)
+            start += len(chunk)
+            remaining -= len(chunk)
+
+    def sendfile_range(self, f, start, end, size):
+        """sendfile() [start, end) to the client; returns where it stopped.
+
+        Stops short only if the file cannot be sendfile()d at all, leaving the
+        rest to the copying loop; any other error is the client going away.
+        """
+        sock = self.connection.fileno()
+        writable = select.poll()
+        writable.register(sock, select.POLLOUT)
+        first = True
+        while start < end:
+            count = min(self.flow.shaper.chunk, end - start)
+            if delay := self.flow.take(count):
+                time.sleep(delay)
+            try:
+                sent = self.sendfile_waiting(writable, sock, f, start, count)
+            except OSError as e:
+                if first and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    return start
+                raise
+            if sent == 0:
+                return end  # the file shrank under us; nothing more to send
+            first = False
+            self.delivered(start, start + sent, size)
+            start += sent
+        return end
+
+    def sendfile_waiting(self, writable, sock, f, start, count):
+        """os.sendfile(), waiting up to the timeout for room to send.
+
+        The timeout makes the socket non-blocking underneath, so a full send
+        buffer is EAGAIN rather than a wait.
+        """
+        while True:
+            try:
+                return os.sendfile(sock, f.fileno(), start, count)
+            except BlockingIOError:
+                if not writable.poll(self.timeout * 1000):
+                    raise TimeoutError("send timed out") from None
+
+    def delivered(self, start, end, size):
+        self.transfer.sent(end - start)
+        if type(self).service.delivered(
+            self.client_address[0], self.path, start, end, size
+        ):
             # shutdown() blocks until serve_forever() returns, so it can never
             # be called from a request thread -- hence the extra thread.
             threading.Thread(target=self.server.shutdown, daemon=True).start()
-        return result
 
     def serve_boot_api(self, raw_mac):
-        mac = normalise_mac(raw_mac)
-        if mac is None:
-            self.send_error(400, "malformed MAC")
+        status, body = type(self).service.boot(raw_mac)
+        if status != 200:
+            if status == 404:
+                self.log_message("ignoring %s", body)
+            self.send_error(status, body)
             return
-        if mac not in type(self).allowed:
-            # 404 is Pixiecore's "ignore this machine". This is the allowlist.
-            self.log_message("ignoring %s (not in allowlist)", mac)
-            self.send_error(404, "not allowlisted")
+
+        self.log_message("booting %s", normalise_mac(raw_mac))
+        self.send_json(body)
+
+    def serve_multicast_api(self):
+        service = type(self).service
+        status, body, stop = service.multicast_session(
+            self.client_address[0], self.path
+        )
+        if status != 200:
+            self.send_error(status, body)
             return
+        self.send_json(body)
+        if stop:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
 
-        body = json.dumps(type(self).boot_json).encode()
-        self.log_message("booting %s", mac)
+    def send_json(self, body):
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(body)))
@@ -97,9 +1478,166 @@ class Server(socketserver.ThreadingTCPServer):
     allow_reuse_address = True
 
 
+class EventLoopServer:
+    """The same HTTP service as Handler/Server, on a single asyncio loop.
+
+    Speaks just enough HTTP/1.1 for Pixiecore, iPXE and the installer's
+    downloads: GET and HEAD, with keep-alive. File bodies go out with the
+    loop's non-blocking sendfile, so no client can stall another.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.done = asyncio.Event()
+        self.clients = set()
+
+    async def serve(self, listen, port, ready):
+        server = await asyncio.start_server(
+            self.client, listen, port, reuse_address=True, limit=MAX_REQUEST_HEAD
+        )
+        async with server:
+            ready()
+            await self.done.wait()
+            # Connections idling on keep-alive would otherwise be cancelled by
+            # asyncio.run after the loop is done with them; end each one here,
+            # while its writer can still be closed cleanly.
+            server.close()
+            for task in self.clients:
+                task.cancel()
+            await asyncio.gather(*self.clients, return_exceptions=True)
+
+    async def client(self, reader, writer):
+        peer = writer.get_extra_info("peername")[0]
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            while await self.handle(peer, reader, writer):
+                pass
+        except (ConnectionError, TimeoutError, asyncio.IncompleteReadError):
+            pass  # the client went away; nothing to tell it
+        except asyncio.LimitOverrunError:
+            await self.send_error(writer, 431)
+        except asyncio.CancelledError:
+            pass  # serve() is stopping; close the connection below
+        finally:
+            self.clients.discard(task)
+            writer.close()
+
+    async def handle(self, peer, reader, writer):
+        """Answer one request; returns whether the connection stays open."""
+        # Also the keep-alive idle timeout: a quiet connection is closed.
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        started = time.monotonic()
+        request_line, _, rest = head.partition(b"\r\n")
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            await self.send_error(writer, 400)
+            return False
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        request = f'"{method} {target} {version}"'
+        connection = headers.get("Connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        if method not in ("GET", "HEAD"):
+            log(peer, "%s %d -", request, 501)
+            await self.send_error(writer, 501)
+            return False
+        if method == "GET" and target.startswith("/v1/boot/"):
+            status, body = self.service.boot(target[len("/v1/boot/") :])
+            if status == 200:
+                log(peer, "booting %s", normalise_mac(target[len("/v1/boot/") :]))
+                await self.send_json(writer, body, close=not keep_alive)
+            else:
+                if status == 404:
+                    log(peer, "ignoring %s", body)
+                await self.send_error(writer, status, body, close=not keep_alive)
+            log(peer, "%s %d -", request, status)
+            return keep_alive
+        if method == "GET" and target.startswith("/v1/multicast/"):
+            status, body, stop = self.service.multicast_session(peer, target)
+            if status == 200:
+                await self.send_json(writer, body, close=not keep_alive)
+            else:
+                await self.send_error(writer, status, body, close=not keep_alive)
+            log(peer, "%s %d -", request, status)
+            if stop:
+                self.done.set()
+            return keep_alive
+
+        entry = self.service.resolve(target)
+        if entry is None:
+            log(peer, "%s %d -", request, 404)
+            await self.send_error(writer, 404, "File not found", close=not keep_alive)
+            return keep_alive
+        # Local and almost certainly cached: not worth a trip to a thread.
+        try:
+            f = open(entry.path, "rb")  # noqa: ASYNC230, SIM115 -- closed by the with below
+        except OSError:
+            log(peer, "%s %d -", request, 404)
+            await self.send_error(writer, 404, "File not found", close=not keep_alive)
+            return keep_alive
+        with f:
+            sequential(f)
+            entry = entry.current(os.fstat(f.fileno()))
+            status, response_headers, parts = file_response(entry, headers)
+            log(peer, "%s %d -", request, status)
+            writer.write(response_head(status, response_headers, not keep_alive))
+            if method == "HEAD" or not parts:
+                await writer.drain()
+                return keep_alive
+            loop = asyncio.get_running_loop()
+            with (
+                self.service.metrics.transfer(peer, target, started, parts) as transfer,
+                self.service.shaper.flow(peer, parts) as flow,
+            ):
+                for prefix, start, end in parts:
+                    writer.write(prefix)
+                    while start < end:
+                        count = min(flow.shaper.chunk, end - start)
+                        if delay := flow.take(count):
+                            await asyncio.sleep(delay)
+                        # Flushes what writer.write() buffered first, then uses
+                        # os.sendfile on the non-blocking socket.
+                        sent = await loop.sendfile(writer.transport, f, start, count)
+                        if sent == 0:
+                            return False  # the file shrank under us
+                        transfer.sent(sent)
+                        if self.service.delivered(
+                            peer, target, start, start + sent, entry.size
+                        ):
+                            self.done.set()
+                        start += sent
+                await writer.drain()
+        return keep_alive
+
+    @staticmethod
+    async def send_json(writer, body, close):
+        headers = render_headers(
+            [("Content-Type", "application/json"), ("Content-Length", str(len(body)))]
+        )
+        writer.write(response_head(200, headers, close) + body)
+        await writer.drain()
+
+    @staticmethod
+    async def send_error(writer, status, message=None, close=True):
+        body = f"{status} {message or HTTPStatus(status).phrase}\n".encode()
+        headers = render_headers(
+            [
+                ("Content-Type", "text/plain; charset=utf-8"),
+                ("Content-Length", str(len(body))),
+            ]
+        )
+        writer.write(response_head(status, headers, close) + body)
+        await writer.drain()
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--root", required=True, help="directory to serve")
+    ap.add_argument("--root", help="directory to serve")
     ap.add_argument("--listen", required=True, help="address to bind")
     ap.add_argument("--port", type=int, required=True)
     ap.add_argument(
@@ -108,44 +1646,183 @@ def main():
         default=[],
         help="allowlisted client MAC; repeatable. No MACs means no machine boots.",
     )
-    ap.add_argument("--cmdline", required=True, help="kernel command line")
+    ap.add_argument("--cmdline", help="kernel command line")
+    ap.add_argument(
+        "--fleet",
+        metavar="FILE",
+        help="per-MAC boot profiles, reloaded on change; replaces "
+        "--root, --mac and --cmdline",
+    )
     ap.add_argument(
         "--exit-after-serve",
         action="store_true",
-        help="stop once the image has been fetched in full",
+        help="stop once the image has been fetched in full (with --fleet: by "
+        "every machine, and each is not booted again once it has been; with "
+        "--multicast: by every receiver or every allowlisted machine)",
+    )
+    ap.add_argument(
+        "--check",
+        action="store_true",
+        help="print what each machine would be told, then exit",
+    )
+    ap.add_argument(
+        "--no-sendfile",
+        action="store_true",
+        help="copy file bodies through Python instead of using sendfile(2)",
+    )
+    ap.add_argument(
+        "--event-loop",
+        action="store_true",
+        help="serve every client from one asyncio loop instead of a thread each",
+    )
+    ap.add_argument(
+        "--warm-cache",
+        action="store_true",
+        help="read every servable file into the page cache in the background, "
+        "so the first client does not wait on the disk",
+    )
+    ap.add_argument(
+        "--rate-limit",
+        type=float,
+        metavar="MBIT",
+        help="cap all downloads together at MBIT Mbit/s, shared so a batch of "
+        "machines finishes together",
+    )
+    ap.add_argument(
+        "--client-rate-limit",
+        type=float,
+        metavar="MBIT",
+        help="cap each client's downloads at MBIT Mbit/s",
+    )
+    ap.add_argument(
+        "--multicast",
+        metavar="GROUP:PORT",
+        help="offer installers with ghaf.image_multicast the image over this "
+        "multicast group, one session per batch",
+    )
+    ap.add_argument(
+        "--multicast-rate",
+        type=float,
+        default=400,
+        metavar="MBIT",
+        help="send rate of each multicast session in Mbit/s (default: 400)",
+    )
+    ap.add_argument(
+        "--multicast-wait",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+        help="how long a session waits for more receivers to join (default: 30)",
+    )
+    ap.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics",
     )
     args = ap.parse_args()
-    Handler.exit_after_serve = args.exit_after_serve
+    if args.no_sendfile:
+        Handler.use_sendfile = False
+    for limit in (args.rate_limit, args.client_rate_limit):
+        if limit is not None and limit <= 0:
+            ap.error("rate limits are in Mbit/s and must be positive")
+
+    multicast = None
+    if args.multicast:
+        group, _, port = args.multicast.rpartition(":")
+        try:
+            if not ipaddress.IPv4Address(group).is_multicast:
+                raise ValueError(group)
+            port = int(port)
+        except ValueError:
+            ap.error("--multicast takes an IPv4 multicast GROUP:PORT")
+        if args.multicast_rate <= 0 or args.multicast_wait < 0:
+            ap.error("--multicast-rate must be positive, --multicast-wait not negative")
+        multicast = Multicast(
+            group, port, args.listen, args.multicast_rate * 125_000, args.multicast_wait
+        )
 
     base = f"http://{args.listen}:{args.port}"
-    Handler.boot_json = {
-        "kernel": f"{base}/boot/bzImage",
-        "initrd": [f"{base}/boot/initrd"],
-        "cmdline": args.cmdline,
-        "message": "Ghaf netboot installer",
-    }
-
-    macs = set()
-    for raw in args.mac:
-        mac = normalise_mac(raw)
-        if mac is None:
-            sys.exit(f"ghaf-netboot: not a MAC address: {raw}")
-        macs.add(mac)
-    Handler.allowed = frozenset(macs)
-    if not macs:
+    if args.fleet:
+        if args.root or args.mac or args.cmdline:
+            ap.error("--fleet replaces --root, --mac and --cmdline")
+        try:
+            table = load_fleet(args.fleet, base, multicast is not None)
+        except FleetError as e:
+            sys.exit(f"ghaf-netboot: {e}")
+    else:
+        if not args.root or args.cmdline is None:
+            ap.error("--root and --cmdline are required without --fleet")
+        macs = set()
+        for raw in args.mac:
+            mac = normalise_mac(raw)
+            if mac is None:
+                sys.exit(f"ghaf-netboot: not a MAC address: {raw}")
+            macs.add(mac)
+        body = boot_json(base, args.cmdline)
+        table = BootTable(dict.fromkeys(macs, body), scan_root(args.root))
+    if not table.boots:
         # Fail closed. An empty allowlist that silently served everyone would be
         # the exact failure this component exists to prevent.
         sys.exit("ghaf-netboot: refusing to start with an empty MAC allowlist")
 
-    os.chdir(args.root)
-    with Server((args.listen, args.port), Handler) as httpd:
+    if args.check:
+        for mac, body in sorted(table.boots.items()):
+            profile = table.profiles.get(mac)
+            print(f"  {mac}" + (f" ({profile})" if profile else ""), file=sys.stderr)
+            print(f"              {json.loads(body)['cmdline']}", file=sys.stderr)
+        return
+
+    # Mbit/s to bytes/s.
+    shaper = Shaper(
+        args.rate_limit and args.rate_limit * 125_000,
+        args.client_rate_limit and args.client_rate_limit * 125_000,
+    )
+    warmer = CacheWarmer() if args.warm_cache else None
+    service = Service(table, args.exit_after_serve, shaper, multicast, warmer)
+    Handler.service = service
+    if args.metrics_port:
+        try:
+            serve_metrics(args.metrics_port, service.metrics)
+        except OSError as e:
+            sys.exit(f"ghaf-netboot: metrics on port {args.metrics_port}: {e}")
+    if args.fleet:
+        watch_fleet(args.fleet, base, service)
+
+    warming = warmer.add(table) if warmer else 0
+
+    def banner():
+        extras = ""
+        if warmer:
+            extras += f", warming {warming / 1e9:.1f} GB into the page cache"
+        if args.rate_limit:
+            extras += f", {args.rate_limit:g} Mbit/s in all"
+        if args.client_rate_limit:
+            extras += f", {args.client_rate_limit:g} Mbit/s per client"
+        if args.multicast:
+            extras += f", multicast on {args.multicast}"
+        if args.metrics_port:
+            extras += f", metrics on http://127.0.0.1:{args.metrics_port}/metrics"
         print(
-            f"ghaf-netboot: HTTP on {base}, serving {args.root}, "
-            f"allowlist: {' '.join(sorted(macs))}",
+            f"ghaf-netboot: HTTP on {base}, serving {args.fleet or args.root}, "
+            f"{describe(table)}{extras}",
             file=sys.stderr,
             flush=True,
         )
-        httpd.serve_forever()
+        if warmer:
+            warmer.start()  # after the banner, so its progress follows it
+
+    # The shell wrapper stops us with SIGTERM; unwind, so the log is written out.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        if args.event_loop:
+            asyncio.run(EventLoopServer(service).serve(args.listen, args.port, banner))
+            return
+        with Server((args.listen, args.port), Handler) as httpd:
+            banner()
+            httpd.serve_forever()
+    finally:
+        LOG.close()
 
 
 if __name__ == "__main__":
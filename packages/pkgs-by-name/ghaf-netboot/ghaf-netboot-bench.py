@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022-2026 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+"""Loopback throughput benchmark for ghaf-netboot-api.
+
+Starts the API against a scratch directory holding a fake image, has several
+clients download it at once over loopback, and reports per-client throughput
+and the server's CPU time per gigabyte served, once for each serving mode:
+
+  ./ghaf-netboot-bench.py --size 2048 --clients 4
+  ./ghaf-netboot-bench.py --mode sendfile --clients 16
+
+Clients are separate processes, so the client side's own copying does not
+share a GIL with anything and the numbers reflect the server. Loopback has no
+NIC in the way, so "MB/s" is an upper bound on what the server can push;
+what matters is the CPU column, which is what runs out on a lab laptop.
+
+With --stalled N it is a load test instead: N clients start downloading the
+image and then stop reading, the way a wedged installer does, and the table
+shows the server's memory and threads and the boot API's latency before and
+while they hang on:
+
+  ./ghaf-netboot-bench.py --stalled 500 --mode threaded --mode event-loop
+
+With --rate MBIT it checks fair shaping: the API runs with --rate-limit MBIT,
+the clients start --stagger seconds apart, and the table shows when each one
+finished against the earliest the whole batch could have, given the limit.
+--slow-client caps the first client's own reading, as a machine behind a
+slow link would, to show its unused share going to the others:
+
+  ./ghaf-netboot-bench.py --size 256 --clients 4 --rate 800 --stagger 1
+
+With --multicast MBIT it measures multicast distribution instead: for each
+--receivers count (default 1, 4 and 16) the API sends one session at MBIT
+Mbit/s to that many ghaf-image-fetch processes, and the table shows how fast
+each receiver got the image, how much of it came by HTTP repair or fallback,
+and whether every copy hashed the same as the original:
+
+  ./ghaf-netboot-bench.py --size 512 --multicast 800
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    "sendfile": [],
+    "copy": ["--no-sendfile"],
+    "event-loop": ["--event-loop"],
+}
+# The load test is about concurrency, not how bytes are copied.
+LOAD_MODES = {
+    "threaded": [],
+    "event-loop": ["--event-loop"],
+}
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument(
+    "--api",
+    default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "ghaf-netboot-api.py"
+    ),
+    help="ghaf-netboot-api to run (default: the one next to this script)",
+)
+parser.add_argument("--size", type=int, default=1024, help="image size in MiB")
+parser.add_argument("--clients", type=int, default=4, help="concurrent downloads")
+parser.add_argument(
+    "--mode",
+    action="append",
+    choices=sorted(MODES | LOAD_MODES),
+    help="serving mode to measure; repeatable (default: all)",
+)
+parser.add_argument(
+    "--stalled",
+    type=int,
+    metavar="N",
+    help="load test: hold N stalled downloads open and probe the boot API",
+)
+parser.add_argument(
+    "--probes", type=int, default=200, help="boot API requests per measurement"
+)
+parser.add_argument(
+    "--rate",
+    type=float,
+    metavar="MBIT",
+    help="fairness test: run the API with --rate-limit MBIT",
+)
+parser.add_argument(
+    "--stagger",
+    type=float,
+    default=1.0,
+    help="with --rate: seconds between one client starting and the next",
+)
+parser.add_argument(
+    "--slow-client",
+    type=float,
+    metavar="MBIT",
+    help="with --rate: the first client reads no faster than MBIT Mbit/s",
+)
+parser.add_argument(
+    "--multicast",
+    type=float,
+    metavar="MBIT",
+    help="multicast test: one session at MBIT Mbit/s to each --receivers count",
+)
+parser.add_argument(
+    "--receivers",
+    type=int,
+    action="append",
+    metavar="N",
+    help="with --multicast: receivers per session; repeatable (default: 1, 4, 16)",
+)
+parser.add_argument(
+    "--fetch",
+    default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "ghaf-image-fetch",
+        "ghaf-image-fetch.py",
+    ),
+    help="ghaf-image-fetch to run (default: the one in the source tree)",
+)
+parser.add_argument(
+    "--api-arg",
+    action="append",
+    default=[],
+    help="extra argument for the API, e.g. --api-arg=--no-sendfile; repeatable",
+)
+
+IMAGE = "ghaf-image/ghaf-image.raw.zst"
+RECV_SIZE = 1024 * 1024
+MAC = "02:00:00:00:00:01"
+# Site-local scope, and sent with a TTL of 1; loopback is all it reaches here.
+GROUP = "239.255.77.42"
+# Seconds a session waits for its receivers; ample for 16 processes to start.
+JOIN_WAIT = 2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    """utime + stime of a running process, from /proc."""
+    with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+        # The command name may contain spaces; fields resume after its ')'.
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def proc_status(pid):
+    """(VmRSS in MB, thread count) of a running process, from /proc."""
+    fields = {}
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            fields[key] = value.split()
+    return int(fields["VmRSS"][0]) / 1024, int(fields["Threads"][0])
+
+
+def boot_latencies(port, count):
+    """Milliseconds for each of `count` sequential boot API requests."""
+    request = f"GET /v1/boot/{MAC} HTTP/1.0\r\nHost: bench\r\n\r\n".encode()
+    times = []
+    for _ in range(count):
+        start = time.monotonic()
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            s.sendall(request)
+            response = b""
+            while chunk := s.recv(4096):
+                response += chunk
+        if response.split(b" ", 2)[1:2] != [b"200"]:
+            raise RuntimeError(f"boot API answered {response[:40]!r}")
+        times.append((time.monotonic() - start) * 1000)
+    return times
+
+
+def stall(port, count):
+    """Open `count` image downloads that read the headers and then nothing."""
+    sockets = []
+    for _ in range(count):
+        s = socket.socket()
+        # A tiny receive window, so the server blocks on each one quickly.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(("127.0.0.1", port))
+        s.sendall(f"GET /{IMAGE} HTTP/1.0\r\nHost: bench\r\n\r\n".encode())
+        s.recv(1024)
+        sockets.append(s)
+    return sockets
+
+
+def download(port):
+    """One client: GET the image, discard it; returns (bytes, seconds)."""
+    buf = bytearray(RECV_SIZE)
+    start = time.monotonic()
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(f"GET /{IMAGE} HTTP/1.0\r\nHost: bench\r\n\r\n".encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = s.recv(4096)
+            if not chunk:
+                raise RuntimeError("connection closed before the headers ended")
+            head += chunk
+        received = len(head) - head.index(b"\r\n\r\n") - 4
+        while n := s.recv_into(buf):
+            received += n
+    return received, time.monotonic() - start
+
+
+def paced_download(job):
+    """download(), after `delay` seconds and reading at most `rate` bytes/s.
+
+    Returns (bytes, started, finished) on the monotonic clock, which on Linux
+    is the same clock in every process.
+    """
+    port, delay, rate = job
+    time.sleep(delay)
+    buf = bytearray(RECV_SIZE // 16 if rate else RECV_SIZE)
+    started = time.monotonic()
+    received = 0
+    with socket.socket() as s:
+        if rate:
+            # Or the kernel's buffers would do the reading for us.
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+        s.connect(("127.0.0.1", port))
+        s.sendall(f"GET /{IMAGE} HTTP/1.0\r\nHost: bench\r\n\r\n".encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = s.recv(4096)
+            if not chunk:
+                raise RuntimeError("connection closed before the headers ended")
+            head += chunk
+        received = len(head) - head.index(b"\r\n\r\n") - 4
+        while n := s.recv_into(buf):
+            received += n
+            if rate:
+                time.sleep(max(started + received / rate - time.monotonic(), 0))
+    return received, started, time.monotonic()
+
+
+def wait_for(port, proc):
+    for _ in range(100):
+        if proc.poll() is not None:
+            sys.exit(f"ghaf-netboot-bench: API exited with {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    sys.exit("ghaf-netboot-bench: API did not start listening")
+
+
+def start_api(mode_args, root, args, port):
+    cmd = [
+        sys.executable,
+        args.api,
+        "--root",
+        root,
+        "--listen",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--mac",
+        MAC,
+        "--cmdline",
+        "bench",
+        *mode_args,
+        *args.api_arg,
+    ]
+    proc = subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
+    wait_for(port, proc)
+    return proc
+
+
+def run(mode, root, args):
+    port = free_port()
+    with start_api(MODES[mode], root, args, port) as proc:
+        try:
+            cpu_before = cpu_seconds(proc.pid)
+            start = time.monotonic()
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(download, [port] * args.clients)
+            wall = time.monotonic() - start
+            cpu = cpu_seconds(proc.pid) - cpu_before
+        finally:
+            proc.terminate()
+
+    size = args.size * 1024 * 1024
+    short = [n for n, _ in results if n != size]
+    if short:
+        sys.exit(f"ghaf-netboot-bench: {mode}: short downloads: {short}")
+    rates = [n / t / 1e6 for n, t in results]
+    total = sum(n for n, _ in results)
+    print(
+        f"{mode:<10} {args.clients:>7} {total / wall / 1e6:>10.0f} "
+        f"{min(rates):>8.0f} {statistics.median(rates):>8.0f} {max(rates):>8.0f} "
+        f"{cpu:>7.2f} {cpu / (total / 1e9):>9.3f}"
+    )
+
+
+def load(mode, root, args):
+    port = free_port()
+    with start_api(LOAD_MODES[mode], root, args, port) as proc:
+        try:
+            idle = boot_latencies(port, args.probes)
+            idle_rss, _ = proc_status(proc.pid)
+            sockets = stall(port, args.stalled)
+            time.sleep(1)  # let every download reach its blocked send
+            loaded = boot_latencies(port, args.probes)
+            loaded_rss, threads = proc_status(proc.pid)
+            for s in sockets:
+                s.close()
+        finally:
+            proc.terminate()
+
+    def p99(times):
+        return statistics.quantiles(times, n=100)[98]
+
+    print(
+        f"{mode:<10} {args.stalled:>7} {idle_rss:>8.1f} {loaded_rss:>8.1f} "
+        f"{threads:>7} {statistics.median(idle):>7.2f} {p99(idle):>7.2f} "
+        f"{statistics.median(loaded):>7.2f} {p99(loaded):>7.2f}"
+    )
+
+
+def fairness(root, args):
+    port = free_port()
+    rate = args.rate * 125_000  # Mbit/s to bytes/s
+    slow = args.slow_client and args.slow_client * 125_000
+    jobs = [
+        (port, i * args.stagger, slow if i == 0 else None) for i in range(args.clients)
+    ]
+    with start_api(["--rate-limit", str(args.rate)], root, args, port) as proc:
+        try:
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(paced_download, jobs)
+        finally:
+            proc.terminate()
+
+    size = args.size * 1024 * 1024
+    short = [n for n, _, _ in results if n != size]
+    if short:
+        sys.exit(f"ghaf-netboot-bench: short downloads: {short}")
+    t0 = min(started for _, started, _ in results)
+    print(f"{'client':<7} {'start s':>8} {'done s':>8} {'MB/s':>8}")
+    for i, (n, started, finished) in enumerate(results):
+        note = "  (slow link)" if i == 0 and slow else ""
+        print(
+            f"{i:<7} {started - t0:>8.1f} {finished - t0:>8.1f} "
+            f"{n / (finished - started) / 1e6:>8.1f}{note}"
+        )
+    # However the link is shared, everything that starts at or after a given
+    # client's start has to fit through it after that point.
+    starts = sorted(started - t0 for _, started, _ in results)
+    bound = max(
+        start + size * (len(starts) - k) / rate for k, start in enumerate(starts)
+    )
+    if slow:
+        bound = max(bound, size / slow)
+    done = max(finished for _, _, finished in results) - t0
+    print(f"batch done in {done:.1f}s; at {args.rate:g} Mbit/s it takes {bound:.1f}s")
+
+
+def multicast(root, args, receivers, digest):
+    port = free_port()
+    api_args = [
+        "--multicast",
+        f"{GROUP}:{free_port()}",
+        "--multicast-rate",
+        str(args.multicast),
+        "--multicast-wait",
+        str(JOIN_WAIT),
+    ]
+    size = args.size * 1024 * 1024
+    url = f"http://127.0.0.1:{port}/{IMAGE}"
+    with start_api(api_args, root, args, port) as proc:
+        try:
+            cpu_before = cpu_seconds(proc.pid)
+            start = time.monotonic()
+            jobs = [
+                (
+                    subprocess.Popen(
+                        [sys.executable, args.fetch, url],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                    ),
+                    size,
+                )
+                for _ in range(receivers)
+            ]
+            # A thread per receiver, so no pipe fills while another is read;
+            # hashlib drops the GIL for large updates.
+            with multiprocessing.pool.ThreadPool(receivers) as pool:
+                results = pool.map(hash_output, jobs)
+            cpu = cpu_seconds(proc.pid) - cpu_before
+        finally:
+            proc.terminate()
+
+    bad = [i for i, (hexdigest, _, _) in enumerate(results) if hexdigest != digest]
+    if bad:
+        sys.exit(f"ghaf-netboot-bench: receivers {bad} wrote a different image")
+    # Timed from when the session starts sending, not from the join.
+    times = [done - start - JOIN_WAIT for _, done, _ in results]
+    rates = [size / t / 1e6 for t in times]
+    over_http = sum(n for _, _, n in results)
+    print(
+        f"{receivers:>9} {receivers * size / max(times) / 1e6:>10.0f} "
+        f"{min(rates):>8.0f} {statistics.median(rates):>8.0f} "
+        f"{over_http / 1e6:>8.1f} {(size + over_http) / size:>10.2f} {cpu:>7.2f}"
+    )
+
+
+def hash_output(job):
+    """(sha256, finish time, bytes fetched over HTTP) of one ghaf-image-fetch."""
+    fetcher, size = job
+    digest = hashlib.sha256()
+    while chunk := fetcher.stdout.read(RECV_SIZE):
+        digest.update(chunk)
+    done = time.monotonic()
+    log = fetcher.stderr.read().decode()
+    if fetcher.wait():
+        sys.exit(f"ghaf-netboot-bench: ghaf-image-fetch failed:\n{log}")
+    over_http = 0.0
+    if match := re.search(r"([\d.]+) MB repaired", log):
+        over_http += float(match.group(1)) * 1e6
+    if match := re.search(r"over HTTP from byte (\d+)", log):
+        over_http += size - int(match.group(1))
+    return digest.hexdigest(), done, over_http
+
+
+def main():
+    args = parser.parse_args()
+    modes = LOAD_MODES if args.stalled else MODES
+    for mode in args.mode or []:
+        if mode not in modes:
+            parser.error(f"--mode {mode} does not apply here; use {', '.join(modes)}")
+    with tempfile.TemporaryDirectory(prefix="ghaf-netboot-bench.") as root:
+        path = os.path.join(root, IMAGE)
+        os.makedirs(os.path.dirname(path))
+        # Incompressible but cheap: one random MiB repeated. Written here, so
+        # it is in the page cache and the disk does not enter into it.
+        block = os.urandom(1024 * 1024)
+        with open(path, "wb") as f:
+            f.writelines(block for _ in range(args.size))
+
+        if args.rate:
+            fairness(root, args)
+            return
+        if args.multicast:
+            digest = hashlib.sha256(block * args.size).hexdigest()
+            # "sent x" is what the server sent, multicast plus HTTP, as a
+            # multiple of one copy; unicast to N receivers would be N.
+            print(
+                f"{'receivers':>9} {'MB/s':>10} {'min':>8} {'median':>8} "
+                f"{'http MB':>8} {'sent x':>10} {'cpu s':>7}"
+            )
+            for receivers in args.receivers or [1, 4, 16]:
+                multicast(root, args, receivers, digest)
+            return
+        if args.stalled:
+            # Latencies in ms, idle and then with the stalled clients attached.
+            print(
+                f"{'mode':<10} {'stalled':>7} {'rss MB':>8} {'-> MB':>8} "
+                f"{'threads':>7} {'p50':>7} {'p99':>7} {'-> p50':>7} {'-> p99':>7}"
+            )
+            for mode in args.mode or list(LOAD_MODES):
+                load(mode, root, args)
+            return
+        print(
+            f"{'mode':<10} {'clients':>7} {'MB/s':>10} "
+            f"{'min':>8} {'median':>8} {'max':>8} {'cpu s':>7} {'cpu s/GB':>9}"
+        )
+        for mode in args.mode or list(MODES):
+            run(mode, root, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,7 @@
 usage() {
   cat <<EOF
 Usage: $(basename "$0") --interface <IFACE> --mac <MAC> --netboot <DIR> --image <DIR> [options]
+       $(basename "$0") --interface <IFACE> --fleet <FILE> [options]
 
 Serve a Ghaf netboot install. Requires root.
 
@@ -25,6 +26,13 @@ Required:
   -n, --netboot <DIR>      Result of .#<target>-netboot-installer
   -g, --image <DIR>        Result of .#<target> (ghaf-image.raw.zst + .bmap)
 
+Or, for several machines with different images at once:
+      --fleet <FILE>       JSON profile file mapping each MAC to its own netboot
+                           and image directories, install target, --encrypt,
+                           --secureboot and extra cmdline (see ghaf-netboot-api).
+                           Replaces --mac, --netboot, --image and the install
+                           options, and is re-read whenever it changes.
+
 Options:
       --install-target <D> Install unattended to <D> (e.g. /dev/nvme0n1).
                            DESTRUCTIVE and requires --mac.
@@ -40,6 +48,37 @@ Options:
       --no-exit-after-serve
                            Keep serving after the image has been fetched. Only
                            safe when the target boots from disk by preference.
+      --event-loop         Serve HTTP from one event loop rather than a thread
+                           per connection. For many targets at once, where
+                           slow or stalled downloads would each pin a thread.
+      --warm-cache         Read the boot files and image into the page cache in
+                           the background at startup, so the first target
+                           streams from memory rather than from a slow disk.
+                           Progress is logged; needs free RAM for the image.
+      --rate-limit <MBIT>  Cap all downloads together at <MBIT> Mbit/s, so the
+                           host's own uplink stays usable. The cap is shared in
+                           proportion to what each target has left, so a batch
+                           finishes together rather than one straggler last.
+      --client-rate-limit <MBIT>
+                           Cap each target's downloads at <MBIT> Mbit/s
+      --multicast          Send the image to a batch of targets at once, over
+                           UDP multicast on 239.255.77.1:48080. Blocks a target
+                           misses it fetches over HTTP, and a target that
+                           cannot keep up downloads the rest over HTTP. With
+                           --exit-after-serve, stops once every target that
+                           joined, or every --mac, has the image.
+      --multicast-rate <MBIT>
+                           Send rate of each multicast session. Defaults to
+                           --rate-limit if that is given, else 400 Mbit/s; it
+                           is not counted against --rate-limit's cap.
+      --multicast-wait <SEC>
+                           How long a session waits for more targets to ask
+                           for the image before sending it (default 30)
+      --metrics-port <PORT>
+                           Per-client throughput, download and boot API counters
+                           in Prometheus format at http://127.0.0.1:<PORT>/metrics
+                           (default 0: off). Loopback only, so it never needs
+                           a firewall hole.
       --force-interface    Skip the default-route / wireless refusals
       --open-firewall      Temporarily open 67/69/4011 and the HTTP ports in the
                            host firewall, and close them again on exit. Without
@@ -73,9 +112,18 @@ IMAGE_DIR=""
 PORT=8080
 TIMEOUT_MIN=60
 INSTALL_TARGET=""
+FLEET=""
 ENCRYPT=false
 SECUREBOOT=false
 FORCE_IFACE=false
+EVENT_LOOP=false
+WARM_CACHE=false
+RATE_LIMIT=""
+CLIENT_RATE_LIMIT=""
+MULTICAST=false
+MULTICAST_RATE=""
+MULTICAST_WAIT=30
+METRICS_PORT=0
 OPEN_FIREWALL=false
 DRY_RUN=false
 # Deliberately tri-state: "" means "nobody asked", which resolves after argument
@@ -110,6 +158,10 @@ while [ $# -gt 0 ]; do
     INSTALL_TARGET="$2"
     shift 2
     ;;
+  --fleet)
+    FLEET="$2"
+    shift 2
+    ;;
   --encrypt)
     ENCRYPT=true
     shift
@@ -134,6 +186,38 @@ while [ $# -gt 0 ]; do
     EXIT_AFTER_SERVE=false
     shift
     ;;
+  --event-loop)
+    EVENT_LOOP=true
+    shift
+    ;;
+  --warm-cache)
+    WARM_CACHE=true
+    shift
+    ;;
+  --rate-limit)
+    RATE_LIMIT="$2"
+    shift 2
+    ;;
+  --client-rate-limit)
+    CLIENT_RATE_LIMIT="$2"
+    shift 2
+    ;;
+  --multicast)
+    MULTICAST=true
+    shift
+    ;;
+  --multicast-rate)
+    MULTICAST_RATE="$2"
+    shift 2
+    ;;
+  --multicast-wait)
+    MULTICAST_WAIT="$2"
+    shift 2
+    ;;
+  --metrics-port)
+    METRICS_PORT="$2"
+    shift 2
+    ;;
   --force-interface)
     FORCE_IFACE=true
     shift
@@ -176,16 +260,26 @@ die() {
 
 # --- G0: nothing is optional, and there is no autodetect -----------------------
 [ -n "$IFACE" ] || die "--interface is required (no default: picking the wrong NIC is the whole hazard)"
-[ ${#MACS[@]} -gt 0 ] || die "--mac is required; without an allowlist any PXE client on this LAN would be served"
-[ -n "$NETBOOT_DIR" ] || die "--netboot is required"
-[ -n "$IMAGE_DIR" ] || die "--image is required"
-
-[ -d "$NETBOOT_DIR" ] || die "no such directory: $NETBOOT_DIR"
-for f in bzImage initrd netboot.ipxe; do
-  [ -e "$NETBOOT_DIR/$f" ] || die "$NETBOOT_DIR/$f missing -- is that a *-netboot-installer result?"
-done
-[ -e "$IMAGE_DIR/ghaf-image.raw.zst" ] || die "$IMAGE_DIR/ghaf-image.raw.zst missing"
-[ -e "$IMAGE_DIR/ghaf-image.bmap" ] || die "$IMAGE_DIR/ghaf-image.bmap missing (needed to verify the image)"
+if [ -n "$FLEET" ]; then
+  # The profile file is the allowlist and carries everything per machine;
+  # mixing in the single-machine options would leave it unclear which wins.
+  if [ ${#MACS[@]} -gt 0 ] || [ -n "$NETBOOT_DIR$IMAGE_DIR$INSTALL_TARGET" ] || $ENCRYPT || $SECUREBOOT; then
+    die "--fleet replaces --mac, --netboot, --image, --install-target, --encrypt and --secureboot"
+  fi
+  [ -f "$FLEET" ] || die "no such fleet file: $FLEET"
+  FLEET=$(readlink -f "$FLEET")
+else
+  [ ${#MACS[@]} -gt 0 ] || die "--mac is required; without an allowlist any PXE client on this LAN would be served"
+  [ -n "$NETBOOT_DIR" ] || die "--netboot is required"
+  [ -n "$IMAGE_DIR" ] || die "--image is required"
+
+  [ -d "$NETBOOT_DIR" ] || die "no such directory: $NETBOOT_DIR"
+  for f in bzImage initrd netboot.ipxe; do
+    [ -e "$NETBOOT_DIR/$f" ] || die "$NETBOOT_DIR/$f missing -- is that a *-netboot-installer result?"
+  done
+  [ -e "$IMAGE_DIR/ghaf-image.raw.zst" ] || die "$IMAGE_DIR/ghaf-image.raw.zst missing"
+  [ -e "$IMAGE_DIR/ghaf-image.bmap" ] || die "$IMAGE_DIR/ghaf-image.bmap missing (needed to verify the image)"
+fi
 
 # Empty means "use pixiecore's own built-in iPXE" (--ipxe builtin, or a non-x86
 # build host). Do NOT substitute a *stock* iPXE here: our binary and pixiecore's
@@ -201,12 +295,21 @@ if [ -n "$INSTALL_TARGET" ]; then
   [[ $INSTALL_TARGET =~ ^/dev/[a-zA-Z0-9._-]+$ ]] || die "--install-target must look like /dev/nvme0n1"
 fi
 
+for rate in "$RATE_LIMIT" "$CLIENT_RATE_LIMIT" "$MULTICAST_RATE"; do
+  [ -z "$rate" ] || [[ $rate =~ ^[0-9]*[.]?[0-9]+$ && ! $rate =~ ^[0.]+$ ]] ||
+    die "rate limits are positive numbers of Mbit/s, not '$rate'"
+done
+[[ $MULTICAST_WAIT =~ ^[0-9]+$ ]] || die "--multicast-wait must be whole seconds"
+MULTICAST_RATE="${MULTICAST_RATE:-${RATE_LIMIT:-400}}"
+
 # An unattended install now ends with the installer rebooting itself, so a
 # server still answering PXE catches that reboot and reinstalls the machine --
 # an install loop, on the one operation where a loop is most expensive. Default
 # it on rather than leaving it to be remembered.
+# A fleet is reimaged unattended by definition, and the API stops booting each
+# machine once it has its image, so the same default applies there.
 if [ -z "$EXIT_AFTER_SERVE" ]; then
-  if [ -n "$INSTALL_TARGET" ]; then EXIT_AFTER_SERVE=true; else EXIT_AFTER_SERVE=false; fi
+  if [ -n "$INSTALL_TARGET$FLEET" ]; then EXIT_AFTER_SERVE=true; else EXIT_AFTER_SERVE=false; fi
 fi
 if [ -n "$INSTALL_TARGET" ] && [ "$EXIT_AFTER_SERVE" = false ]; then
   echo "ghaf-netboot: WARNING --no-exit-after-serve with --install-target: if this target" >&2
@@ -305,43 +408,70 @@ firewall_warn_if_closed() {
 # mounts the store and then drops to an emergency shell with
 # "Failed to start Find NixOS closure" -- confirmed on hardware. The store path
 # changes with every rebuild, so it has to be read at run time.
-IPXE_SCRIPT="$NETBOOT_DIR/netboot.ipxe"
-BASE_CMDLINE=$(awk '/^kernel /{ sub(/^kernel[[:space:]]+[^[:space:]]+[[:space:]]*/, ""); print; exit }' "$IPXE_SCRIPT")
-[ -n "$BASE_CMDLINE" ] || die "could not read a 'kernel' line from $IPXE_SCRIPT"
-case "$BASE_CMDLINE" in
-*init=*) ;;
-*) die "no init= in $IPXE_SCRIPT; the target would drop to an emergency shell" ;;
-esac
-
-# Drop the iPXE-only placeholders and the builder's own image URL: that one is
-# templated on ${next-server} for a plain iPXE workflow, and we serve the image
-# ourselves, so ours has to win rather than appear alongside it.
-BASE_CMDLINE=$(
-  printf '%s\n' "$BASE_CMDLINE" |
-    sed -e 's/[$]{cmdline}//g' -e 's#ghaf[.]image_url=[^[:space:]]*##g' -e 's/[[:space:]]\+/ /g' -e 's/^ //' -e 's/ $//'
-)
-
-IMAGE_URL="http://${LISTEN_IP}:${PORT}/ghaf-image"
-CMDLINE="$BASE_CMDLINE ghaf.image_url=${IMAGE_URL}"
-if [ -n "$INSTALL_TARGET" ]; then
-  CMDLINE="$CMDLINE ghaf.install_target=${INSTALL_TARGET}"
-  $ENCRYPT && CMDLINE="$CMDLINE ghaf.install_encrypt"
-  $SECUREBOOT && CMDLINE="$CMDLINE ghaf.install_secureboot"
+# With --fleet, ghaf-netboot-api applies the same rules to each profile itself.
+if [ -z "$FLEET" ]; then
+  IPXE_SCRIPT="$NETBOOT_DIR/netboot.ipxe"
+  BASE_CMDLINE=$(awk '/^kernel /{ sub(/^kernel[[:space:]]+[^[:space:]]+[[:space:]]*/, ""); print; exit }' "$IPXE_SCRIPT")
+  [ -n "$BASE_CMDLINE" ] || die "could not read a 'kernel' line from $IPXE_SCRIPT"
+  case "$BASE_CMDLINE" in
+  *init=*) ;;
+  *) die "no init= in $IPXE_SCRIPT; the target would drop to an emergency shell" ;;
+  esac
+
+  # Drop the iPXE-only placeholders and the builder's own image URL: that one is
+  # templated on ${next-server} for a plain iPXE workflow, and we serve the image
+  # ourselves, so ours has to win rather than appear alongside it.
+  BASE_CMDLINE=$(
+    printf '%s\n' "$BASE_CMDLINE" |
+      sed -e 's/[$]{cmdline}//g' -e 's#ghaf[.]image_url=[^[:space:]]*##g' -e 's/[[:space:]]\+/ /g' -e 's/^ //' -e 's/ $//'
+  )
+
+  IMAGE_URL="http://${LISTEN_IP}:${PORT}/ghaf-image"
+  CMDLINE="$BASE_CMDLINE ghaf.image_url=${IMAGE_URL}"
+  if [ -n "$INSTALL_TARGET" ]; then
+    CMDLINE="$CMDLINE ghaf.install_target=${INSTALL_TARGET}"
+    $ENCRYPT && CMDLINE="$CMDLINE ghaf.install_encrypt"
+    $SECUREBOOT && CMDLINE="$CMDLINE ghaf.install_secureboot"
+  fi
+  $MULTICAST && CMDLINE="$CMDLINE ghaf.image_multicast"
 fi
 
-cat >&2 <<EOF
+if [ -n "$FLEET" ]; then
+  cat >&2 <<EOF
+ghaf-netboot:
+  interface   $IFACE ($LISTEN_IP)
+  fleet       $FLEET (reloaded on change)
+  http        http://${LISTEN_IP}:${PORT}
+  page cache  $(if $WARM_CACHE; then echo "warmed in the background at startup"; else echo "filled by the first download"; fi)
+  shaping     ${RATE_LIMIT:-unlimited} Mbit/s in all, ${CLIENT_RATE_LIMIT:-unlimited} Mbit/s per target
+  multicast   $(if $MULTICAST; then echo "239.255.77.1:48080 at ${MULTICAST_RATE} Mbit/s, ${MULTICAST_WAIT} s to join"; else echo "off"; fi)
+  metrics     $(if [ "$METRICS_PORT" = 0 ]; then echo "off"; else echo "http://127.0.0.1:${METRICS_PORT}/metrics"; fi)
+  ipxe        ${IPXE_EFI64:-pixiecore built-in (native drivers; broadcast DHCP fails on some NICs)}
+  stop        $(if $EXIT_AFTER_SERVE; then echo "once every machine has been served its image"; else echo "on timeout or signal only"; fi)
+  timeout     $(if [ "$TIMEOUT_MIN" = 0 ]; then echo "none"; else echo "${TIMEOUT_MIN} min"; fi)
+EOF
+  # Prints what each machine would be told, and fails on a bad profile file.
+  ghaf-netboot-api --fleet "$FLEET" --listen "$LISTEN_IP" --port "$PORT" --check ||
+    die "$FLEET does not load"
+else
+  cat >&2 <<EOF
 ghaf-netboot:
   interface   $IFACE ($LISTEN_IP)
   allowlist   ${MACS[*]}
   netboot     $NETBOOT_DIR
   image       $IMAGE_DIR
   http        http://${LISTEN_IP}:${PORT}
+  page cache  $(if $WARM_CACHE; then echo "warmed in the background at startup"; else echo "filled by the first download"; fi)
+  shaping     ${RATE_LIMIT:-unlimited} Mbit/s in all, ${CLIENT_RATE_LIMIT:-unlimited} Mbit/s per target
+  multicast   $(if $MULTICAST; then echo "239.255.77.1:48080 at ${MULTICAST_RATE} Mbit/s, ${MULTICAST_WAIT} s to join"; else echo "off"; fi)
+  metrics     $(if [ "$METRICS_PORT" = 0 ]; then echo "off"; else echo "http://127.0.0.1:${METRICS_PORT}/metrics"; fi)
   ipxe        ${IPXE_EFI64:-pixiecore built-in (native drivers; broadcast DHCP fails on some NICs)}
   cmdline     $CMDLINE
   mode        $(if [ -n "$INSTALL_TARGET" ]; then echo "UNATTENDED INSTALL to $INSTALL_TARGET (destructive)"; else echo "interactive TUI"; fi)
-  stop        $(if $EXIT_AFTER_SERVE; then echo "once the image has been served in full"; else echo "on timeout or signal only"; fi)
+  stop        $(if ! $EXIT_AFTER_SERVE; then echo "on timeout or signal only"; elif $MULTICAST; then echo "once every multicast target that joined, or every --mac, has the image"; else echo "once the image has been served in full"; fi)
   timeout     $(if [ "$TIMEOUT_MIN" = 0 ]; then echo "none"; else echo "${TIMEOUT_MIN} min"; fi)
 EOF
+fi
 
 firewall_warn_if_closed
 
@@ -354,13 +484,17 @@ fi
 
 # --- serve --------------------------------------------------------------------
 # linkFarm results are symlinks into the store; deref them so the HTTP server
-# does not have to follow links out of its root.
-ROOT=$(mktemp -d)
-mkdir -p "$ROOT/boot" "$ROOT/ghaf-image"
-cp -L "$NETBOOT_DIR/bzImage" "$ROOT/boot/bzImage"
-cp -L "$NETBOOT_DIR/initrd" "$ROOT/boot/initrd"
-ln -s "$(readlink -f "$IMAGE_DIR/ghaf-image.raw.zst")" "$ROOT/ghaf-image/ghaf-image.raw.zst"
-ln -s "$(readlink -f "$IMAGE_DIR/ghaf-image.bmap")" "$ROOT/ghaf-image/ghaf-image.bmap"
+# does not have to follow links out of its root. A fleet has no root: the API
+# serves exactly the files its profiles name, and nothing else.
+ROOT=""
+if [ -z "$FLEET" ]; then
+  ROOT=$(mktemp -d)
+  mkdir -p "$ROOT/boot" "$ROOT/ghaf-image"
+  cp -L "$NETBOOT_DIR/bzImage" "$ROOT/boot/bzImage"
+  cp -L "$NETBOOT_DIR/initrd" "$ROOT/boot/initrd"
+  ln -s "$(readlink -f "$IMAGE_DIR/ghaf-image.raw.zst")" "$ROOT/ghaf-image/ghaf-image.raw.zst"
+  ln -s "$(readlink -f "$IMAGE_DIR/ghaf-image.bmap")" "$ROOT/ghaf-image/ghaf-image.bmap"
+fi
 
 API_PID=""
 PIXIE_PID=""
@@ -369,21 +503,33 @@ cleanup() {
   [ -n "$API_PID" ] && kill "$API_PID" 2>/dev/null || true
   [ -n "$PIXIE_PID" ] && kill "$PIXIE_PID" 2>/dev/null || true
   firewall_close || true
-  rm -rf "$ROOT" || true
+  [ -z "$ROOT" ] || rm -rf "$ROOT" || true
   echo "ghaf-netboot: stopped" >&2
 }
 trap cleanup EXIT INT TERM
 
 $OPEN_FIREWALL && firewall_open
 
-mac_args=()
-for m in "${MACS[@]}"; do mac_args+=(--mac "$m"); done
-
 serve_args=()
+if [ -n "$FLEET" ]; then
+  serve_args+=(--fleet "$FLEET")
+else
+  serve_args+=(--root "$ROOT" --cmdline "$CMDLINE")
+  for m in "${MACS[@]}"; do serve_args+=(--mac "$m"); done
+fi
 $EXIT_AFTER_SERVE && serve_args+=(--exit-after-serve)
+$EVENT_LOOP && serve_args+=(--event-loop)
+$WARM_CACHE && serve_args+=(--warm-cache)
+[ -z "$RATE_LIMIT" ] || serve_args+=(--rate-limit "$RATE_LIMIT")
+[ -z "$CLIENT_RATE_LIMIT" ] || serve_args+=(--client-rate-limit "$CLIENT_RATE_LIMIT")
+if $MULTICAST; then
+  # One hop and a fixed group: the installer's firewall opens this port only.
+  serve_args+=(--multicast 239.255.77.1:48080 --multicast-wait "$MULTICAST_WAIT")
+  serve_args+=(--multicast-rate "$MULTICAST_RATE")
+fi
+[ "$METRICS_PORT" = 0 ] || serve_args+=(--metrics-port "$METRICS_PORT")
 
-ghaf-netboot-api --root "$ROOT" --listen "$LISTEN_IP" --port "$PORT" \
-  --cmdline "$CMDLINE" "${mac_args[@]}" "${serve_args[@]+"${serve_args[@]}"}" &
+ghaf-netboot-api --listen "$LISTEN_IP" --port "$PORT" "${serve_args[@]}" &
 API_PID=$!
 sleep 1
 kill -0 "$API_PID" 2>/dev/null || die "HTTP server failed to start"